@@ -3,58 +3,330 @@
 
 #define dhtType DHT11
 #define dhtPin 32
+#define moisturePin 34  // Capacitive probe on an ADC1 pin (ADC2 is unusable with WiFi)
+#define moistureOversample 8  // ADC reads averaged per reading
+
+#define heartbeatIntervalMs 1000  // Max silence before a heartbeat is sent
+#define minSampleIntervalMs 10
+#define argumentTimeoutMs 50  // Wait for the digits of an N/I/D argument
+
+// Binary reading frame (little endian, 13 bytes):
+// 0xA5 | type | seq u16 | loop u8 | moisture i16 | temp i16 | humidity i16 | crc16
+// Values are fixed point x100, INT16_MIN means NaN. Must match Software/protocol.py
+// Type 0x02 adds raw ADC counts u16 before the CRC (15 bytes); moisture is
+// sent as NaN and calibrated on the host (Software/calibration.py)
+#define frameSync 0xA5
+#define frameReading 0x01
+#define frameRawReading 0x02
+#define frameSize 15
+// Type 0x03 replays a buffered sample (22 bytes):
+// 0xA5 | 0x03 | seq u32 | age ms u32 | loop u16 | moisture i16 | temp i16 |
+// humidity i16 | raw u16 | crc16
+#define frameStoredReading 0x03
+#define storedFrameSize 22
+
+// Every sample is kept in a RAM ring buffer so a host that lost the link can
+// ask for what it missed with "D<last seq>\n" (store-and-forward)
+#define bufferCapacity 2048
+#define dumpFramesPerLoop 16  // Dumps are interleaved with normal sampling
 
 bool isRunning = false;
-int loopCounter = 0;  // Added loop counter
-const int totalLoops = 5;  // Number of loops to perform
+long loopCounter = 0;  // Added loop counter
+long totalLoops = 5;  // Number of loops to perform, 0 = burst until stopped
+unsigned long sampleIntervalMs = 2000;  // Time between readings during a run
+unsigned long lastSampleMs = 0;
+unsigned long lastTxMs = 0;  // Last time anything was written to Serial
+bool binaryMode = false;  // Text until the host asks for binary frames
+uint32_t sampleSeq = 0;  // Sequence number of the newest sample (first is 1)
+
+struct StoredSample {
+  uint32_t seq;
+  uint32_t takenMs;
+  uint16_t loop;
+  int16_t moisture;
+  int16_t temperature;
+  int16_t humidity;
+  uint16_t rawCounts;
+};
+
+StoredSample ring[bufferCapacity];
+uint32_t dumpNext = 0;  // Next sequence to replay, 0 when no dump is running
+uint32_t dumpSent = 0;
 
 
 DHT dht(dhtPin, dhtType);
 
 
+void markTx() {
+  lastTxMs = millis();
+}
+
+// CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)
+uint16_t crc16(const uint8_t *data, size_t len) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+int16_t toFixed(float value) {
+  if (isnan(value)) {
+    return INT16_MIN;
+  }
+  return (int16_t)lroundf(value * 100.0f);
+}
+
+void putInt16(uint8_t *out, int16_t value) {
+  out[0] = (uint16_t)value & 0xFF;
+  out[1] = ((uint16_t)value >> 8) & 0xFF;
+}
+
+void putUint32(uint8_t *out, uint32_t value) {
+  for (int i = 0; i < 4; i++) {
+    out[i] = (value >> (8 * i)) & 0xFF;
+  }
+}
+
+void sendReadingFrame(float moisture_percent, float temperature, float humidity, uint16_t rawCounts) {
+  uint8_t frame[frameSize];
+  frame[0] = frameSync;
+  frame[1] = frameRawReading;
+  putInt16(&frame[2], (int16_t)(sampleSeq & 0xFFFF));
+  frame[4] = (uint8_t)(loopCounter & 0xFF);  // Host unwraps past 255
+  putInt16(&frame[5], toFixed(moisture_percent));
+  putInt16(&frame[7], toFixed(temperature));
+  putInt16(&frame[9], toFixed(humidity));
+  putInt16(&frame[11], (int16_t)rawCounts);
+  putInt16(&frame[13], (int16_t)crc16(frame, frameSize - 2));
+  Serial.write(frame, frameSize);
+}
+
+void storeSample(float moisture_percent, float temperature, float humidity, uint16_t rawCounts) {
+  StoredSample &slot = ring[sampleSeq % bufferCapacity];
+  slot.seq = sampleSeq;
+  slot.takenMs = millis();
+  slot.loop = (uint16_t)loopCounter;
+  slot.moisture = toFixed(moisture_percent);
+  slot.temperature = toFixed(temperature);
+  slot.humidity = toFixed(humidity);
+  slot.rawCounts = rawCounts;
+}
+
+void sendStoredFrame(const StoredSample &sample) {
+  uint8_t frame[storedFrameSize];
+  frame[0] = frameSync;
+  frame[1] = frameStoredReading;
+  putUint32(&frame[2], sample.seq);
+  putUint32(&frame[6], millis() - sample.takenMs);
+  putInt16(&frame[10], (int16_t)sample.loop);
+  putInt16(&frame[12], sample.moisture);
+  putInt16(&frame[14], sample.temperature);
+  putInt16(&frame[16], sample.humidity);
+  putInt16(&frame[18], (int16_t)sample.rawCounts);
+  putInt16(&frame[20], (int16_t)crc16(frame, storedFrameSize - 2));
+  Serial.write(frame, storedFrameSize);
+}
+
+void sendStoredLine(const StoredSample &sample) {
+  Serial.print("Stored: ");
+  Serial.print(sample.seq);
+  Serial.print(",");
+  Serial.print(millis() - sample.takenMs);
+  Serial.print(",");
+  Serial.print(sample.loop);
+  Serial.print(",");
+  Serial.print(sample.moisture);
+  Serial.print(",");
+  Serial.print(sample.temperature);
+  Serial.print(",");
+  Serial.print(sample.humidity);
+  Serial.print(",");
+  Serial.println(sample.rawCounts);
+}
+
+// Replay everything after `after` that is still buffered. A host asking for
+// a sequence we never produced talks to a rebooted board: send it all.
+void startDump(uint32_t after) {
+  uint32_t oldest = sampleSeq > bufferCapacity ? sampleSeq - bufferCapacity + 1 : 1;
+  if (after > sampleSeq) {
+    after = 0;
+  }
+  dumpNext = after + 1 < oldest ? oldest : after + 1;
+  dumpSent = 0;
+}
+
+void continueDump() {
+  for (int i = 0; i < dumpFramesPerLoop && dumpNext != 0; i++) {
+    if (dumpNext > sampleSeq) {
+      Serial.print("Dump: sent=");
+      Serial.print(dumpSent);
+      Serial.print(" seq=");
+      Serial.print(sampleSeq);
+      Serial.print(" loop=");
+      Serial.print(loopCounter);
+      Serial.print(" running=");
+      Serial.println(isRunning ? 1 : 0);
+      dumpNext = 0;
+      break;
+    }
+    const StoredSample &sample = ring[dumpNext % bufferCapacity];
+    if (binaryMode) {
+      sendStoredFrame(sample);
+    } else {
+      sendStoredLine(sample);
+    }
+    dumpNext++;
+    dumpSent++;
+  }
+  markTx();
+}
+
+uint16_t readMoistureCounts() {
+  uint32_t total = 0;
+  for (int i = 0; i < moistureOversample; i++) {
+    total += analogRead(moisturePin);
+  }
+  return (uint16_t)(total / moistureOversample);
+}
+
+// Serial.parseInt() returns 0 when no digits arrive, which for N would
+// silently mean burst mode. Only take an argument that is actually there.
+bool readArgument(long &value) {
+  unsigned long started = millis();
+  while (millis() - started < argumentTimeoutMs) {
+    int next = Serial.peek();
+    if (next == ' ') {
+      Serial.read();
+    } else if (next >= '0' && next <= '9') {
+      value = Serial.parseInt();
+      return true;
+    } else if (next >= 0) {
+      return false;  // Something other than a number follows the command
+    }
+  }
+  return false;
+}
+
+void reportConfig() {
+  Serial.print("Config: N=");
+  Serial.print(totalLoops);
+  Serial.print(" I=");
+  Serial.println(sampleIntervalMs);
+  markTx();
+}
+
 void setup() {
   Serial.begin(115200); // Starts the serial communication
+  Serial.setTimeout(argumentTimeoutMs);  // Bounds parseInt() for the N/I/D arguments
   dht.begin();
+  analogReadResolution(12);
 }
 
 void loop() {
   if (Serial.available() > 0) {
     char command = Serial.read();
-    
+
     if (command == 'S') {  // Start command
       isRunning = true;
       loopCounter = 0;
-      Serial.println("Started");
+      lastSampleMs = millis() - sampleIntervalMs;  // Take the first reading now
+      Serial.print("Started seq=");  // Lets the host extend 16-bit frame sequences
+      Serial.println(sampleSeq);
+      markTx();
       // Removed initial Loop:0 message
     }
     else if (command == 'X') {  // Stop command
       isRunning = false;
       Serial.println("Stopped");
+      markTx();
+    }
+    else if (command == 'P') {  // Liveness probe from the host
+      Serial.println("HB");
+      markTx();
+    }
+    else if (command == 'B') {  // Switch readings to binary frames
+      binaryMode = true;
+      Serial.println("Mode: binary");
+      markTx();
+    }
+    else if (command == 'T') {  // Back to the text protocol
+      binaryMode = false;
+      Serial.println("Mode: text");
+      markTx();
+    }
+    else if (command == 'N') {  // N<count>: readings per run, N0 = burst
+      long count;
+      if (readArgument(count)) {  // A bare N leaves the count as it is
+        totalLoops = count;
+      }
+      reportConfig();
+    }
+    else if (command == 'I') {  // I<ms>: interval between readings
+      long interval = Serial.parseInt();
+      if (interval >= minSampleIntervalMs) {
+        sampleIntervalMs = interval;
+      }
+      reportConfig();
+    }
+    else if (command == 'Q') {  // Query the current configuration
+      reportConfig();
+    }
+    else if (command == 'D') {  // D<seq>: replay buffered samples after seq
+      long after = Serial.parseInt();
+      startDump(after < 0 ? 0 : (uint32_t)after);
     }
   }
 
-  if (isRunning && loopCounter < 5) {
+  bool burst = totalLoops == 0;
+  if (isRunning && (burst || loopCounter < totalLoops) && millis() - lastSampleMs >= sampleIntervalMs) {
+    lastSampleMs = millis();
+
     // Read sensors
     float temperature = dht.readTemperature();
     float humidity = dht.readHumidity();
-    float moisture_percent = 50.15;  // Replace with actual sensor reading
+    uint16_t rawCounts = readMoistureCounts();
+    float moisture_percent = NAN;  // Calibrated on the host from rawCounts
+
+    loopCounter++;
+    sampleSeq++;
+    storeSample(moisture_percent, temperature, humidity, rawCounts);
 
     // Send data
-    Serial.print(moisture_percent, 2);
-    Serial.print(",");
-    Serial.print(temperature, 2);
-    Serial.print(",");
-    Serial.println(humidity, 2);
+    if (binaryMode) {
+      sendReadingFrame(moisture_percent, temperature, humidity, rawCounts);  // Carries the loop count
+    } else {
+      Serial.print(moisture_percent, 2);
+      Serial.print(",");
+      Serial.print(temperature, 2);
+      Serial.print(",");
+      Serial.print(humidity, 2);
+      Serial.print(",");
+      Serial.println(rawCounts);
 
-    loopCounter++;
-    Serial.print("Loop: ");
-    Serial.println(loopCounter);
-    
-    if (loopCounter >= 5) {
+      Serial.print("Loop: ");
+      Serial.println(loopCounter);
+    }
+
+    if (!burst && loopCounter >= totalLoops) {
       isRunning = false;
-      Serial.println("Complete: Finished 5 loops");
+      Serial.print("Complete: Finished ");
+      Serial.print(totalLoops);
+      Serial.println(" loops");
     }
-    
-    delay(2000);
+    markTx();
+  }
+
+  if (dumpNext != 0) {
+    continueDump();
   }
-}
\ No newline at end of file
+
+  // Any output proves we are alive; only send a heartbeat after a silence
+  if (millis() - lastTxMs >= heartbeatIntervalMs) {
+    Serial.println("HB");
+    markTx();
+  }
+}
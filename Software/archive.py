@@ -0,0 +1,182 @@
+import csv
+import gzip
+import heapq
+import os
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select, and_, not_
+from models import ArchiveFile, MoistureContent
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Only needed for Parquet/Arrow archive files
+    pa = None
+
+# Read side of the archive written by retention.py. Each manifest entry
+# covers exactly the rows with start <= date_created < end and id <= max_id
+# that were in MoistureContent when its file was written. Anything else in
+# the table (catch-up rows dated into an archived month, months skipped by
+# an archiving run, rows added later) is still live, so a range is answered
+# from the overlapping files plus MoistureContent minus what the files
+# cover, merged by date. Rows come back as tuples in HEADER order.
+
+# Every MoistureContent column, so archived readings can still be
+# recalibrated and listed per run. The first six are export.HEADER; files
+# written before the rest were added read back with them as None.
+COLUMNS = [
+    MoistureContent.id,
+    MoistureContent.moisture_percent,
+    MoistureContent.temperature,
+    MoistureContent.humidity,
+    MoistureContent.date_created.label('timestamp'),
+    MoistureContent.device_id,
+    MoistureContent.raw_counts,
+    MoistureContent.seq,
+    MoistureContent.run_id
+]
+HEADER = [c.key for c in COLUMNS]
+INTEGER_FIELDS = ('id', 'raw_counts', 'seq', 'run_id')
+
+Part = namedtuple('Part', ['path', 'format', 'start', 'end', 'rows', 'max_id'])
+
+
+def database_dir(conn):
+    """Directory of the SQLite file, where archive paths are resolved"""
+    database = conn.engine.url.database
+    return os.path.dirname(os.path.abspath(database)) if database else os.getcwd()
+
+
+def parts(conn, start=None, end=None):
+    """Manifest entries overlapping [start, end), oldest first.
+
+    Relative paths (written by older versions) are taken relative to the
+    database file.
+    """
+    stmt = select(ArchiveFile.path, ArchiveFile.format, ArchiveFile.start,
+                  ArchiveFile.end, ArchiveFile.rows, ArchiveFile.max_id)
+    if start is not None:
+        stmt = stmt.where(ArchiveFile.end > start)
+    if end is not None:
+        stmt = stmt.where(ArchiveFile.start < end)
+    base = database_dir(conn)
+    return [Part(os.path.join(base, row.path), *row[1:])
+            for row in conn.execute(stmt.order_by(ArchiveFile.start, ArchiveFile.id))]
+
+
+def not_archived(covered):
+    """Conditions leaving out MoistureContent rows that one of `covered` holds.
+
+    Normally those rows are already deleted; this keeps them from showing
+    twice while an interrupted delete is pending.
+    """
+    return [not_(and_(MoistureContent.date_created >= part.start,
+                      MoistureContent.date_created < part.end,
+                      MoistureContent.id <= part.max_id))
+            for part in covered]
+
+
+def _parse_csv_row(row, header=HEADER):
+    """A row of an archive CSV (columns named by `header`) as a HEADER tuple"""
+    values = dict(zip(header, row))
+    parsed = []
+    for name in HEADER:
+        value = values.get(name, '')
+        if value == '':
+            parsed.append(None)
+        elif name == 'timestamp':
+            parsed.append(datetime.fromisoformat(value))
+        elif name == 'device_id':
+            parsed.append(value)
+        else:
+            parsed.append(int(value) if name in INTEGER_FIELDS else float(value))
+    return tuple(parsed)
+
+
+def _read_csv(path, start, end, device_id, chunk_size):
+    with gzip.open(path, 'rt', newline='') if path.endswith('.gz') else open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or HEADER
+        chunk = []
+        for raw in reader:
+            row = _parse_csv_row(raw, header)
+            if start is not None and row[4] < start:
+                continue
+            if end is not None and row[4] >= end:
+                continue
+            if device_id is not None and row[5] != device_id:
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _read_arrow(path, fmt, start, end, device_id, chunk_size):
+    if pa is None:
+        raise RuntimeError("pyarrow is required to read Parquet/Arrow archive files")
+    if fmt == 'parquet':
+        batches = pa.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size)
+    else:
+        reader = pa.ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    pc = pa.compute
+    for batch in batches:
+        stamps = batch.column('timestamp')
+        mask = None
+        conditions = []
+        if start is not None:
+            conditions.append(pc.greater_equal(stamps, pa.scalar(start, stamps.type)))
+        if end is not None:
+            conditions.append(pc.less(stamps, pa.scalar(end, stamps.type)))
+        if device_id is not None:
+            conditions.append(pc.equal(batch.column('device_id'), device_id))
+        for condition in conditions:
+            mask = condition if mask is None else pc.and_(mask, condition)
+        if mask is not None:
+            batch = batch.filter(mask)
+        if batch.num_rows:
+            names = batch.schema.names
+            yield list(zip(*[batch.column(name).to_pylist() if name in names
+                             else [None] * batch.num_rows for name in HEADER]))
+
+
+def read_part(part, start=None, end=None, device_id=None, chunk_size=5000):
+    """Yield lists of rows from one archive file, filtered to the range"""
+    if part.format == 'csv':
+        return _read_csv(part.path, start, end, device_id, chunk_size)
+    return _read_arrow(part.path, part.format, start, end, device_id, chunk_size)
+
+
+def _rows(chunks):
+    for chunk in chunks:
+        yield from chunk
+
+
+def merged(covered, live_chunks, start=None, end=None, device_id=None, chunk_size=5000):
+    """Yield lists of rows from the `covered` files and live chunks in date order.
+
+    Every source is already sorted by date, so they are merged lazily and
+    only one chunk per source is held at a time. Archived rows have every
+    HEADER field; live ones whatever their query selected.
+    """
+    sources = [_rows(read_part(part, start, end, device_id, chunk_size)) for part in covered]
+    sources.append(_rows(live_chunks))
+    chunk = []
+    for row in heapq.merge(*sources, key=lambda row: row[4]):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_archived(conn, start=None, end=None, device_id=None, chunk_size=5000):
+    """Yield lists of archived rows in [start, end), in date order"""
+    yield from merged(parts(conn, start, end), [], start, end, device_id, chunk_size)
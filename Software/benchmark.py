@@ -0,0 +1,379 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from ingest import ReadingWriter
+from storage import open_storage
+from models import setup_database
+from simulator import FakeDevice
+
+# End-to-end ingestion benchmark: a simulated ESP32 (simulator.py) feeds
+# the controller.py pipeline and the MoistureMonitorApp collection path,
+# and every sample is timed from the moment the device writes it until
+# the batch holding it is committed. Results are checked against
+# THRESHOLDS and, with --baseline, against a previous run saved by --save.
+# The startup path runs the GUI in a fresh interpreter under -X importtime
+# and reports import time, time to the first window and time to connected.
+
+THRESHOLDS = {
+    'min_throughput_ratio': 0.95,  # Stored samples/s over the offered rate
+    'max_p99_latency_ms': 2500.0,  # Includes the writer's 1 s flush interval
+    'max_cpu_percent': 80.0,       # Of one core, simulator excluded
+    'max_rss_mb': 400.0,
+    'max_gui_import_ms': 800.0,
+    'max_first_window_ms': 2000.0,
+    'max_connected_ms': 5000.0
+}
+HIGHER_IS_BETTER = ('samples_per_s',)
+COMPARED = ('samples_per_s', 'p50_latency_ms', 'p99_latency_ms', 'cpu_percent')
+STARTUP_COMPARED = ('gui_import_ms', 'first_window_ms', 'connected_ms', 'controller_import_ms')
+
+# Runs in a fresh interpreter: argv is (spawn time, port, database URL)
+STARTUP_PROBE = """
+import contextlib, json, os, sys, time
+spawned, port, database = float(sys.argv[1]), sys.argv[2], sys.argv[3]
+marks = {'interpreter': time.monotonic() - spawned}
+import tkinter as tk
+from interface import MoistureMonitorApp
+try:
+    root = tk.Tk()
+except tk.TclError:
+    root = None
+if root is not None:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        app = MoistureMonitorApp(root, port=port, database=database)
+        root.update()
+        marks['window'] = time.monotonic() - spawned
+        deadline = time.monotonic() + 15
+        while not app.is_connected and time.monotonic() < deadline:
+            root.update()
+            time.sleep(0.01)
+        if app.is_connected:
+            marks['connected'] = time.monotonic() - spawned
+        app.on_closing()
+print(json.dumps(marks))
+"""
+
+
+class TimedWriter(ReadingWriter):
+    """ReadingWriter that records when the row with each device seq was committed"""
+
+    def __init__(self, *args, **kwargs):
+        self.committed = {}
+        super().__init__(*args, **kwargs)
+
+    def _write(self, rows):
+        super()._write(rows)
+        now = time.monotonic()
+        for row in rows:
+            if row.get('seq') is not None:
+                self.committed[row['seq']] = now
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Measurement:
+    """CPU and wall time of this process over a run, minus the simulator thread"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def __enter__(self):
+        self.wall = time.monotonic()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.device_cpu = self.device.cpu_time
+        return self
+
+    def __exit__(self, *exc):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.wall = time.monotonic() - self.wall
+        self.cpu = usage.ru_utime + usage.ru_stime - self.cpu
+        self.cpu -= self.device.cpu_time - self.device_cpu
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        self.rss_mb = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+        return False
+
+
+def summarize(name, device, writer, measurement, samples):
+    latencies = [(writer.committed[seq] - sent) * 1000.0
+                 for seq, sent in device.sent_at.items() if seq in writer.committed]
+    stored = len(latencies)
+    span = None
+    if latencies:
+        span = max(writer.committed.values()) - min(device.sent_at.values())
+    return {
+        'path': name,
+        'samples': samples,
+        'stored': stored,
+        'offered_rate': 1.0 / device.interval,
+        'samples_per_s': round(stored / span, 1) if span else 0.0,
+        'p50_latency_ms': round(percentile(latencies, 0.50) or 0.0, 1),
+        'p99_latency_ms': round(percentile(latencies, 0.99) or 0.0, 1),
+        'cpu_percent': round(100.0 * measurement.cpu / measurement.wall, 1),
+        'rss_mb': round(measurement.rss_mb, 1),
+        'corrupted_writes': device.corrupted,
+        'link_drops': device.drops
+    }
+
+
+def make_device(args):
+    return FakeDevice(total_loops=args.samples, interval=1.0 / args.rate, raw_counts=2300,
+                      noise=args.noise, corrupt_rate=args.corrupt, drop_every=args.drop_every,
+                      drop_for=args.drop_for, seed=1, track_latency=True).start()
+
+
+def bench_controller(args, database):
+    """controller.py: reader thread -> DeviceLink (Collector) -> batched writer"""
+    from hub import DeviceLink
+
+    device = make_device(args)
+    engine, Session = setup_database(database)
+    writer = TimedWriter(Session, storage=open_storage(args.storage, Session))
+    done = threading.Event()
+
+    def on_message(device_id, data):
+        if data.get('status', '').startswith("Complete"):
+            done.set()
+    timeout = args.samples / args.rate * 2 + 10
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        link = DeviceLink(device.port, device.port, writer, binary=not args.text,
+                          on_message=on_message).open()
+        with Measurement(device) as measurement:
+            link.send(b'S')
+            done.wait(timeout)
+            writer.flush()
+
+        link.close()
+    writer.close()
+    device.stop()
+    engine.dispose()
+    return summarize('controller', device, writer, measurement, args.samples)
+
+
+def bench_gui(args, database):
+    """MoistureMonitorApp: monitor thread, collection thread and Tk event loop"""
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Skipping GUI path: {e}")
+        return None
+    root.withdraw()
+    from interface import MoistureMonitorApp
+
+    # The firmware (and the GUI) accept intervals down to 10 ms
+    rate = min(args.rate, 100.0)
+    device = make_device(argparse.Namespace(**dict(vars(args), rate=rate)))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        app = MoistureMonitorApp(root, port=device.port, database=database)
+        app.use_binary = not args.text
+        app.writer.close()
+        app.writer = TimedWriter(app.Session)
+
+        deadline = time.monotonic() + 15
+        while not (app.is_connected and app.reader) and time.monotonic() < deadline:
+            root.update()
+            time.sleep(0.01)
+        time.sleep(3)  # Let the monitor finish negotiating the protocol
+        app.samples_var.set(str(args.samples))
+        app.interval_var.set(str(int(round(1000.0 / rate))))
+
+        with Measurement(device) as measurement:
+            app.start_data_collection()
+            deadline = time.monotonic() + args.samples / rate * 2 + 10
+            while app.is_collecting and time.monotonic() < deadline:
+                root.update()
+                time.sleep(0.005)
+            app.writer.flush()
+
+        writer = app.writer
+        app.on_closing()
+    device.stop()
+    return summarize('gui', device, writer, measurement, args.samples)
+
+
+def import_times(stderr, module):
+    """Cumulative ms of `module` and of its direct imports, from -X importtime output"""
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        # Nested imports are indented two spaces per level and listed before their parent
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = round(int(cumulative) / 1000.0, 1)
+        elif depth == 0:
+            if name.strip() == module:
+                return round(int(cumulative) / 1000.0, 1), children
+            children = {}
+    return None, {}
+
+
+def run_probe(code, *args):
+    """Run `code` in a fresh interpreter with -X importtime; returns (stdout, stderr)"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        p for p in (here, os.environ.get('PYTHONPATH')) if p))
+    spawned = time.monotonic()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code, str(spawned)]
+                             + list(args), capture_output=True, text=True, env=env, timeout=60)
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    return process.stdout, process.stderr
+
+
+def bench_startup(args, database):
+    """Imports, first window and first connection of a freshly started GUI"""
+    device = make_device(args)
+    try:
+        stdout, stderr = run_probe(STARTUP_PROBE, device.port, database)
+    finally:
+        device.stop()
+    marks = json.loads(stdout.strip().splitlines()[-1])
+    gui_import, imports = import_times(stderr, 'interface')
+    controller_import, _ = import_times(run_probe("import controller")[1], 'controller')
+
+    def ms(mark):
+        return round(marks[mark] * 1000.0, 1) if mark in marks else None
+
+    slowest = sorted(imports.items(), key=lambda item: -item[1])
+    if 'window' not in marks:
+        print("Startup: no display, only imports are measured")
+    return {
+        'path': 'startup',
+        'interpreter_ms': ms('interpreter'),
+        'gui_import_ms': gui_import,
+        'first_window_ms': ms('window'),
+        'connected_ms': ms('connected'),
+        'controller_import_ms': controller_import,
+        'slowest_imports': [[name, round(value, 1)] for name, value in slowest[:5]]
+    }
+
+
+def check_startup(result):
+    failures = []
+    for key, limit in (('gui_import_ms', 'max_gui_import_ms'),
+                       ('first_window_ms', 'max_first_window_ms'),
+                       ('connected_ms', 'max_connected_ms')):
+        if result[key] is not None and result[key] > THRESHOLDS[limit]:
+            failures.append(f"{key} {result[key]} ms")
+    return failures
+
+
+def check(result, baseline=None, tolerance=0.2):
+    """List of regressions in `result`"""
+    if result['path'] == 'startup':
+        failures = check_startup(result)
+        compared = STARTUP_COMPARED
+    else:
+        failures = check_ingestion(result)
+        compared = COMPARED
+
+    previous = (baseline or {}).get(result['path'])
+    for key in compared if previous else ():
+        old, new = previous.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (old - new) / old if key in HIGHER_IS_BETTER else (new - old) / old
+        if change > tolerance:
+            failures.append(f"{key} {old} -> {new} ({change:+.0%} worse than baseline)")
+    return failures
+
+
+def check_ingestion(result):
+    failures = []
+    ratio = result['samples_per_s'] / result['offered_rate']
+    if ratio < THRESHOLDS['min_throughput_ratio']:
+        failures.append(f"throughput {result['samples_per_s']}/s is "
+                        f"{ratio:.0%} of the offered {result['offered_rate']:.0f}/s")
+    if result['p99_latency_ms'] > THRESHOLDS['max_p99_latency_ms']:
+        failures.append(f"p99 latency {result['p99_latency_ms']} ms")
+    if result['cpu_percent'] > THRESHOLDS['max_cpu_percent']:
+        failures.append(f"CPU {result['cpu_percent']}%")
+    if result['rss_mb'] > THRESHOLDS['max_rss_mb']:
+        failures.append(f"RSS {result['rss_mb']} MB")
+    return failures
+
+
+def describe(result):
+    if result['path'] == 'startup':
+        slowest = ", ".join(f"{name} {value} ms" for name, value in result['slowest_imports'])
+        return (f"startup: GUI import {result['gui_import_ms']} ms, first window "
+                f"{result['first_window_ms']} ms, connected {result['connected_ms']} ms, "
+                f"controller import {result['controller_import_ms']} ms (slowest: {slowest})")
+    return (f"{result['path']}: {result['stored']}/{result['samples']} stored, "
+            f"{result['samples_per_s']} samples/s, latency p50 {result['p50_latency_ms']} ms "
+            f"p99 {result['p99_latency_ms']} ms, CPU {result['cpu_percent']}%, "
+            f"RSS {result['rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ingestion benchmark")
+    parser.add_argument("--path", choices=['controller', 'gui', 'startup', 'all'], default='all')
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=100.0, help="Samples per second")
+    parser.add_argument("--text", action="store_true", help="Use the text protocol")
+    parser.add_argument("--storage", default="sqlite",
+                        help="Controller path storage: sqlite or segments:<directory>")
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Probability a write is corrupted")
+    parser.add_argument("--drop-every", type=float, help="Mean seconds between link drops")
+    parser.add_argument("--drop-for", type=float, default=1.0)
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed change vs baseline")
+    parser.add_argument("--save", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    paths = ['controller', 'gui', 'startup'] if args.path == 'all' else [args.path]
+    results = {}
+    failures = []
+    for path in paths:
+        # Each path gets a fresh database; sockets are created next to it
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                database = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+                bench = {'controller': bench_controller, 'gui': bench_gui,
+                         'startup': bench_startup}[path]
+                result = bench(args, database)
+            finally:
+                os.chdir(cwd)
+        if result is None:
+            continue
+        results[path] = result
+        problems = check(result, baseline, args.tolerance)
+        failures += [f"{path}: {p}" for p in problems]
+        print(describe(result) + (" - REGRESSION" if problems else ""))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f"Regression: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select, update, bindparam, func
+from models import MoistureContent, DeviceCalibration, VarietyCurve, setup_database
+import queries
+import rollups
+
+# Host-side calibration. Devices send raw ADC counts; moisture % is derived
+# here so a new calibration never requires re-reading the sensors:
+#   r = (counts - dry) / (wet - dry)           per device (DeviceCalibration)
+#   m = poly(r) + temp_coeff * (T - ref_temp)  per variety (VarietyCurve)
+# The combination for a device is compiled once into a Model and cached.
+
+# Typical capacitive probe on the ESP32's 12-bit ADC; replace per sensor
+DEFAULT_DRY_COUNTS = 3200.0
+DEFAULT_WET_COUNTS = 1400.0
+DEFAULT_VARIETY = 'generic'
+REPROCESS_CHUNK = 20000
+
+Model = namedtuple('Model', [
+    'dry', 'span', 'coefficients', 'temp_coeff', 'ref_temp', 'min_percent', 'max_percent'
+])
+
+
+def compile_model(device, curve):
+    """Model from a DeviceCalibration and VarietyCurve (either may be None)"""
+    dry = device.dry_counts if device else DEFAULT_DRY_COUNTS
+    wet = device.wet_counts if device else DEFAULT_WET_COUNTS
+    if curve is None:
+        curve = VarietyCurve(variety=DEFAULT_VARIETY, c0=0.0, c1=100.0, c2=0.0, c3=0.0,
+                             temp_coeff=0.0, ref_temp=25.0, min_percent=0.0, max_percent=100.0)
+    # np.polyval wants the highest power first
+    coefficients = np.array([curve.c3, curve.c2, curve.c1, curve.c0], dtype=float)
+    return Model(dry, wet - dry, coefficients, curve.temp_coeff, curve.ref_temp,
+                 curve.min_percent, curve.max_percent)
+
+
+def evaluate(model, counts, temperatures=None):
+    """Moisture % for arrays of counts (and temperatures); NaN where counts are missing"""
+    counts = np.asarray(counts, dtype=float)
+    ratio = (counts - model.dry) / model.span
+    moisture = np.polyval(model.coefficients, ratio)
+    if temperatures is not None and model.temp_coeff:
+        delta = np.asarray(temperatures, dtype=float) - model.ref_temp
+        # No compensation for readings without a temperature
+        moisture += model.temp_coeff * np.nan_to_num(delta, nan=0.0)
+    return np.clip(moisture, model.min_percent, model.max_percent)
+
+
+class CalibrationEngine:
+    """Converts raw counts to moisture % with cached per-device models.
+
+    Models are loaded on first use of a device and kept until
+    `invalidate()`; `set_device()` and `set_curve()` invalidate for you.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, Session):
+        self.Session = Session
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def model(self, device_id):
+        key = device_id or ''
+        with self.lock:
+            model = self.models.get(key)
+        if model is not None:
+            return model
+        with self.Session() as session:
+            device = session.get(DeviceCalibration, key) if key else None
+            variety = device.variety if device else DEFAULT_VARIETY
+            model = compile_model(device, session.get(VarietyCurve, variety))
+        with self.lock:
+            self.models[key] = model
+        return model
+
+    def invalidate(self, device_id=None):
+        """Forget cached models (all of them if no device is given)"""
+        with self.lock:
+            if device_id is None:
+                self.models.clear()
+            else:
+                self.models.pop(device_id, None)
+
+    def convert(self, device_id, counts, temperatures=None):
+        return evaluate(self.model(device_id), counts, temperatures)
+
+    def value(self, device_id, counts, temperature=None):
+        """Single reading convenience wrapper around convert()"""
+        temperature = np.nan if temperature is None else temperature
+        return float(self.convert(device_id, [counts], [temperature])[0])
+
+    def apply(self, rows):
+        """Fill moisture_percent for every row dict that has raw_counts but no value.
+
+        Rows calibrated before filtering (collector.py) keep their value.
+        Rows are grouped per device and each group is converted in one call.
+        """
+        groups = {}
+        for i, row in enumerate(rows):
+            moisture = row.get('moisture_percent')
+            if row.get('raw_counts') is not None and (moisture is None or moisture != moisture):
+                groups.setdefault(row.get('device_id'), []).append(i)
+        for device_id, indexes in groups.items():
+            counts = np.array([rows[i]['raw_counts'] for i in indexes], dtype=float)
+            temperatures = np.array([
+                np.nan if rows[i]['temperature'] is None else rows[i]['temperature']
+                for i in indexes
+            ], dtype=float)
+            moisture = self.convert(device_id, counts, temperatures)
+            for i, value in zip(indexes, moisture.tolist()):
+                rows[i]['moisture_percent'] = value
+        return rows
+
+    def set_device(self, device_id, dry_counts, wet_counts, variety=DEFAULT_VARIETY):
+        if wet_counts == dry_counts:
+            # A zero span would turn every reading into NaN
+            raise ValueError(f"Wet and dry counts are both {dry_counts}")
+        with self.Session() as session:
+            session.merge(DeviceCalibration(device_id=device_id, dry_counts=dry_counts,
+                                            wet_counts=wet_counts, variety=variety))
+            session.commit()
+        self.invalidate(device_id)
+
+    def set_curve(self, variety, coefficients, temp_coeff=0.0, ref_temp=25.0,
+                  min_percent=0.0, max_percent=100.0):
+        """Store a variety curve; `coefficients` are c0..c3 (missing ones are 0)"""
+        c = list(coefficients) + [0.0] * (4 - len(coefficients))
+        with self.Session() as session:
+            session.merge(VarietyCurve(variety=variety, c0=c[0], c1=c[1], c2=c[2], c3=c[3],
+                                       temp_coeff=temp_coeff, ref_temp=ref_temp,
+                                       min_percent=min_percent, max_percent=max_percent))
+            session.commit()
+        self.invalidate()
+
+
+def reprocess(engine, Session, start=None, end=None, device_id=None, chunk_size=REPROCESS_CHUNK):
+    """Recompute moisture_percent from stored raw counts with the current calibration.
+
+    Rows are walked in id order, one chunk per transaction, and the rollups
+    of the affected range are rebuilt afterwards. Archived rows are left as
+    they are. Returns the number of readings updated.
+    """
+    calibration = CalibrationEngine(Session)
+    stmt = queries.filter_range(
+        select(MoistureContent.id, MoistureContent.device_id, MoistureContent.raw_counts,
+               MoistureContent.temperature),
+        start, end, device_id
+    ).where(MoistureContent.raw_counts.isnot(None)).order_by(MoistureContent.id).limit(chunk_size)
+    change = update(MoistureContent).where(MoistureContent.id == bindparam('row_id')).values(
+        moisture_percent=bindparam('moisture')
+    ).execution_options(synchronize_session=False)
+
+    updated = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(stmt.where(MoistureContent.id > last_id)).all()
+            if not rows:
+                break
+            ids = np.array([r[0] for r in rows])
+            devices = np.array([r[1] or '' for r in rows], dtype=object)
+            counts = np.array([r[2] for r in rows], dtype=float)
+            temperatures = np.array([np.nan if r[3] is None else r[3] for r in rows], dtype=float)
+            moisture = np.empty(len(rows))
+            for device in set(devices):
+                mask = devices == device
+                moisture[mask] = calibration.convert(device, counts[mask], temperatures[mask])
+            conn.execute(change, [
+                {'row_id': int(i), 'moisture': float(m)} for i, m in zip(ids, moisture)
+            ])
+        updated += len(rows)
+        last_id = int(ids[-1])
+
+    if updated:
+        # Rebuild the rollups over the buckets that were touched
+        with engine.connect() as conn:
+            first, last = conn.execute(
+                queries.filter_range(
+                    select(func.min(MoistureContent.date_created),
+                           func.max(MoistureContent.date_created)),
+                    start, end, device_id
+                ).where(MoistureContent.raw_counts.isnot(None))
+            ).one()
+        # `end` is exclusive; keep the newest reading inside it
+        rollups.backfill(engine, first, last + timedelta(microseconds=1), device_id)
+        with engine.begin() as conn:
+            queries.mark_changed(conn)  # Cached views of these rows are now stale
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage sensor calibration")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    device = commands.add_parser("device", help="Set a device's dry/wet counts and variety")
+    device.add_argument("device_id")
+    device.add_argument("--dry", type=float, required=True)
+    device.add_argument("--wet", type=float, required=True)
+    device.add_argument("--variety", default=DEFAULT_VARIETY)
+
+    curve = commands.add_parser("curve", help="Set a variety curve")
+    curve.add_argument("variety")
+    curve.add_argument("coefficients", type=float, nargs='+', help="c0 [c1 [c2 [c3]]]")
+    curve.add_argument("--temp-coeff", type=float, default=0.0)
+    curve.add_argument("--ref-temp", type=float, default=25.0)
+    curve.add_argument("--min", type=float, default=0.0)
+    curve.add_argument("--max", type=float, default=100.0)
+
+    redo = commands.add_parser("reprocess", help="Recompute stored readings from raw counts")
+    redo.add_argument("--start", type=datetime.fromisoformat)
+    redo.add_argument("--end", type=datetime.fromisoformat)
+    redo.add_argument("--device")
+
+    commands.add_parser("list", help="Show stored calibrations")
+    args = parser.parse_args()
+
+    engine, Session = setup_database()
+    calibration = CalibrationEngine(Session)
+    if args.command == "device":
+        try:
+            calibration.set_device(args.device_id, args.dry, args.wet, args.variety)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.command == "curve":
+        calibration.set_curve(args.variety, args.coefficients, args.temp_coeff,
+                              args.ref_temp, args.min, args.max)
+    elif args.command == "reprocess":
+        count = reprocess(engine, Session, args.start, args.end, args.device)
+        print(f"Reprocessed {count} readings")
+    else:
+        with Session() as session:
+            for d in session.scalars(select(DeviceCalibration)):
+                print(f"device {d.device_id}: dry={d.dry_counts} wet={d.wet_counts} variety={d.variety}")
+            for c in session.scalars(select(VarietyCurve)):
+                print(f"variety {c.variety}: {c.c0} {c.c1} {c.c2} {c.c3} "
+                      f"temp_coeff={c.temp_coeff} ref={c.ref_temp} range={c.min_percent}..{c.max_percent}")
+
+
+if __name__ == "__main__":
+    main()
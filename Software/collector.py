@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta
+from filters import ReadingFilter, in_range
+import runs
+import log
+import metrics
+from protocol import (parse_message, parse_config, configure, unwrap_loop, started_seq,
+                      DEFAULT_SAMPLE_COUNT, DEFAULT_INTERVAL_MS)
+
+# The run lifecycle of one device, whatever carries its items. hub.DeviceLink
+# (and through it the daemon), controller.py and the GUI all feed the items
+# of their SerialReader to a Collector, so opening runs, unwrapping sequence
+# numbers, calibrating, filtering and deciding how a run ended happen in
+# one place.
+
+
+class Collector:
+    """Per-item ingestion for one device: parse, filter, queue and record runs.
+
+    Readings are calibrated, filtered and queued on `writer` tagged with
+    `device_id`. "Started" opens the run's MeasurementRun row, "Complete"
+    and "Stopped" store its filtered result. `on_reading(row)` is called
+    for every queued reading and `on_finish(status, result)` for every
+    stored run.
+    """
+
+    def __init__(self, writer, device_id, run_filter=None, on_reading=None, on_finish=None):
+        self.writer = writer
+        self.device_id = device_id
+        self.filter = run_filter or ReadingFilter()
+        self.on_reading = on_reading
+        self.on_finish = on_finish
+        self.is_collecting = False
+        self.loop_count = 0
+        self.config = None  # (count, interval_ms) last reported by the device
+        self.run_started = None
+        self.run_seq = None  # Device sequence number before the run's first sample
+        self.run_id = None  # MeasurementRun row of the current run
+        self.grain_lot = None  # Recorded with the runs started from now on
+
+    def adopt(self, previous):
+        """Continue the run of a link that was lost, instead of starting fresh"""
+        self.filter = previous.filter
+        self.run_started = previous.run_started
+        self.run_id = previous.run_id
+        self.grain_lot = previous.grain_lot
+        self.run_seq = previous.run_seq
+        self.loop_count = previous.loop_count
+        self.config = previous.config
+
+    def configure(self, reader, write, count=None, interval_ms=None):
+        """Set and/or query the run settings while `reader` is in queue mode.
+
+        A device that does not answer is an older firmware running its
+        defaults, so `config` is always known once this has been called.
+        """
+        self.config = (configure(reader, write, count, interval_ms)
+                       or (DEFAULT_SAMPLE_COUNT, DEFAULT_INTERVAL_MS))
+        return self.config
+
+    def last_seq(self):
+        """Device sequence number of the newest reading of this run, if known"""
+        if self.run_seq is None:
+            return None
+        return self.run_seq + self.loop_count
+
+    def reading_seq(self, data):
+        """Device sequence number of a parsed reading, if it can be known"""
+        if data.get('stored'):
+            return data['seq']
+        seq = self.last_seq()
+        if seq is not None and 'loop' not in data:
+            seq += 1  # Text mode: "Loop: N" follows the reading
+        return seq
+
+    def begin_run(self):
+        """Create the run's row so its readings can reference it"""
+        count, interval_ms = self.config or (None, None)
+        self.run_id = runs.open_run(self.writer.Session, self.device_id, self.run_started,
+                                    self.grain_lot, count, interval_ms)
+
+    def end_status(self, stopped=False):
+        """Status of a run that ended now: only burst runs (N=0) end when stopped"""
+        count = self.config[0] if self.config else DEFAULT_SAMPLE_COUNT
+        if count == 0 or (not stopped and self.loop_count >= count):
+            return runs.COMPLETE
+        return runs.INCOMPLETE
+
+    def finish_run(self, status=runs.COMPLETE):
+        """Store the filtered result of the current run, if one is open"""
+        if self.run_started is None:
+            return
+        started, self.run_started = self.run_started, None
+        run_id, self.run_id = self.run_id, None
+        result = self.filter.result()
+        runs.close_run(self.writer.Session, self.device_id, started, result, status, run_id)
+        print(f"[{self.device_id}] Run result: {runs.describe(result)}")
+        if self.on_finish:
+            self.on_finish(status, result)
+
+    def apply_catch_up(self, answer):
+        """Ingest the answer of protocol.catch_up() and resume or close the run"""
+        if answer is None:
+            # Firmware without a ring buffer: what was sent meanwhile is lost
+            print(f"[{self.device_id}] No dump answer, closing the interrupted run")
+            self.finish_run(runs.INTERRUPTED)
+            return
+
+        items, info = answer
+        rows = []
+        for received, item in items:
+            data = parse_message(item)
+            if not data:
+                continue
+            timestamp = received - timedelta(milliseconds=data['age_ms'])
+            # Stored loop counts are exact, unlike the 8-bit live ones
+            self.loop_count = max(self.loop_count, data['loop'])
+            row = self._reading(data, timestamp)
+            if row:
+                rows.append(row)
+                if self.on_reading:
+                    self.on_reading(row)
+        self.writer.put_many(rows)
+        print(f"[{self.device_id}] Caught up {len(rows)} readings")
+
+        if info.get('loop') is not None:
+            self.loop_count = max(self.loop_count, info['loop'])
+        if info.get('seq') is not None and self.run_seq is not None:
+            self.run_seq = info['seq'] - self.loop_count
+        self.is_collecting = bool(info.get('running'))
+        if not self.is_collecting:
+            self.finish_run(self.end_status())
+
+    def _reading(self, data, timestamp):
+        """Calibrated, filtered row for the writer, or None if rejected"""
+        if data.get('raw_counts') is not None:
+            # Calibrated once, here, since the filters need the value; the
+            # writer keeps it. A failed temperature read is not compensated for
+            temperature = data['temperature'] if in_range('temperature', data['temperature']) else None
+            data['moisture_percent'] = self.writer.calibration.value(
+                self.device_id, data['raw_counts'], temperature)
+        reading = self.filter.process(data)
+        if not reading:
+            log.debug('rejected', device=self.device_id, data=data)
+            return None
+        return {
+            'moisture_percent': reading['moisture_percent'],
+            'temperature': reading['temperature'],
+            'humidity': reading['humidity'],
+            'date_created': timestamp,
+            'device_id': self.device_id,
+            'raw_counts': reading.get('raw_counts'),
+            'seq': self.reading_seq(data),
+            'run_id': self.run_id
+        }
+
+    def handle(self, item):
+        """Ingest one item from the reader; returns the parsed data or None"""
+        data = metrics.parse(item, self.device_id)
+        if not data:
+            if isinstance(item, bytes) and item.strip() not in (b'', b'HB'):
+                log.debug('unrecognised', device=self.device_id, line=item)
+            return None
+
+        if 'loop' in data:
+            self.loop_count = unwrap_loop(self.loop_count, data['loop'])
+        if 'moisture_percent' in data:
+            row = self._reading(data, datetime.now())
+            if row:
+                self.writer.put(**row)
+                if self.on_reading:
+                    self.on_reading(row)
+        if 'status' in data:
+            status = data['status']
+            if status.startswith("Started"):
+                self.is_collecting = True
+                self.loop_count = 0
+                self.filter.reset()
+                self.run_started = datetime.now()
+                self.run_seq = started_seq(status)
+                self.begin_run()
+            elif status.startswith("Complete"):
+                self.is_collecting = False
+                self.finish_run(runs.COMPLETE)
+            elif status.startswith("Stopped"):
+                self.is_collecting = False
+                self.finish_run(self.end_status(stopped=True))
+            elif status.startswith("Config:"):
+                self.config = parse_config(status)
+        return data
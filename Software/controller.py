@@ -1,176 +1,133 @@
 import serial
 import time
-from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Moisture, Base
+from models import setup_database
+from ingest import ReadingWriter
+from hub import DeviceLink, LIVENESS_INTERVAL
+import runs
+import metrics
+import profiler
+from serial_reader import find_esp32_ports, device_identity
 
-def connect_serial():
-    """Attempt to connect to ESP32 via serial"""
+DEFAULT_PORT = 'COM3'  # Used when no USB serial board is found
+RECONNECT_DELAY = 2.0  # Seconds between attempts to reopen a lost port
+
+def find_port():
+    """First USB serial board, or DEFAULT_PORT"""
+    ports = find_esp32_ports()
+    return ports[0].device if ports else DEFAULT_PORT
+
+def connect(port, writer, binary=True, previous=None):
+    """Open a DeviceLink to the ESP32; `previous` is a link lost mid-run"""
+    link = DeviceLink(device_identity(port), port, writer, binary=binary)
+    if previous is not None and previous.run_started is not None:
+        link.adopt(previous)  # open() fetches what the device buffered meanwhile
     try:
-        ser = serial.Serial(
-            port='COM3',
-            baudrate=115200,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            timeout=1
-        )
-        print("Successfully connected to ESP32")
-        time.sleep(2)  # Give time for serial connection to stabilize
-        ser.flush()    # Flush any leftover data
-        return ser
-    except serial.SerialException as e:
+        link.open()
+    except (serial.SerialException, OSError) as e:
         print(f"Error connecting to serial port: {e}")
+        link.close()
         return None
+    print("Successfully connected to ESP32")
+    if binary:
+        if link.binary_mode:
+            print("Using binary frames")
+        else:
+            print("Device did not answer binary request, using text protocol")
+    print(f"Device settings: {link.config}")
+    return link
 
-def parse_data(line):
-    """Parse the incoming data string from ESP32"""
-    try:
-        # Print raw data for debugging
-        print(f"Raw bytes received: {line}")
-        
-        # Try different decodings if utf-8 fails
-        try:
-            decoded_line = line.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                decoded_line = line.decode('ascii', errors='ignore')
-            except:
-                decoded_line = line.decode('latin-1')
-        
-        print(f"Decoded line: {decoded_line}")
-        
-        # Check if this is a status message
-        if "Started" in decoded_line or "Stopped" in decoded_line:
-            return {"status": decoded_line.strip()}
-            
-        # Clean the data and split by comma
-        cleaned_line = decoded_line.strip()
-        if not cleaned_line:  # Skip empty lines
-            return None
-            
-        values = cleaned_line.split(',')
-        
-        # Check if we have all required values
-        if len(values) != 3:  # Expecting 3 values
-            print(f"Warning: Expected 3 values, but got {len(values)}")
-            return None
-            
-        # Convert values to appropriate types
+def main(binary=True, port=None, metrics_port=metrics.METRICS_PORT):
+    # Counters and histograms on http://127.0.0.1:9108/metrics
+    if metrics_port:
         try:
-            return {
-                'moisture_percent': float(values[0]),
-                'temperature': float(values[1]),
-                'humidity': float(values[2])
-            }
-        except (ValueError, IndexError) as e:
-            print(f"Error converting values: {e}")
-            return None
-            
-    except Exception as e:
-        print(f"Error parsing data: {e}")
-        print(f"Problematic line: {line}")
-        return None
+            metrics.serve(metrics_port)
+        except OSError as e:
+            print(f"Metrics endpoint disabled: {e}")
+    if profiler.enabled():
+        profiler.install_signal_toggle()
 
-def main():
     # Database connection
-    engine = create_engine('sqlite:///moistureDB.db')
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    # Serial connection
-    ser = connect_serial()
-    if not ser:
+    engine, Session = setup_database()
+    writer = ReadingWriter(Session)
+
+    # Serial connection; parsing, filtering and runs are the link's (see collector.py)
+    port = port or find_port()
+    runs.sweep(Session, device_identity(port))  # Runs a previous session left open
+    link = connect(port, writer, binary)
+    if not link:
+        writer.close()
         return
     
     print("\nCommands:")
     print("s - Start data collection")
     print("x - Stop data collection")
+    print("n <count> - Readings per run (0 = burst until stopped)")
+    print("i <ms> - Interval between readings")
+    print("l <lot> - Grain lot recorded with the next runs")
     print("q - Quit program")
     print("\nWaiting for command...")
     
+    lost = None  # Link that failed, replaced once the port opens again
+    grain_lot = None
     try:
         while True:
             # Check for user input
             if input_available():  # You'll need to implement this based on your OS
-                command = input().lower()
-                
-                if command == 's':
-                    ser.write(b'S')  # Send start command
-                    print("Sending start command...")
-                
-                elif command == 'x':
-                    ser.write(b'X')  # Send stop command
-                    print("Sending stop command...")
+                command, _, argument = input().strip().partition(' ')
+                command = command.lower()
                 
-                elif command == 'q':
-                    print("Quitting...")
-                    break
-            
-            # Check for serial data
-            if ser.in_waiting:
                 try:
-                    line = ser.readline()
-                    if line:
-                        data = parse_data(line)
-                        
-                        if data:
-                            # Check if this is a status message
-                            if "status" in data:
-                                print(f"ESP32 Status: {data['status']}")
-                                continue
-                                
-                            # Create new moisture reading
-                            moisture_reading = Moisture(
-                                moisture_percent=data['moisture_percent'],
-                                date_created=datetime.now()
-                            )
-                            moisture_reading.temperature = data['temperature']
-                            moisture_reading.humidity = data['humidity']
-                            
-                            # Save to database
-                            try:
-                                session.add(moisture_reading)
-                                session.commit()
-                                print(f"Saved reading: "
-                                      f"Moisture: {data['moisture_percent']}%, "
-                                      f"Temp: {data['temperature']}°C, "
-                                      f"Humidity: {data['humidity']}%")
-                            except Exception as e:
-                                print(f"Error saving to database: {e}")
-                                session.rollback()
-                                
-                except Exception as e:
-                    print(f"Unexpected error: {e}")
-            
-            # Small delay to prevent excessive CPU usage
-            time.sleep(0.1)
+                    if command == 's':
+                        link.send(b'S')  # Send start command
+                        print("Sending start command...")
+
+                    elif command == 'x':
+                        link.send(b'X')  # Send stop command
+                        print("Sending stop command...")
+
+                    elif command == 'l':
+                        grain_lot = link.grain_lot = argument.strip() or None
+                        print(f"Grain lot: {grain_lot or '-'}")
+
+                    elif command in ('n', 'i') and argument.strip().isdigit():
+                        # The device answers with its new "Config:" line
+                        link.send(command.upper().encode() + argument.strip().encode() + b'\n')
+
+                    elif command == 'q':
+                        print("Quitting...")
+                        break
+                except (serial.SerialException, OSError, AttributeError) as e:
+                    print(f"Command failed: {e}")
+
+            # Readings are handled on the link's reader thread; this loop
+            # only polls stdin and watches the link
+            time.sleep(LIVENESS_INTERVAL / 10)
+            if lost is None and not link.is_alive():
+                print(f"Serial error: {link.reader.error or 'heartbeat lost'}, reconnecting...")
+                link.close()
+                lost, reconnect_at = link, time.monotonic()
+            if lost is not None and time.monotonic() >= reconnect_at:
+                link = connect(lost.port, writer, binary, lost)
+                if link:
+                    link.grain_lot = grain_lot  # An adopted run keeps the lot it was stored with
+                    lost = None
+                else:
+                    link = lost
+                    reconnect_at = time.monotonic() + RECONNECT_DELAY
                 
     except KeyboardInterrupt:
         print("\nStopping data collection...")
     finally:
         # Send stop command before closing
-        ser.write(b'X')
-        time.sleep(0.5)  # Give ESP32 time to process the stop command
-        ser.close()
-        session.close()
+        if lost is None:
+            try:
+                link.send(b'X')
+                time.sleep(0.5)  # Give ESP32 time to process the stop command
+            except (serial.SerialException, OSError) as e:
+                print(f"Could not send stop command: {e}")
+        link.close()
+        writer.flush()
+        link.finish_run(runs.INTERRUPTED)  # The stop was never confirmed
+        writer.close()
         print("Connections closed")
 
-def input_available():
-    """Check if input is available (implementation depends on your OS)"""
-    import sys
-    import select
-    
-    # For Windows
-    if sys.platform == 'win32':
-        import msvcrt
-        return msvcrt.kbhit()
-    
-    # For Unix-like systems
-    else:
-        rlist, _, _ = select.select([sys.stdin], [], [], 0)
-        return len(rlist) > 0
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
@@ -0,0 +1,693 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import serial
+from models import setup_database
+from ingest import make_row, write_batch, retain, ROW_KEYS
+from calibration import CalibrationEngine
+from storage import SqliteStorage
+from hub import DeviceLink
+import runs
+import metrics
+import profiler
+from pubsub import Broker, WEBSOCKET_PORT, use_unix_socket
+from serial_reader import (open_serial, find_esp32_ports, port_identity, device_identity,
+                           HEARTBEAT, PROBE_COMMAND, SILENCE_WINDOW, PROBE_GRACE)
+from protocol import FrameDecoder, BINARY_COMMAND, BINARY_ACK, DUMP_PREFIX, parse_fields, parse_message
+
+# Headless acquisition for unattended logging. One asyncio loop owns every
+# serial port (non-blocking, woken by add_reader on POSIX), reconnects with
+# exponential backoff and hands readings to a single database thread in
+# batches. Clients such as the GUI attach over a local control socket that
+# speaks one JSON object per line:
+#   {"command": "status"}                                  -> {"ok": true, "devices": {...}}
+#   {"command": "start", "count": 10, "interval_ms": 500, "lot": "A7"}
+#                                                          -> {"ok": true, "devices": [...]}
+#   {"command": "stop"} / {"command": "configure", ...}
+#   {"command": "subscribe", "topics": [...]}  -> {"ok": true}, then one event per line
+# Every command takes an optional "devices" list of device IDs. Events
+# (see pubsub.py) go through a Broker, which also serves them on its own
+# socket and as a WebSocket for dashboards and other consumers.
+
+CONTROL_SOCKET = 'moisture-daemon.sock'  # Unix socket, relative to the working directory
+CONTROL_HOST = '127.0.0.1'  # TCP fallback where Unix sockets are missing
+CONTROL_PORT = 8765
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 30.0
+SCAN_INTERVAL = 5.0
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 1.0
+COMMAND_TIMEOUT = 2.0
+
+
+class PendingRun:
+    """Run id of a run whose row the writer thread has not created yet"""
+
+    def __init__(self):
+        self.id = None  # Set on the writer thread; stays None if the insert failed
+
+
+def resolve_run(run_id):
+    """The stored id for a row's run_id (on the writer thread)"""
+    return run_id.id if isinstance(run_id, PendingRun) else run_id
+
+
+class BatchWriter:
+    """ReadingWriter counterpart for the event loop.
+
+    Rows are collected on the loop and written to `storage` by one
+    executor thread (SQLite allows a single writer anyway), either when
+    `batch_size` rows are pending or every `flush_interval` seconds.
+    """
+
+    def __init__(self, Session, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 storage=None):
+        self.Session = Session
+        self.calibration = CalibrationEngine(Session)
+        self.storage = storage or SqliteStorage(Session)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.failing = False  # The last write failed; retry on the timer only
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        metrics.QUEUE_DEPTH.track(lambda: len(self.pending), 'writer')
+        return self
+
+    def put(self, **row):
+        self.pending.append(make_row(**row))
+        if len(self.pending) >= self.batch_size and not self.failing:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    def put_many(self, rows):
+        self.pending.extend(make_row(**{k: row.get(k) for k in ROW_KEYS}) for row in rows)
+        asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        self.failing = not await self.run(self._write, rows)
+        if self.failing:
+            # Tried again, ahead of newer readings, with the next flush
+            self.pending[:0] = retain(rows)
+
+    async def run(self, function, *args):
+        """Run a blocking database call on the writer thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.pending:
+            metrics.ROWS_DROPPED.inc(amount=len(self.pending))
+        await self.run(self.storage.close)
+        self.executor.shutdown()
+        metrics.QUEUE_DEPTH.untrack('writer')
+
+    def _write(self, rows):
+        for row in rows:
+            row['run_id'] = resolve_run(row['run_id'])
+        return write_batch(self.storage, self.calibration, rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+class AsyncDeviceLink(DeviceLink):
+    """A DeviceLink driven by the event loop instead of a reader thread.
+
+    Parsing, filtering, run tracking and catch-up bookkeeping are
+    DeviceLink's; this class only replaces the transport and keeps the link
+    alive across disconnects.
+    """
+
+    def __init__(self, daemon, device_id, port, baudrate=115200, binary=True):
+        super().__init__(device_id, port, daemon.writer, baudrate, binary,
+                         on_message=daemon.on_message)
+        self.daemon = daemon
+        self.connected = False
+        self.items = None
+        self.decoder = None
+        self.error = None
+        self.task = None
+        self.connections = 0
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        metrics.QUEUE_DEPTH.track(lambda: self.items.qsize() if self.items else 0,
+                                  f"reader:{self.device_id}")
+        return self
+
+    async def run(self):
+        """Keep the device connected until cancelled, backing off after failures"""
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                self.connect()
+                await self.wait_alive()
+                delay = RECONNECT_MIN
+                await self.session()
+            except (serial.SerialException, OSError) as e:
+                if self.connected:
+                    print(f"[{self.device_id}] Disconnected: {e}")
+                    self.daemon.publish({'event': 'connection', 'device_id': self.device_id,
+                                         'connected': False})
+            finally:
+                self.disconnect()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def connect(self):
+        self.ser = open_serial(self.port, self.baudrate, timeout=0)
+        self.decoder = FrameDecoder()
+        self.items = asyncio.Queue()
+        self.error = None
+        self.closed = False
+        loop = asyncio.get_running_loop()
+        if use_unix_socket():
+            loop.add_reader(self.ser.fileno(), self._readable)
+        else:
+            # No add_reader for serial ports on Windows; poll from a thread
+            self.ser.timeout = 0.1
+            loop.create_task(self._poll())
+        self.connected = True
+        self.connections += 1
+        if self.connections > 1:
+            metrics.RECONNECTS.inc(self.device_id)
+        print(f"[{self.device_id}] Connected on {self.port}")
+        self.daemon.publish({'event': 'connection', 'device_id': self.device_id, 'connected': True})
+
+    def disconnect(self):
+        was_open = self.ser is not None
+        self.connected = False
+        self.closed = True
+        if was_open and use_unix_socket():
+            try:
+                asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            except (ValueError, OSError):
+                pass
+        try:
+            if self.ser and self.ser.is_open:
+                self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.ser = None
+
+    def send(self, command):
+        if not self.ser:
+            raise serial.SerialException("Device not connected")
+        self.ser.write(command)
+
+    def _receive(self, data):
+        metrics.BYTES_READ.inc(self.device_id, len(data))
+        for item in self.decoder.feed(data):
+            if item != HEARTBEAT:
+                metrics.LINES_READ.inc(self.device_id)
+            self.items.put_nowait(item)
+
+    def _fail(self, error):
+        self.error = error
+        self.items.put_nowait(None)
+
+    def _readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            self._fail(e)
+            return
+        self._receive(data)
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        ser = self.ser
+        while ser is self.ser and not self.closed:
+            try:
+                data = await loop.run_in_executor(None, ser.read, 4096)
+            except (serial.SerialException, OSError) as e:
+                self._fail(e)
+                return
+            if data:
+                self._receive(data)
+
+    async def next_item(self, timeout=None):
+        """Next item from the device; probes a silent device and fails if it stays silent"""
+        try:
+            item = await asyncio.wait_for(self.items.get(), timeout or SILENCE_WINDOW)
+        except asyncio.TimeoutError:
+            self.send(PROBE_COMMAND)
+            try:
+                item = await asyncio.wait_for(self.items.get(), PROBE_GRACE)
+            except asyncio.TimeoutError:
+                raise serial.SerialException("Heartbeat lost")
+        if item is None:
+            raise serial.SerialException(str(self.error or "Port closed"))
+        return item
+
+    async def wait_for(self, accept, timeout):
+        """First text line for which accept() is true, or None after `timeout` seconds"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                item = await asyncio.wait_for(self.items.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if item is None:
+                raise serial.SerialException(str(self.error or "Port closed"))
+            if isinstance(item, bytes) and accept(item):
+                return item
+
+    async def catch_up(self, timeout=2.0):
+        """protocol.catch_up() on the event loop"""
+        self.send(b'D%d\n' % (self.last_seq() or 0))
+        items = []
+        while True:
+            try:
+                item = await asyncio.wait_for(self.items.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if item is None:
+                raise serial.SerialException(str(self.error or "Port closed"))
+            if isinstance(item, bytes) and item.startswith(DUMP_PREFIX):
+                try:
+                    info = {k: int(v) for k, v in parse_fields(item).items()}
+                except ValueError:
+                    info = {}
+                return items, info
+            data = parse_message(item)
+            if data and data.get('stored'):
+                items.append((datetime.now(), item))
+
+    async def wait_alive(self):
+        """Wait for any traffic (heartbeats included) before talking to the device"""
+        item = await self.next_item()
+        if item != HEARTBEAT and self.run_started is None:
+            self.handle(item)  # While resuming, the dump replays it anyway
+
+    async def session(self):
+        if self.binary:
+            self.send(BINARY_COMMAND)
+            self.binary_mode = await self.wait_for(lambda line: line == BINARY_ACK, 1.0) is not None
+        if self.run_started is not None:
+            self.apply_catch_up(await self.catch_up())
+        else:
+            self.send(b'Q')  # The "Config:" answer is handled like any other line
+        while True:
+            item = await self.next_item()
+            if item != HEARTBEAT:
+                self.handle(item)
+
+    def handle(self, item):
+        loop = self.loop_count
+        data = super().handle(item)
+        if self.loop_count != loop:
+            self.daemon.publish({'event': 'progress', 'device_id': self.device_id,
+                                 'loop': self.loop_count,
+                                 'total': self.config[0] if self.config else None})
+        return data
+
+    def _reading(self, data, timestamp):
+        row = super()._reading(data, timestamp)
+        if row:
+            self.daemon.publish({
+                'event': 'reading', 'device_id': self.device_id,
+                'timestamp': timestamp.isoformat(),
+                'moisture_percent': row['moisture_percent'],
+                'moisture_smoothed': self.filter.channels['moisture_percent'].ema.value,
+                'temperature': row['temperature'], 'humidity': row['humidity'],
+                'loop': self.loop_count
+            })
+        return row
+
+    def begin_run(self):
+        """Create the run's row on the writer thread without waiting for it.
+
+        Readings carry a PendingRun until then; the writer thread runs the
+        insert before any later batch and swaps in the id when it writes
+        them.
+        """
+        count, interval_ms = self.config or (None, None)
+        run = self.run_id = PendingRun()
+        started, grain_lot = self.run_started, self.grain_lot
+
+        def start():
+            run.id = runs.open_run(self.writer.Session, self.device_id, started, grain_lot,
+                                   count, interval_ms)
+        self.writer.executor.submit(start)
+
+    def finish_run(self, status=runs.COMPLETE):
+        """Store the run result on the writer thread, after its readings"""
+        if self.run_started is None:
+            return
+        started, self.run_started = self.run_started, None
+        run_id, self.run_id = self.run_id, None
+        result = self.filter.result()
+        finished = datetime.now()
+
+        async def record():
+            await self.writer.flush()
+            await self.writer.run(lambda: runs.close_run(
+                self.writer.Session, self.device_id, started, result, status,
+                resolve_run(run_id), finished))
+
+        task = asyncio.get_running_loop().create_task(record())
+        self.daemon.recording.add(task)
+        task.add_done_callback(self.daemon.recording.discard)
+        summary = runs.describe(result)
+        print(f"[{self.device_id}] Run result: {summary}")
+        # After the status line that ended the run has been published
+        asyncio.get_running_loop().call_soon(self.daemon.publish, {
+            'event': 'run', 'device_id': self.device_id, 'loop': self.loop_count, 'summary': summary
+        })
+
+
+class AcquisitionDaemon:
+    """Owns the devices, the writer and the control socket"""
+
+    def __init__(self, Session, ports=None, binary=True, baudrate=115200,
+                 address=None, scan_interval=SCAN_INTERVAL, pubsub_address=None,
+                 websocket_port=WEBSOCKET_PORT):
+        self.Session = Session
+        self.ports = ports or []
+        self.binary = binary
+        self.baudrate = baudrate
+        self.address = address
+        self.scan_interval = scan_interval
+        self.writer = None
+        self.links = {}
+        self.clients = {}  # Handler task -> stream writer
+        self.recording = set()  # Run results being written
+        self.broker = Broker()
+        self.pubsub_address = pubsub_address
+        self.websocket_port = websocket_port
+        self.server = None
+        self.stopping = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+
+        self.writer = BatchWriter(self.Session).start()
+        for port in self.ports:
+            self.add_device(port)
+        scanner = loop.create_task(self.scan()) if not self.ports else None
+        await self.serve()
+        await self.broker.serve(self.pubsub_address, self.websocket_port)
+        print(f"Acquisition daemon listening on {self.describe_address()}")
+
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.shutdown(scanner)
+
+    def add_device(self, port, device_id=None):
+        device_id = device_id or device_identity(port)
+        if device_id not in self.links:
+            # Runs a previous session left open; queued ahead of this link's writes
+            self.writer.executor.submit(runs.sweep, self.Session, device_id)
+        link = AsyncDeviceLink(self, device_id, port, self.baudrate, self.binary).start()
+        self.links[device_id] = link
+        return link
+
+    async def scan(self):
+        """Pick up boards that are plugged in later; known ones reconnect themselves"""
+        while True:
+            known = {link.port for link in self.links.values()}
+            for info in find_esp32_ports():
+                if info.device not in known:
+                    self.add_device(info.device, port_identity(info))
+            await asyncio.sleep(self.scan_interval)
+
+    async def shutdown(self, scanner=None):
+        print("Shutting down")
+        if scanner:
+            scanner.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for link in self.links.values():
+            if link.connected:
+                try:
+                    link.send(b'X')
+                except (serial.SerialException, OSError):
+                    pass
+        await asyncio.sleep(0.5)  # Let the devices confirm the stop
+        for link in self.links.values():
+            link.task.cancel()
+            link.disconnect()
+            link.finish_run(runs.INTERRUPTED)  # Runs that were not confirmed as stopped
+        await asyncio.gather(*self.recording, return_exceptions=True)
+        for writer in self.clients.values():
+            writer.transport.abort()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        await self.broker.close()
+        await self.writer.close()
+        if use_unix_socket() and os.path.exists(self.address or CONTROL_SOCKET):
+            os.remove(self.address or CONTROL_SOCKET)
+
+    def describe_address(self):
+        if use_unix_socket():
+            return self.address or CONTROL_SOCKET
+        return f"{CONTROL_HOST}:{self.address or CONTROL_PORT}"
+
+    async def serve(self):
+        if use_unix_socket():
+            path = self.address or CONTROL_SOCKET
+            if os.path.exists(path):
+                os.remove(path)  # Left over from a daemon that was killed
+            self.server = await asyncio.start_unix_server(self.handle_client, path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, CONTROL_HOST,
+                                                     int(self.address or CONTROL_PORT))
+
+    def select(self, devices):
+        if devices is None:
+            return list(self.links.values())
+        return [self.links[d] for d in devices if d in self.links]
+
+    def send(self, command, devices=None):
+        sent = []
+        for link in self.select(devices):
+            try:
+                link.send(command)
+                sent.append(link.device_id)
+            except (serial.SerialException, OSError) as e:
+                print(f"[{link.device_id}] Send failed: {e}")
+        return sent
+
+    def configure(self, count=None, interval_ms=None, devices=None):
+        sent = []
+        if count is not None:
+            sent = self.send(b'N%d\n' % count, devices)
+        if interval_ms is not None:
+            sent = self.send(b'I%d\n' % interval_ms, devices)
+        return sent
+
+    def status(self):
+        return {
+            d: {'port': link.port, 'connected': link.connected,
+                'collecting': link.is_collecting, 'loop': link.loop_count,
+                'binary': link.binary_mode, 'config': link.config}
+            for d, link in self.links.items()
+        }
+
+    def execute(self, request):
+        """Reply to one control request"""
+        command = request.get('command')
+        devices = request.get('devices')
+        if command == 'status':
+            return {'ok': True, 'devices': self.status(), 'pubsub': self.broker.stats()}
+        if command == 'configure':
+            return {'ok': True, 'devices': self.configure(request.get('count'),
+                                                          request.get('interval_ms'), devices)}
+        if command == 'start':
+            self.configure(request.get('count'), request.get('interval_ms'), devices)
+            for link in self.select(devices):
+                link.grain_lot = request.get('lot')
+            return {'ok': True, 'devices': self.send(b'S', devices)}
+        if command == 'stop':
+            return {'ok': True, 'devices': self.send(b'X', devices)}
+        return {'ok': False, 'error': f"Unknown command: {command}"}
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    reply = {'ok': False, 'error': "Invalid JSON"}
+                else:
+                    if request.get('command') == 'subscribe':
+                        # The connection becomes a pub/sub subscriber
+                        writer.write(b'{"ok": true}\n')
+                        await self.broker.follow(reader, writer,
+                                                 self.broker.add(self.stream_sender(writer),
+                                                                 request.get('topics')))
+                        break
+                    reply = self.execute(request)
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.clients.pop(task, None)
+            writer.close()
+
+    @staticmethod
+    def stream_sender(writer):
+        async def send(message):
+            writer.write(message.encode() + b'\n')
+            await writer.drain()
+        return send
+
+    def on_message(self, device_id, data):
+        """Called by the links for every parsed message"""
+        if 'status' in data and data['status'] != HEARTBEAT.decode():
+            self.publish({'event': 'status', 'device_id': device_id, 'status': data['status'],
+                          'loop': self.links[device_id].loop_count,
+                          'config': self.links[device_id].config})
+
+    def publish(self, event):
+        self.broker.publish(event)
+
+
+class DaemonClient:
+    """Blocking client for the control socket, used by the GUI.
+
+    `request()` sends one command and returns the reply dict. `subscribe()`
+    opens a second connection and calls `on_event(event)` for every event
+    on a background thread until `close()`.
+    """
+
+    def __init__(self, address=None):
+        self.address = address
+        self.sock = None
+        self.file = None
+        self.events = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if use_unix_socket():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(COMMAND_TIMEOUT)
+            sock.connect(self.address or CONTROL_SOCKET)
+        else:
+            sock = socket.create_connection((CONTROL_HOST, int(self.address or CONTROL_PORT)),
+                                            COMMAND_TIMEOUT)
+        return sock
+
+    @classmethod
+    def attach(cls, address=None):
+        """A connected client, or None if no daemon is running"""
+        client = cls(address)
+        try:
+            client.sock = client._connect()
+        except OSError:
+            return None
+        client.file = client.sock.makefile('rwb')
+        return client
+
+    def request(self, command, **arguments):
+        with self.lock:
+            self.file.write(json.dumps(dict(arguments, command=command)).encode() + b'\n')
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            raise ConnectionError("Daemon closed the connection")
+        return json.loads(line)
+
+    def subscribe(self, on_event):
+        sock = self._connect()
+        sock.settimeout(None)
+        self.events = sock
+        stream = sock.makefile('rwb')
+        stream.write(b'{"command": "subscribe"}\n')
+        stream.flush()
+        stream.readline()  # {"ok": true}
+
+        def listen():
+            try:
+                for line in stream:
+                    on_event(json.loads(line))
+            except (OSError, ValueError):
+                pass
+            on_event({'event': 'closed'})
+
+        thread = threading.Thread(target=listen)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        for sock in (self.events, self.sock):
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless moisture acquisition daemon")
+    parser.add_argument("--port", action="append", dest="ports",
+                        help="Serial port to use (repeatable); scans for boards if omitted")
+    parser.add_argument("--db", default="sqlite:///moistureDB.db")
+    parser.add_argument("--socket", help="Control socket path (TCP port on Windows)")
+    parser.add_argument("--pubsub-socket", help="Event socket path (TCP port on Windows)")
+    parser.add_argument("--websocket-port", type=int, default=WEBSOCKET_PORT,
+                        help="Localhost WebSocket port for events (0 disables it)")
+    parser.add_argument("--text", action="store_true", help="Do not ask for binary frames")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT,
+                        help="Localhost port for Prometheus metrics (0 disables it)")
+    parser.add_argument("--profiling", action="store_true",
+                        help="Serve /profile and toggle sampling with SIGUSR1")
+    args = parser.parse_args()
+
+    profiling = args.profiling or profiler.enabled()
+    if args.metrics_port:
+        try:
+            metrics.serve(args.metrics_port, profiling=profiling)
+        except OSError as e:
+            print(f"Metrics endpoint disabled: {e}")
+    if profiling:
+        profiler.install_signal_toggle()
+
+    engine, Session = setup_database(args.db)
+    daemon = AcquisitionDaemon(Session, args.ports, binary=not args.text, address=args.socket,
+                               pubsub_address=args.pubsub_socket,
+                               websocket_port=args.websocket_port or None)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import numpy as np
+from sqlalchemy import select, func
+from models import MoistureContent
+import queries
+
+# Downsampling for long-history plots. Every method returns at most
+# `points` samples, so graphs and reports cost the same to render whether
+# the range holds a hundred readings or several million.
+
+METHODS = ('lttb', 'minmax', 'mean')
+RAW_FETCH_FACTOR = 20  # Above points * factor rows, pre-aggregate in SQL first
+PREAGGREGATE_FACTOR = 4  # SQL buckets per output point before LTTB
+
+
+def lttb(x, y, points):
+    """Largest-Triangle-Three-Buckets downsampling of sorted (x, y).
+
+    Keeps the first and last sample and, from each of `points - 2` buckets,
+    the sample forming the largest triangle with the previously kept sample
+    and the mean of the next bucket. One Python iteration per output point,
+    the work inside each bucket is vectorised.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    size = len(x)
+    if points >= size or points < 3:
+        return x, y
+
+    edges = np.linspace(1, size - 1, points - 1).astype(int)
+    keep = np.empty(points, dtype=int)
+    keep[0] = 0
+    keep[-1] = size - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else size
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+def minmax(x, y, points):
+    """Keep the minimum and maximum sample of each of `points // 2` buckets"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    size = len(x)
+    buckets = max(points // 2, 1)
+    if size <= points:
+        return x, y
+
+    # Pad to a rectangle so every bucket reduces in one vectorised call
+    width = -(-size // buckets)
+    padded = np.full(buckets * width, np.nan)
+    padded[:size] = y
+    grid = padded.reshape(buckets, width)
+    valid = ~np.all(np.isnan(grid), axis=1)
+    rows = np.arange(buckets)[valid]
+    lows = rows * width + np.nanargmin(grid[valid], axis=1)
+    highs = rows * width + np.nanargmax(grid[valid], axis=1)
+    keep = np.unique(np.concatenate([lows, highs]))
+    return x[keep], y[keep]
+
+
+def _julian_to_datetime64(days):
+    """SQLite julianday values to numpy datetime64 (naive, as stored)"""
+    ms = np.round((np.asarray(days, dtype=float) - 2440587.5) * 86400000.0)
+    return ms.astype('int64').astype('datetime64[ms]')
+
+
+def _datetime_to_julian(times):
+    ms = np.asarray(times, dtype='datetime64[ms]').astype('int64')
+    return ms / 86400000.0 + 2440587.5
+
+
+def series(session, start=None, end=None, points=1000, device_id=None, method='lttb'):
+    """Moisture series for a time range reduced to at most `points` samples.
+
+    'mean' and 'minmax' are bucketed entirely in SQL. 'lttb' reads raw rows
+    for small ranges; for large ones SQL first reduces the range to
+    min/max buckets and LTTB picks the final points from those.
+    Returns (times as datetime64[ms] array, moisture array).
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown downsampling method: {method}")
+
+    if method == 'mean':
+        buckets = queries.downsampled(session, start, end, points, device_id)
+        return (np.array([b.time for b in buckets], dtype='datetime64[ms]'),
+                np.array([b.moisture_avg for b in buckets], dtype=float))
+
+    if method == 'minmax':
+        buckets = queries.downsampled(session, start, end, max(points // 2, 1), device_id)
+        return _bucket_extremes(buckets)
+
+    times, values, _ = lttb_series(session, start, end, points, device_id)
+    return times, values
+
+
+def lttb_series(session, start=None, end=None, points=1000, device_id=None):
+    """series() with method 'lttb', plus whether it was reduced from raw rows.
+
+    Only then is the last point the newest reading in the range; from SQL
+    buckets it is a bucket time. Returns (times, moisture, raw).
+    """
+    total = queries.count(session, start, end, device_id)
+    raw = total <= points * RAW_FETCH_FACTOR
+    if raw:
+        stmt = queries.filter_range(
+            select(func.julianday(MoistureContent.date_created), MoistureContent.moisture_percent),
+            start, end, device_id
+        ).where(MoistureContent.moisture_percent.isnot(None)).order_by(MoistureContent.date_created)
+        rows = session.execute(stmt).all()
+        x = np.array([r[0] for r in rows], dtype=float)
+        y = np.array([r[1] for r in rows], dtype=float)
+    else:
+        buckets = queries.downsampled(session, start, end, points * PREAGGREGATE_FACTOR, device_id)
+        times, y = _bucket_extremes(buckets)
+        x = _datetime_to_julian(times)
+
+    finite = np.isfinite(y)
+    x, y = lttb(x[finite], y[finite], points)
+    return _julian_to_datetime64(x), y, raw
+
+
+def _bucket_extremes(buckets):
+    """Two samples per SQL bucket (min then max) placed at the bucket time"""
+    times = np.repeat(np.array([b.time for b in buckets], dtype='datetime64[ms]'), 2)
+    values = np.empty(len(times), dtype=float)
+    values[0::2] = [b.moisture_min for b in buckets]
+    values[1::2] = [b.moisture_max for b in buckets]
+    return times, values
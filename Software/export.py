@@ -0,0 +1,234 @@
+import argparse
+import csv
+import gzip
+import os
+import threading
+from datetime import datetime
+from sqlalchemy import select, func
+from models import MoistureContent, setup_database
+import queries
+import archive
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Parquet/Arrow export is optional
+    pa = None
+
+# What users get; archive files (retention.py) add the raw counts, device
+# sequence number and run to the same leading columns
+EXPORT_COLUMNS = archive.COLUMNS[:6]
+HEADER = [c.key for c in EXPORT_COLUMNS]
+FORMATS = ('csv', 'parquet', 'arrow')
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def format_for_path(path):
+    """Pick the export format from a file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        return 'parquet'
+    if ext in ('.arrow', '.feather', '.ipc'):
+        return 'arrow'
+    return 'csv'
+
+
+def iter_chunks(engine, start=None, end=None, device_id=None, chunk_size=5000,
+                include_archive=True, columns=EXPORT_COLUMNS):
+    """Yield lists of rows in date order without loading the whole table.
+
+    Rows come from a plain Core select with a server-side cursor, so no ORM
+    objects are built and at most `chunk_size` rows are held at once.
+    Rows that were moved to archive files are read from those files and
+    merged with the ones still in the table. `columns` must be a leading
+    part of archive.COLUMNS.
+    """
+    covered = []
+    if include_archive:
+        with engine.connect() as conn:
+            covered = archive.parts(conn, start, end)
+    live = _live_chunks(engine, start, end, device_id, chunk_size, covered, columns)
+    if not covered:
+        yield from live
+        return
+    width = len(columns)
+    for chunk in archive.merged(covered, live, start, end, device_id, chunk_size):
+        yield [row[:width] for row in chunk]
+
+
+def _live_chunks(engine, start, end, device_id, chunk_size, covered, columns):
+    stmt = queries.filter_range(select(*columns), start, end, device_id)
+    stmt = stmt.where(*archive.not_archived(covered)).order_by(MoistureContent.date_created)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+        for partition in result.partitions(chunk_size):
+            yield partition
+
+
+def _write_csv(path, header, chunks, on_chunk):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for rows in chunks:
+            writer.writerows(rows)
+            on_chunk(len(rows))
+
+
+def _arrow_schema(header):
+    types = {
+        'id': pa.int64(),
+        'moisture_percent': pa.float64(),
+        'temperature': pa.float64(),
+        'humidity': pa.float64(),
+        'timestamp': pa.timestamp('us'),
+        'device_id': pa.string(),
+        'raw_counts': pa.int64(),
+        'seq': pa.int64(),
+        'run_id': pa.int64()
+    }
+    return pa.schema([(name, types[name]) for name in header])
+
+
+def _write_arrow(path, fmt, header, chunks, on_chunk):
+    if pa is None:
+        raise RuntimeError("pyarrow is required for Parquet/Arrow export")
+    schema = _arrow_schema(header)
+    if fmt == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            batch = pa.record_batch(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                schema=schema
+            )
+            if fmt == 'parquet':
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+            on_chunk(len(rows))
+    finally:
+        writer.close()
+
+
+def export(engine, path, fmt=None, start=None, end=None, device_id=None,
+           chunk_size=5000, progress=None, cancel=None, include_archive=True,
+           columns=EXPORT_COLUMNS):
+    """Stream readings to `path` as CSV (gzipped for .gz), Parquet or Arrow IPC.
+
+    `progress(done, total)` is called after each chunk, and setting the
+    `cancel` event stops the export and removes the partial file. Returns
+    the number of rows written. With archived rows in range, `total` is an
+    upper bound: whole archive files are counted. `columns` is as for
+    iter_chunks().
+    """
+    fmt = fmt or format_for_path(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    with engine.connect() as conn:
+        covered = archive.parts(conn, start, end) if include_archive else []
+        total = sum(part.rows for part in covered)
+        total += conn.execute(
+            queries.filter_range(select(func.count()).select_from(MoistureContent),
+                                 start, end, device_id)
+            .where(*archive.not_archived(covered))
+        ).scalar()
+    done = 0
+
+    def on_chunk(n):
+        nonlocal done
+        done += n
+        if progress:
+            progress(done, total)
+        if cancel is not None and cancel.is_set():
+            raise ExportCancelled()
+
+    chunks = iter_chunks(engine, start, end, device_id, chunk_size, include_archive, columns)
+    header = [c.key for c in columns]
+    try:
+        if fmt == 'csv':
+            _write_csv(path, header, chunks, on_chunk)
+        else:
+            _write_arrow(path, fmt, header, chunks, on_chunk)
+    except BaseException:
+        chunks.close()
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return done
+
+
+class ExportJob:
+    """Runs an export on a background thread.
+
+    `on_done(job)` is called from the worker thread when it finishes; check
+    `state` ('done', 'cancelled' or 'failed'), `rows` and `error`.
+    """
+
+    def __init__(self, engine, path, fmt=None, start=None, end=None, device_id=None,
+                 progress=None, on_done=None):
+        self.engine = engine
+        self.path = path
+        self.fmt = fmt
+        self.start_time = start
+        self.end_time = end
+        self.device_id = device_id
+        self.progress = progress
+        self.on_done = on_done
+        self.cancel_event = threading.Event()
+        self.state = 'running'
+        self.rows = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _run(self):
+        try:
+            self.rows = export(
+                self.engine, self.path, self.fmt, self.start_time, self.end_time,
+                self.device_id, progress=self.progress, cancel=self.cancel_event
+            )
+            self.state = 'done'
+        except ExportCancelled:
+            self.state = 'cancelled'
+        except Exception as e:
+            self.error = e
+            self.state = 'failed'
+        if self.on_done:
+            self.on_done(self)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export moisture readings")
+    parser.add_argument("path", help="Output file (.csv, .parquet or .arrow)")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--device")
+    args = parser.parse_args()
+
+    engine, Session = setup_database()
+    rows = export(
+        engine, args.path, args.format, args.start, args.end, args.device,
+        progress=lambda done, total: print(f"\r{done}/{total} rows", end="")
+    )
+    print(f"\nExported {rows} rows to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import math
+import random
+import threading
+from collections import deque
+
+# Streaming signal conditioning between parsing and storage. Every stage
+# keeps a bounded amount of state, so a filter costs the same after ten
+# readings as after ten million, and one ReadingFilter per device lets
+# many devices run side by side.
+
+# Plausible ranges; anything outside (or NaN) is a failed sensor read
+RANGES = {
+    'moisture_percent': (0.0, 100.0),
+    'temperature': (-40.0, 85.0),
+    'humidity': (0.0, 100.0)
+}
+
+# Two-sided 95% Student t quantiles by degrees of freedom (1.96 beyond)
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+       2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+       2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+MEDIAN_CAPACITY = 2048  # Values kept per channel for the run median
+
+
+def t95(df):
+    return T95[df - 1] if df <= len(T95) else 1.96
+
+
+def in_range(name, value):
+    """Whether `value` is a plausible reading of channel `name` (not NaN)"""
+    low, high = RANGES[name]
+    return value is not None and value == value and low <= value <= high
+
+
+class Hampel:
+    """Causal Hampel outlier test over the last `window` valid samples.
+
+    A sample is an outlier when it is further than `threshold` scaled MADs
+    from the window median. `min_scale` keeps a perfectly flat signal from
+    rejecting every tiny change.
+    """
+
+    def __init__(self, window=7, threshold=3.0, min_scale=0.5):
+        self.window = deque(maxlen=window)
+        self.threshold = threshold
+        self.min_scale = min_scale
+
+    def is_outlier(self, value):
+        outlier = False
+        if len(self.window) >= 3:
+            ordered = sorted(self.window)
+            median = ordered[len(ordered) // 2]
+            mad = sorted(abs(v - median) for v in ordered)[len(ordered) // 2]
+            scale = max(1.4826 * mad, self.min_scale)
+            outlier = abs(value - median) > self.threshold * scale
+        # Outliers stay in the window so a genuine step change is accepted
+        # once it persists
+        self.window.append(value)
+        return outlier
+
+    def reset(self):
+        self.window.clear()
+
+
+class Ema:
+    """Exponential moving average"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value):
+        self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class Median:
+    """Median of a stream, exact up to `capacity` values.
+
+    Past that it is the median of a uniform reservoir sample of `capacity`
+    values, so long burst runs stay within bounded memory.
+    """
+
+    def __init__(self, capacity=MEDIAN_CAPACITY, seed=None):
+        self.capacity = capacity
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.values = []
+
+    def update(self, value):
+        self.n += 1
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+        else:
+            i = self.random.randrange(self.n)
+            if i < self.capacity:
+                self.values[i] = value
+
+    @property
+    def value(self):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class Welford:
+    """Running mean and variance (Welford's algorithm)"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+    @property
+    def ci95(self):
+        """Half-width of the 95% confidence interval of the mean"""
+        if self.n < 2:
+            return None
+        return t95(self.n - 1) * self.std / math.sqrt(self.n)
+
+
+class ChannelFilter:
+    """Range check -> Hampel -> (EMA, Welford, median) for one measurement"""
+
+    def __init__(self, low, high, window=7, threshold=3.0, min_scale=0.5, alpha=0.3):
+        self.low = low
+        self.high = high
+        self.hampel = Hampel(window, threshold, min_scale)
+        self.ema = Ema(alpha)
+        self.stats = Welford()
+        self.median = Median()
+        self.rejected = 0
+
+    def update(self, value):
+        """The value if accepted, otherwise None"""
+        if value is None or value != value or not self.low <= value <= self.high:
+            self.rejected += 1
+            return None
+        if self.hampel.is_outlier(value):
+            self.rejected += 1
+            return None
+        self.ema.update(value)
+        self.stats.update(value)
+        self.median.update(value)
+        return value
+
+    def reset(self):
+        self.hampel.reset()
+        self.ema.reset()
+        self.stats.reset()
+        self.median.reset()
+        self.rejected = 0
+
+    def result(self):
+        s = self.stats
+        return {
+            'n': s.n, 'rejected': self.rejected, 'median': self.median.value,
+            'mean': s.mean if s.n else None, 'std': s.std, 'ci95': s.ci95
+        }
+
+
+class ReadingFilter:
+    """Filters the readings of one device.
+
+    `process()` returns a copy of the reading with rejected temperature or
+    humidity set to None and 'moisture_smoothed' added, or None when the
+    moisture itself is rejected; temperature and humidity are only checked
+    (and counted) for readings whose moisture is kept. `result()` gives the
+    median, mean and spread of the values accepted since the last `reset()`
+    (normally the start of a run), i.e. of what survived the outlier test.
+    The median is the run's value; the mean and its 95% interval are what
+    runs are compared by.
+    """
+
+    def __init__(self, **options):
+        self.channels = {name: ChannelFilter(low, high, **options)
+                         for name, (low, high) in RANGES.items()}
+
+    def process(self, data):
+        filtered = dict(data)
+        moisture = self.channels['moisture_percent']
+        filtered['moisture_percent'] = moisture.update(data.get('moisture_percent'))
+        if filtered['moisture_percent'] is None:
+            # The reading is dropped, so it counts towards no channel's figures
+            return None
+        for name, channel in self.channels.items():
+            if channel is not moisture:
+                filtered[name] = channel.update(data.get(name))
+        filtered['moisture_smoothed'] = self.channels['moisture_percent'].ema.value
+        return filtered
+
+    def reset(self):
+        for channel in self.channels.values():
+            channel.reset()
+
+    def result(self):
+        return {name: channel.result() for name, channel in self.channels.items()}
+
+
+class FilterBank:
+    """One ReadingFilter per device, created on first use (thread-safe)"""
+
+    def __init__(self, **options):
+        self.options = options
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    def get(self, device_id):
+        with self.lock:
+            f = self.filters.get(device_id)
+            if f is None:
+                f = self.filters[device_id] = ReadingFilter(**self.options)
+            return f
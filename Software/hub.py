@@ -0,0 +1,305 @@
+import queue
+import threading
+import time
+import serial
+from models import setup_database
+from ingest import ReadingWriter
+from collector import Collector
+import runs
+import metrics
+from serial_reader import (SerialReader, find_esp32_ports, open_serial, port_identity,
+                           device_identity, PROBE_COMMAND)
+from protocol import negotiate_binary, catch_up
+
+LIVENESS_INTERVAL = 1.0  # Seconds between link checks, below serial_reader.PROBE_GRACE
+
+
+class DeviceLink(Collector):
+    """One connected sensor.
+
+    A single SerialReader thread per device hands items to
+    Collector.handle() as they arrive, so readings are filtered and queued
+    on the shared writer, tagged with `device_id`, and each finished run's
+    filtered result is stored. The run settings are queried when the link
+    opens. A link that replaces one lost mid-run (see `adopt()`) first
+    fetches what the device buffered in the meantime.
+    """
+
+    def __init__(self, device_id, port, writer, baudrate=115200, binary=True, on_message=None):
+        super().__init__(writer, device_id)
+        self.port = port
+        self.baudrate = baudrate
+        self.binary = binary
+        self.on_message = on_message
+        self.write_lock = threading.Lock()
+        self.ser = None
+        self.reader = None
+        self.binary_mode = False
+        self.closed = False
+
+    def open(self):
+        self.ser = open_serial(self.port, self.baudrate, timeout=0.5)
+        # Negotiate, query the settings and catch up on the queue first,
+        # then switch to the callback
+        self.reader = SerialReader(self.ser, device=self.device_id).start()
+        if self.binary:
+            self.binary_mode = negotiate_binary(self.reader, self.send)
+        if self.run_started is None:
+            self.configure(self.reader, self.send)
+        else:
+            self.catch_up()
+        self.reader.on_item = self.handle
+        while True:
+            try:
+                item = self.reader.lines.get_nowait()
+            except queue.Empty:
+                break
+            self.handle(item)
+        return self
+
+    def catch_up(self):
+        """Store the readings the device buffered while the link was down"""
+        self.apply_catch_up(catch_up(self.reader, self.send, self.last_seq() or 0))
+
+    def send(self, command):
+        with self.write_lock:
+            self.ser.write(command)
+
+    def is_alive(self):
+        """Check liveness, probing a device that has gone quiet"""
+        if self.closed or self.reader is None:
+            return False
+        state = self.reader.liveness()
+        if state == 'probe':
+            try:
+                self.send(PROBE_COMMAND)
+            except (serial.SerialException, OSError):
+                return False
+        return state != 'dead'
+
+    def close(self):
+        self.closed = True
+        if self.reader:
+            self.reader.stop()
+        try:
+            if self.ser and self.ser.is_open:
+                self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def handle(self, item):
+        if item is None:
+            print(f"[{self.device_id}] Serial error: {self.reader.error}")
+            self.closed = True
+            self.is_collecting = False
+            return None
+
+        data = super().handle(item)
+        if data and self.on_message:
+            self.on_message(self.device_id, data)
+        return data
+
+
+class AcquisitionHub:
+    """Drives many sensors from one process through one batched writer.
+
+    Devices are found with `discover()` (or added explicitly with
+    `add_device()`), and commands fan out to every device or to a chosen
+    subset of device IDs.
+    """
+
+    def __init__(self, writer, baudrate=115200, binary=True, on_message=None):
+        self.writer = writer
+        self.baudrate = baudrate
+        self.binary = binary
+        self.on_message = on_message
+        self.links = {}
+        self.interrupted = {}  # Links lost mid-run, by device ID
+        self.seen = set()  # Device IDs connected before, for the reconnect count
+        self.lock = threading.Lock()
+        self.stop_scanning = threading.Event()
+        self.scan_thread = None
+
+    @property
+    def devices(self):
+        with self.lock:
+            return sorted(self.links)
+
+    def add_device(self, port, device_id=None):
+        device_id = device_id or device_identity(port)
+        link = DeviceLink(device_id, port, self.writer, self.baudrate,
+                          self.binary, self.on_message)
+        with self.lock:
+            previous = self.interrupted.pop(device_id, None)
+        if previous:
+            link.adopt(previous)
+        elif device_id not in self.seen:
+            runs.sweep(self.writer.Session, device_id)  # Runs a previous session left open
+        link.open()
+        with self.lock:
+            self.links[device_id] = link
+            if device_id in self.seen:
+                metrics.RECONNECTS.inc(device_id)
+            self.seen.add(device_id)
+        print(f"Connected {device_id} on {port}")
+        return link
+
+    def discover(self):
+        """Connect every matching port that is not connected yet"""
+        with self.lock:
+            known = {link.port for link in self.links.values()}
+        added = []
+        for info in find_esp32_ports():
+            if info.device in known:
+                continue
+            try:
+                added.append(self.add_device(info.device, port_identity(info)))
+            except (serial.SerialException, OSError) as e:
+                print(f"Could not open {info.device}: {e}")
+        return added
+
+    def prune(self):
+        """Close and forget devices whose link has failed"""
+        with self.lock:
+            dead = [d for d, link in self.links.items() if not link.is_alive()]
+            links = [self.links.pop(d) for d in dead]
+            for link in links:
+                if link.run_started is not None:
+                    # Picked up again by add_device() when it comes back
+                    self.interrupted[link.device_id] = link
+        for link in links:
+            link.close()
+            print(f"Disconnected {link.device_id}")
+        return dead
+
+    def start_scanning(self, interval=5.0):
+        """Rescan ports in the background so hot-plugged devices are picked up.
+
+        Links are checked every LIVENESS_INTERVAL, well inside the probe
+        grace period, so a quiet device is probed before it is given up.
+        """
+        def scan():
+            next_scan = time.monotonic() + interval
+            while not self.stop_scanning.wait(LIVENESS_INTERVAL):
+                self.prune()
+                if time.monotonic() >= next_scan:
+                    self.discover()
+                    next_scan = time.monotonic() + interval
+
+        self.scan_thread = threading.Thread(target=scan)
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+
+    def _select(self, devices):
+        with self.lock:
+            if devices is None:
+                return list(self.links.values())
+            return [self.links[d] for d in devices if d in self.links]
+
+    def send(self, command, devices=None):
+        """Send a command to all devices, or only to the given device IDs"""
+        sent = []
+        for link in self._select(devices):
+            try:
+                link.send(command)
+                sent.append(link.device_id)
+            except (serial.SerialException, OSError) as e:
+                print(f"[{link.device_id}] Send failed: {e}")
+        return sent
+
+    def start(self, devices=None, grain_lot=None):
+        """Start a run; `grain_lot` labels the stored runs"""
+        for link in self._select(devices):
+            link.grain_lot = grain_lot
+        return self.send(b'S', devices)
+
+    def stop(self, devices=None):
+        return self.send(b'X', devices)
+
+    def configure(self, count=None, interval_ms=None, devices=None):
+        """Set readings per run (0 = burst) and/or the sample interval"""
+        sent = []
+        if count is not None:
+            sent = self.send(b'N%d\n' % count, devices)
+        if interval_ms is not None:
+            sent = self.send(b'I%d\n' % interval_ms, devices)
+        return sent
+
+    def status(self):
+        with self.lock:
+            return {
+                d: {'port': link.port, 'collecting': link.is_collecting,
+                    'loop': link.loop_count, 'binary': link.binary_mode,
+                    'config': link.config}
+                for d, link in self.links.items()
+            }
+
+    def close(self):
+        self.stop_scanning.set()
+        with self.lock:
+            links = list(self.links.values())
+            self.links.clear()
+        for link in links:
+            try:
+                link.send(b'X')
+            except (serial.SerialException, OSError):
+                pass
+        if links:
+            time.sleep(0.5)  # Give devices time to process the stop command
+        for link in links:
+            link.close()
+        self.writer.flush()
+
+
+def main():
+    engine, Session = setup_database()
+    writer = ReadingWriter(Session)
+    hub = AcquisitionHub(writer)
+    hub.discover()
+    hub.start_scanning()
+    grain_lot = None
+
+    print("\nCommands (optionally followed by device IDs):")
+    print("s [ids] - Start data collection")
+    print("x [ids] - Stop data collection")
+    print("n <count> [ids] - Readings per run (0 = burst until stopped)")
+    print("i <ms> [ids] - Interval between readings")
+    print("lot <name> - Grain lot recorded with the next runs ('lot -' to clear)")
+    print("l - List devices")
+    print("q - Quit program")
+
+    try:
+        while True:
+            parts = input().split()
+            if not parts:
+                continue
+            command, devices = parts[0].lower(), parts[1:] or None
+
+            if command == 's':
+                print(f"Started: {hub.start(devices, grain_lot)}")
+            elif command == 'lot' and devices:
+                grain_lot = None if devices[0] == '-' else devices[0]
+                print(f"Grain lot: {grain_lot or '-'}")
+            elif command == 'x':
+                print(f"Stopped: {hub.stop(devices)}")
+            elif command in ('n', 'i') and devices and devices[0].isdigit():
+                value, devices = int(devices[0]), devices[1:] or None
+                if command == 'n':
+                    print(f"Configured: {hub.configure(count=value, devices=devices)}")
+                else:
+                    print(f"Configured: {hub.configure(interval_ms=value, devices=devices)}")
+            elif command == 'l':
+                for device_id, state in hub.status().items():
+                    print(f"{device_id}: {state}")
+            elif command == 'q':
+                break
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        hub.close()
+        writer.close()
+        print("Connections closed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from metrics import COMMIT_LATENCY, ROWS_COMMITTED, QUEUE_DEPTH, WRITE_FAILURES, ROWS_DROPPED
+from calibration import CalibrationEngine
+from storage import SqliteStorage
+import log
+
+
+WRITE_RETRIES = 3  # Further attempts after a failed batch write
+RETRY_DELAY = 0.2  # Seconds before the first retry, doubled for each further one
+MAX_RETAINED = 100000  # Rows kept for the next flush while writes keep failing
+
+ROW_KEYS = ('moisture_percent', 'temperature', 'humidity', 'date_created', 'device_id',
+            'raw_counts', 'seq', 'run_id')
+
+
+def make_row(moisture_percent=None, temperature=None, humidity=None, date_created=None,
+             device_id=None, raw_counts=None, seq=None, run_id=None):
+    """Row dict as the batched writers insert it"""
+    return {
+        'moisture_percent': moisture_percent,
+        'temperature': temperature,
+        'humidity': humidity,
+        'date_created': date_created or datetime.now(),
+        'device_id': device_id,
+        'raw_counts': raw_counts,
+        'seq': seq,
+        'run_id': run_id
+    }
+
+
+def write_batch(storage, calibration, rows, retries=WRITE_RETRIES):
+    """Calibrate a batch of rows and write it to `storage` in one go.
+
+    A failed write (e.g. the database is locked) is rolled back and tried
+    again with backoff. Returns False if every attempt failed; the rows are
+    then the caller's to keep.
+    """
+    if not rows:
+        return True
+    for attempt in range(retries + 1):
+        try:
+            started = time.perf_counter()
+            calibration.apply(rows)
+            storage.write(rows)
+            COMMIT_LATENCY.observe(time.perf_counter() - started)
+            ROWS_COMMITTED.inc(amount=len(rows))
+            return True
+        except Exception as e:
+            storage.rollback()
+            WRITE_FAILURES.inc()
+            log.warning('write_failed', rows=len(rows), attempt=attempt + 1, error=str(e))
+            if attempt < retries:
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+    return False
+
+
+def retain(rows, limit=MAX_RETAINED):
+    """Rows of a failed batch to try again with the next one, oldest dropped past `limit`"""
+    if len(rows) > limit:
+        ROWS_DROPPED.inc(amount=len(rows) - limit)
+        log.error('rows_dropped', rows=len(rows) - limit)
+        rows = rows[-limit:]
+    return rows
+
+
+class ReadingWriter:
+    """Writer stage that batches parsed readings into bulk inserts.
+
+    Batches go to `storage` (storage.py), by default SQLite through one
+    long-lived session used only by the writer thread. Readings are kept
+    in a bounded queue and flushed when `batch_size` rows are pending, when
+    the oldest pending row is `flush_interval` seconds old, or when
+    `flush()` / `close()` is called. Readings with raw sensor counts that
+    arrive uncalibrated are calibrated per batch, and with SQLite each
+    batch also updates the rollup tables in the same transaction. A batch
+    that still fails after its retries is kept and written together with
+    the next one.
+    """
+
+    def __init__(self, Session, batch_size=200, flush_interval=1.0, max_pending=10000,
+                 calibration=None, storage=None):
+        self.Session = Session
+        self.calibration = calibration or CalibrationEngine(Session)
+        self.storage = storage or SqliteStorage(Session)
+        self.retained = []  # Rows of batches that could not be written yet
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        QUEUE_DEPTH.track(self.queue.qsize, 'writer')
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, moisture_percent, temperature, humidity, date_created=None, device_id=None,
+            raw_counts=None, seq=None, run_id=None):
+        """Queue one reading (blocks if the queue is full).
+
+        With `raw_counts` and no moisture_percent (None or NaN), it is
+        computed from the counts.
+        """
+        if self.closed:
+            raise RuntimeError("Writer is closed")
+        self.queue.put(make_row(moisture_percent, temperature, humidity, date_created,
+                                device_id, raw_counts, seq, run_id))
+
+    def put_many(self, rows):
+        """Queue a bulk batch (e.g. a ring buffer catch-up) written in one transaction.
+
+        Rows are dicts with the keys put() takes; missing ones default to
+        None and any others are ignored.
+        """
+        if self.closed:
+            raise RuntimeError("Writer is closed")
+        batch = [make_row(**{k: row.get(k) for k in ROW_KEYS}) for row in rows]
+        if batch:
+            self.queue.put(batch)
+
+    def flush(self, timeout=None):
+        """Block until every reading queued so far has been committed.
+
+        Returns False on a timeout, or if the write failed and the rows are
+        only retained for the next batch.
+        """
+        if not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        done.written = False
+        self.queue.put(done)
+        return done.wait(timeout) and done.written
+
+    def close(self, timeout=None):
+        """Flush pending readings and stop the writer thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+        QUEUE_DEPTH.untrack('writer')
+
+    def _run(self):
+        pending = []
+        deadline = None
+        try:
+            while True:
+                wait = None if not pending else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=wait)
+                except queue.Empty:
+                    # Time threshold reached
+                    self._write(pending)
+                    pending = []
+                    continue
+
+                if item is None:
+                    break
+
+                if isinstance(item, threading.Event):
+                    self._write(pending)
+                    pending = []
+                    item.written = not self.retained
+                    item.set()
+                    continue
+
+                if isinstance(item, list):
+                    # Bulk batches are written right away, after anything pending
+                    self._write(pending + item)
+                    pending = []
+                    continue
+
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.append(item)
+
+                if len(pending) >= self.batch_size:
+                    self._write(pending)
+                    pending = []
+        finally:
+            self._write(pending)
+            if self.retained:
+                ROWS_DROPPED.inc(amount=len(self.retained))
+                log.error('rows_dropped', rows=len(self.retained))
+            self.storage.close()
+
+    def _write(self, rows):
+        rows = self.retained + rows
+        self.retained = []
+        if not write_batch(self.storage, self.calibration, rows):
+            self.retained = retain(rows)
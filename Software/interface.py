@@ -1,56 +1,109 @@
 import tkinter as tk
-from tkinter import ttk, filedialog
+from tkinter import ttk, filedialog, messagebox
 import serial
 import threading
 import time
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import pandas as pd
 from models import MoistureContent, setup_database
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-import io
+from ingest import ReadingWriter
+from filters import FilterBank
+from collector import Collector
+import runs
+from daemon import DaemonClient
+from pubsub import Broker
+from uidispatch import UiDispatcher
+import plugins
+import log
+import metrics
+import profiler
+from statspanel import StatsPanel
+from serial_reader import SerialReader, PROBE_COMMAND, find_esp32_ports, open_serial, device_identity
+from protocol import negotiate_binary, run_timeout, catch_up, DEFAULT_SAMPLE_COUNT
 import queue
-from datetime import datetime
+from datetime import datetime, timedelta
 
-class MoistureMonitorApp:
-    def __init__(self, root):
+DEFAULT_PORT = 'COM3'  # Used when no USB serial board is found
+GRAPH_HISTORY = timedelta(days=7)  # Stored history shown when the graph opens
+GRAPH_POINTS = 1000  # History is downsampled to this many points
+PRELOAD_DELAY_MS = 500  # Graph/export/report modules load in the background after this
 
-        self.status_queue = queue.Queue()
+class MoistureMonitorApp:
+    def __init__(self, root, port=None, database=None):
+        """`port` skips the USB scan, `database` is a SQLAlchemy URL (both for testing)"""
         self.root = root
         self.root.title("Moisture Monitoring")
         self.root.geometry("800x600")
 
         # Serial setup
         self.ser = None
+        self.port = None
+        self.device_id = None  # serial_reader.device_identity() of the port
+        self.fixed_port = port
+        self.reader = None
         self.is_connected = False
         self.serial_lock = threading.Lock()
         self.stop_monitoring = False
+        self.has_connected = False  # For the reconnect count
         self.data_collection_active = False
-        self.loop_count = 0
-        self.total_loops = 5
+        self.total_loops = DEFAULT_SAMPLE_COUNT  # Of the daemon's runs, for the progress bar
+        self.stop_requested = None
+        self.use_binary = True  # Falls back to text if the firmware is older
+        self.binary_mode = False
 
         # Database setup
-        self.engine, self.Session = setup_database()
+        self.engine, self.Session = setup_database(database) if database else setup_database()
+        self.writer = ReadingWriter(self.Session)
+        self.filters = FilterBank()
+        self.collector = None  # collector.Collector of the current run
+        self.resume_pending = False  # A run was interrupted by a disconnect
         self.is_collecting = False
-
-        # GUI setup
+        self.export_job = None
+        self.live_chart = None
+        self.query_cache = None  # History queries kept between graph windows
+        self.stats_panel = None
+        self.reading_listeners = []  # Called with (timestamp, moisture_percent)
+        self.reports = None  # Created with the reports plugin on first PDF export
+
+        # GUI setup: widgets only change through the dispatcher, once per frame
         self.create_widgets()
-        self.process_status_updates()
+        self.progress_mode = None
+        self.ui = UiDispatcher(self.root)
+        self.ui.register('status', self.apply_status)
+        self.ui.register('progress', self.apply_progress)
+        self.ui.register('connected', self.apply_connection)
+        self.ui.register('reading', self.apply_reading)
+        self.ui.start()
+
+        # Optional features are imported once the window is on screen
+        self.root.after(PRELOAD_DELAY_MS, plugins.preload)
+
+        # A running acquisition daemon owns the devices; the GUI is then only its client
+        self.broker = None
+        self.metrics_server = None
+        self.daemon = DaemonClient.attach()
+        if self.daemon:
+            self.daemon.subscribe(self.on_daemon_event)
+            self.update_status("Attached to acquisition daemon", "green")
+            return
+
+        # Otherwise the GUI publishes live events itself (see pubsub.py)
+        try:
+            self.broker = Broker().start_thread()
+        except OSError as e:
+            print(f"Live event publishing disabled: {e}")
+
+        # Acquisition metrics for Prometheus; the Stats window reads them directly
+        try:
+            self.metrics_server = metrics.serve()
+        except OSError as e:
+            print(f"Metrics endpoint disabled: {e}")
+        if profiler.enabled():
+            profiler.install_signal_toggle()
 
         # Start monitor thread
         self.monitor_thread = threading.Thread(target=self.monitor_serial_connection)
         self.monitor_thread.daemon = True
         self.monitor_thread.start()
 
-    def process_status_updates(self):
-        while not self.status_queue.empty():
-            text, color = self.status_queue.get_nowait()
-            self.status_label.config(text=text, fg=color)
-        self.root.after(100, self.process_status_updates)
-
     def create_widgets(self):
 
         # Status Frame
@@ -64,6 +117,9 @@ class MoistureMonitorApp:
         )
         self.status_label.pack(expand=True)
 
+        self.reading_label = tk.Label(self.status_frame, text="", font=("Arial", 12))
+        self.reading_label.pack(expand=True)
+
         # Progress Bar
         self.progress = ttk.Progressbar(
             self.status_frame,
@@ -72,6 +128,35 @@ class MoistureMonitorApp:
             mode='determinate'
         )
 
+        # Run settings
+        self.settings_frame = tk.Frame(self.root)
+        self.settings_frame.pack(fill='x', padx=20)
+
+        self.samples_var = tk.StringVar(value=str(DEFAULT_SAMPLE_COUNT))
+        self.interval_var = tk.StringVar(value=str(DEFAULT_INTERVAL_MS))
+        self.burst_var = tk.BooleanVar(value=False)
+        self.lot_var = tk.StringVar(value="")
+
+        tk.Label(self.settings_frame, text="Samples").pack(side='left')
+        tk.Spinbox(
+            self.settings_frame, from_=1, to=10000, width=6,
+            textvariable=self.samples_var
+        ).pack(side='left', padx=5)
+        tk.Label(self.settings_frame, text="Interval (ms)").pack(side='left')
+        tk.Spinbox(
+            self.settings_frame, from_=10, to=600000, increment=100, width=8,
+            textvariable=self.interval_var
+        ).pack(side='left', padx=5)
+        tk.Checkbutton(
+            self.settings_frame, text="Burst (until stopped)",
+            variable=self.burst_var
+        ).pack(side='left', padx=5)
+        tk.Label(self.settings_frame, text="Grain lot").pack(side='left')
+        tk.Entry(
+            self.settings_frame, width=12,
+            textvariable=self.lot_var
+        ).pack(side='left', padx=5)
+
         # Buttons
         self.button_frame = tk.Frame(self.root)
         self.button_frame.pack(expand=True, fill='x', padx=20, pady=20)
@@ -83,6 +168,13 @@ class MoistureMonitorApp:
         )
         self.start_button.pack(side='left', expand=True, padx=10)
 
+        self.stop_button = tk.Button(
+            self.button_frame, 
+            text="Stop", 
+            command=self.stop_data_collection
+        )
+        self.stop_button.pack(side='left', expand=True, padx=10)
+
         self.graph_button = tk.Button(
             self.button_frame, 
             text="Graph", 
@@ -90,52 +182,99 @@ class MoistureMonitorApp:
         )
         self.graph_button.pack(side='left', expand=True, padx=10)
 
+        self.stats_button = tk.Button(
+            self.button_frame,
+            text="Stats",
+            command=self.show_stats
+        )
+        self.stats_button.pack(side='left', expand=True, padx=10)
+
         self.export_button = tk.Button(
             self.button_frame,
             text="Export PDF",
             command=self.export_to_pdf
         )
         self.export_button.pack(side='right', expand=True, padx=10)
+
+        self.export_data_button = tk.Button(
+            self.button_frame,
+            text="Export Data",
+            command=self.export_to_csv
+        )
+        self.export_data_button.pack(side='right', expand=True, padx=10)
+
+        # Only shown while an export is running
+        self.cancel_export_button = tk.Button(
+            self.button_frame,
+            text="Cancel Export",
+            command=self.cancel_export
+        )
         self.led = tk.Canvas(self.status_frame, width=30, height=30)
         self.led.pack(pady=10)
         self.led_indicator = self.led.create_oval(5, 5, 25, 25, fill="gray")
 
 
-    def export_to_csv(self):
-        """Export database contents to CSV file"""
-        try:
-            # Ask user for save location
-            file_path = filedialog.asksaveasfilename(
-                defaultextension='.csv',
-                filetypes=[("CSV files", "*.csv")],
-                title="Save CSV file"
-            )
-            
-            if file_path:
-                session = self.Session()
-                # Query all readings
-                readings = session.query(MoistureContent).all()
-                
-                # Create dataframe
-                data = {
-                    'id': [r.id for r in readings],
-                    'moisture_percent': [r.moisture_percent for r in readings],
-                    'temperature': [r.temperature for r in readings],
-                    'humidity': [r.humidity for r in readings],
-                    'timestamp': [r.date_created for r in readings]
-                }
-                df = pd.DataFrame(data)
-                
-                # Save to CSV
-                df.to_csv(file_path, index=False)
-                session.close()
-                
-                self.update_status("Data exported successfully", "green")
-        except Exception as e:
-            self.update_status(f"Export failed: {str(e)}", "red")
+    def export_to_csv(self, start=None, end=None, device_id=None):
+        """Export readings to CSV/Parquet/Arrow on a background thread"""
+        if self.export_job and self.export_job.state == 'running':
+            self.update_status("Export already running", "yellow")
+            return
+
+        # Ask user for save location
+        file_path = filedialog.asksaveasfilename(
+            defaultextension='.csv',
+            filetypes=[("CSV files", "*.csv"), ("Parquet files", "*.parquet"),
+                       ("Arrow IPC files", "*.arrow")],
+            title="Save data export"
+        )
+        if not file_path:
+            return
+
+        def progress(done, total):
+            percent = (done / total * 100) if total else 100
+            self.update_status(f"Exporting: {done}/{total} rows ({percent:.0f}%)", "blue")
+
+        def finished(job):
+            self.ui.call(self.cancel_export_button.pack_forget)
+            if job.state == 'done':
+                self.update_status(f"Exported {job.rows} rows successfully", "green")
+            elif job.state == 'cancelled':
+                self.update_status("Export cancelled", "orange")
+            else:
+                self.update_status(f"Export failed: {job.error}", "red")
+
+        export = plugins.load('export')
+        self.export_job = export.ExportJob(
+            self.engine, file_path, start=start, end=end, device_id=device_id,
+            progress=progress, on_done=finished
+        ).start()
+        self.cancel_export_button.pack(side='right', expand=True, padx=10)
+
+    def cancel_export(self):
+        if self.export_job:
+            self.export_job.cancel()
+
+    def read_run_settings(self):
+        """Sample count and interval from the settings widgets (0 = burst)"""
+        count = 0 if self.burst_var.get() else int(self.samples_var.get())
+        interval_ms = int(self.interval_var.get())
+        if count < 0 or interval_ms < 10:
+            raise ValueError("Out of range")
+        return count, interval_ms
+
+    def send_command(self, command):
+        """Write a command to the device"""
+        with self.serial_lock:
+            if not self.ser or not self.ser.is_open:
+                raise serial.SerialException("Device not connected")
+            self.ser.write(command)
 
     def start_data_collection(self):
         """Start data collection process"""
+        if self.daemon:
+            self.start_remote()
+            return
+
         if not self.is_connected:
             self.update_status("Cannot Start: Not Connected", "red")
             return
@@ -145,128 +284,272 @@ class MoistureMonitorApp:
             return
 
         try:
-            with self.serial_lock:
-                if not self.ser or not self.ser.is_open:
-                    raise serial.SerialException("Device not connected")
-                    
-                self.loop_count = 0
-                self.ser.write(b'S')
-                self.is_collecting = True
-                self.update_status("Data Collection: Started", "blue")
-                self.show_progress()
-                
-                # Start the data collection thread
-                self.data_collection_thread = threading.Thread(
-                    target=self.collect_data
-                )
-                self.data_collection_thread.daemon = True
-                self.data_collection_thread.start()
+            count, interval_ms = self.read_run_settings()
+        except ValueError:
+            self.update_status("Invalid sample count or interval", "red")
+            return
+
+        self.stop_requested = None
+        self.is_collecting = True
+        self.update_status("Data Collection: Starting", "blue")
+        self.show_progress(indeterminate=count == 0)
+
+        # Configuring and starting the device happens on the collection thread
+        grain_lot = self.lot_var.get().strip() or None
+        self.data_collection_thread = threading.Thread(
+            target=self.collect_data, args=(count, interval_ms, grain_lot)
+        )
+        self.data_collection_thread.daemon = True
+        self.data_collection_thread.start()
+
+    def stop_data_collection(self):
+        """Ask the device to stop the current run"""
+        if self.daemon:
+            self.daemon_request('stop')
+            return
+
+        if not self.is_collecting:
+            return
+        try:
+            self.send_command(b'X')
+            self.stop_requested = time.time()
+        except (serial.SerialException, OSError) as e:
+            print(f"Stop failed: {e}")
+            self.handle_disconnection()
+
+    def daemon_request(self, command, **arguments):
+        try:
+            reply = self.daemon.request(command, **arguments)
+        except (OSError, ValueError) as e:
+            self.update_status(f"Daemon request failed: {e}", "red")
+            return None
+        if not reply.get('ok'):
+            self.update_status(f"Daemon: {reply.get('error')}", "red")
+            return None
+        return reply
+
+    def start_remote(self):
+        """Start a run on every device of the daemon"""
+        try:
+            count, interval_ms = self.read_run_settings()
+        except ValueError:
+            self.update_status("Invalid sample count or interval", "red")
+            return
+        reply = self.daemon_request('start', count=count, interval_ms=interval_ms,
+                                    lot=self.lot_var.get().strip() or None)
+        if reply is None:
+            return
+        if not reply['devices']:
+            self.update_status("Daemon has no connected devices", "red")
+            return
+        self.total_loops = count
+        self.show_progress(indeterminate=count == 0)
+
+    def on_daemon_event(self, event):
+        """Events from the daemon's subscription (on the client thread)"""
+        kind = event['event']
+        if kind == 'reading':
+            self.publish_reading(datetime.fromisoformat(event['timestamp']), event)
+            if self.total_loops:
+                self.update_progress(min(event['loop'] / self.total_loops, 1.0) * 100)
+        elif kind == 'status':
+            self.update_status(f"{event['device_id']}: {event['status']}", "blue")
+        elif kind == 'run':
+            self.hide_progress()
+            self.update_status(f"{event['device_id']}: Run finished after {event['loop']} "
+                               f"readings, {event['summary']}", "green")
+        elif kind == 'connection':
+            self.ui.set('connected', event['connected'])
+            state = "Connected" if event['connected'] else "Disconnected"
+            self.update_status(f"{event['device_id']}: {state}",
+                               "green" if event['connected'] else "red")
+        elif kind == 'closed':
+            self.update_status("Acquisition daemon stopped", "red")
+
+    def collect_data(self, count=None, interval_ms=None, grain_lot=None):
+        """Thread to collect data from ESP32"""
+        try:
+            if not self.reader:
+                raise serial.SerialException("Device not connected")
+            self.reader.drain()  # Ignore lines from before this run
+
+            # Parsing, filtering and the run's row are the collector's; the
+            # run opens when the device confirms the start
+            collector = Collector(self.writer, self.device_id, self.filters.get(self.device_id),
+                                  on_reading=self.on_collected, on_finish=self.report_run)
+            collector.grain_lot = grain_lot
+            collector.configure(self.reader, self.send_command, count, interval_ms)
+            self.collector = collector
+            self.send_command(b'S')
+            self.update_status("Data Collection: Started", "blue")
 
         except (serial.SerialException, OSError) as e:
             print(f"Start failed: {e}")
+            self.is_collecting = False
             self.handle_disconnection()
             self.update_status("Start Failed: Disconnected", "red")
+            self.hide_progress()
+            return
 
-    def collect_data(self):
-        """Thread to collect data from ESP32"""
+        self.run_loop()
+
+    def on_collected(self, row):
+        """Collector.on_reading: hand a queued reading to the live views"""
+        smoothed = self.collector.filter.channels['moisture_percent'].ema.value
+        self.publish_reading(row['date_created'], dict(row, moisture_smoothed=smoothed))
+
+    def run_loop(self):
+        """Consume readings until the run ends, is stopped or the link drops"""
+        # Progress and timeout follow the negotiated run, burst runs until stopped
+        collector = self.collector
+        total = collector.config[0]
+        burst = total == 0
+        timeout = run_timeout(*collector.config)
         start_time = time.time()
-        timeout = 30  # 30 seconds timeout
         
-        # Reset loop counter at start
-        self.loop_count = 0
-        
-        while self.is_collecting and self.loop_count < self.total_loops:
+        while self.is_collecting and (burst or collector.loop_count < total):
             try:
-                with self.serial_lock:
-                    if not self.ser or not self.ser.is_open:
-                        raise serial.SerialException("Device disconnected")
-                        
-                    if self.ser.in_waiting > 0:
-                        line = self.ser.readline().decode().strip()
-                        print(f"Received: {line}")  # Debug
-                        
-                        if line.startswith("Loop:"):
-                            # Extract numeric value from "Loop: X"
-                            try:
-                                received_loop = int(line.split(":")[1].strip())
-                                self.loop_count = received_loop
-                                print(f"Updated loop: {self.loop_count}")
-                                self.update_progress((self.loop_count / self.total_loops) * 100)
-                            except ValueError:
-                                print("Invalid loop message")
-                                
-                        elif line.startswith("Complete:"):
-                            break
+                reader = self.reader
+                if not reader:
+                    raise serial.SerialException("Device disconnected")
+
+                # Lines come from the reader thread, so no serial lock is held here
+                try:
+                    raw = reader.lines.get(timeout=0.5)
+                except queue.Empty:
+                    raw = b''
+
+                if raw is None:
+                    raise serial.SerialException(f"Device disconnected: {reader.error}")
+
+                data = collector.handle(raw) if raw else None
+                if data:
+                    log.debug('received', device=self.device_id, data=data)
+
+                    # Text mode sends "Loop: N" lines, binary frames carry it
+                    if 'loop' in data:
+                        self.publish_event({'event': 'progress', 'device_id': self.device_id,
+                                            'loop': collector.loop_count, 'total': total})
+                        if not burst:
+                            self.update_progress((collector.loop_count / total) * 100)
+
+                    # The collector has stored the run by now
+                    if data.get('status', '').startswith(("Complete", "Stopped")):
+                        break
                             
-                        elif not (line.startswith("Started") or line.startswith("Stopped")):
-                            try:
-                                parts = line.split(',')
-                                if len(parts) == 3:
-                                    session = self.Session()
-                                    moisture_data = MoistureContent(
-                                        moisture_percent=float(parts[0]),
-                                        temperature=float(parts[1]),
-                                        humidity=float(parts[2])
-                                    )
-                                    session.add(moisture_data)
-                                    session.commit()
-                                    session.close()
-                            except ValueError as e:
-                                print(f"Data parsing error: {e}")
-                                
                 # Check for timeout
-                if time.time() - start_time > timeout:
+                if timeout is not None and time.time() - start_time > timeout:
                     print("Data collection timeout")
                     break
-                    
-                time.sleep(0.1)
+
+                # The device normally confirms a stop right away
+                if self.stop_requested and time.time() - self.stop_requested > 2:
+                    break
                 
             except (serial.SerialException, OSError) as e:
                 print(f"Serial error: {e}")
                 self.handle_disconnection()
                 break
 
-        # Completion handling
+        self.writer.flush()
+        if not self.is_connected and collector.run_seq is not None and not self.stop_requested:
+            # The device keeps sampling into its ring buffer; the monitor
+            # catches up and resumes the run once the link is back
+            self.resume_pending = True
+            self.update_status(f"Collection interrupted after {collector.loop_count} readings, "
+                               "waiting for reconnect", "orange")
+            return
+        collector.finish_run(collector.end_status())
         self.is_collecting = False
-        if self.loop_count >= self.total_loops:
-            self.update_status("Data Collection: Complete", "green")
+        self.hide_progress()
+
+    def report_run(self, status, result):
+        """Collector.on_finish: report how the run ended"""
+        collector = self.collector
+        self.is_collecting = False
+        self.resume_pending = False
+        summary = runs.describe(result)
+        if collector.config[0] == 0:
+            self.update_status(f"Data Collection: Stopped after {collector.loop_count} readings, {summary}", "green")
+        elif status == runs.COMPLETE:
+            self.update_status(f"Data Collection: Complete, {summary}", "green")
         else:
-            self.update_status("Data Collection: Incomplete", "red")
+            self.update_status(f"Data Collection: {status.capitalize()}, {summary}", "red")
         self.hide_progress()
-    def update_status(self, text, color):
-        """Enhanced thread-safe status updates"""
-        def update_gui():
-            current_text = self.status_label.cget("text")
-            if current_text != text:  # Only update if changed
-                self.status_label.config(text=text, fg=color)
-                self.root.update_idletasks()  # Force GUI refresh
-        
-        self.root.after(0, update_gui)
-        
+
+    def resume_collection(self):
+        """After a reconnect, fetch what the device buffered and continue the run"""
+        collector = self.collector
+        try:
+            answer = catch_up(self.reader, self.send_command, collector.last_seq() or 0)
+        except (serial.SerialException, OSError) as e:
+            print(f"Catch-up failed: {e}")
+            return  # Still pending, retried after the next reconnect
+        if answer is None and not self.is_connected:
+            return
+
+        # Closes the run unless the device is still sampling
+        collector.apply_catch_up(answer)
+        if collector.is_collecting:
+            self.is_collecting = True
+            self.resume_pending = False
+            self.update_status(f"Data Collection: Resumed at {collector.loop_count} readings", "blue")
+            self.run_loop()
+
     def monitor_serial_connection(self):
         """Improved connection monitoring with cooldown"""
         while not self.stop_monitoring:
             try:
                 if not self.is_connected:
-                    # Attempt connection with fresh port object
+                    # Open and negotiate a fresh port without the lock, so
+                    # commands never wait for the cooldown or the handshake
+                    port = self.fixed_port or self.find_esp32_port() or DEFAULT_PORT
+                    ser = open_serial(port, 115200, timeout=0.5)
+                    device_id = device_identity(port)
+                    reader = SerialReader(ser, device=device_id).start()
+                    try:
+                        time.sleep(2)  # Cooldown after connection
+                        binary_mode = self.use_binary and negotiate_binary(reader, ser.write)
+                    except (serial.SerialException, OSError):
+                        reader.stop()
+                        ser.close()
+                        raise
+
+                    # Swap the negotiated port in
                     with self.serial_lock:
                         if self.ser:
                             self.ser.close()
-                        self.ser = serial.Serial('COM3', 115200, timeout=1)
-                        self.is_connected = True
-                        self.root.after(0, self.update_status, 
-                                    "ESP32 Status: Connected", "green")
-                        print("Connected successfully")
-                        time.sleep(2)  # Cooldown after connection
+                        self.ser, self.port, self.device_id = ser, port, device_id
+                        self.reader = reader
+                        self.binary_mode = binary_mode
+                    if self.has_connected:
+                        metrics.RECONNECTS.inc(self.device_id)
+                    else:
+                        runs.sweep(self.Session, self.device_id)  # Left open by a crash
+                    self.has_connected = True
+                    self.is_connected = True  # After the sweep, which must not close a new run
+                    self.ui.set('connected', True)
+                    self.update_status("ESP32 Status: Connected", "green")
+                    print("Connected successfully")
+                    if self.use_binary:
+                        print(f"Binary frames: {self.binary_mode}")
+                    if self.resume_pending:
+                        self.resume_thread = threading.Thread(target=self.resume_collection)
+                        self.resume_thread.daemon = True
+                        self.resume_thread.start()
                 else:
-                    # Check connection status without CTS (more reliable)
-                    with self.serial_lock:
-                        if not self.ser.is_open:
-                            raise serial.SerialException("Port closed")
-                            
-                        # Test with a safe command
-                        self.ser.write(b'\x00')  # Null byte test
-                        time.sleep(0.1)
+                    # Any traffic from the device (data or heartbeat) proves
+                    # it is alive, so nothing is written while it is talking
+                    if not self.ser or not self.ser.is_open:
+                        raise serial.SerialException("Port closed")
+
+                    state = self.reader.liveness()
+                    if state == 'dead':
+                        raise serial.SerialException(
+                            str(self.reader.error or "Heartbeat lost"))
+                    if state == 'probe':
+                        with self.serial_lock:
+                            self.ser.write(PROBE_COMMAND)
                         
             except (serial.SerialException, OSError) as e:
                 if self.is_connected:  # Only handle if we were connected
@@ -284,17 +567,16 @@ class MoistureMonitorApp:
             time.sleep(1)  # Base polling interval
 
     def handle_disconnection(self):
-
-        def update_connection_state(self, connected):
-            color = "green" if connected else "red"
-            self.led.itemconfig(self.led_indicator, fill=color) 
-
         """Safer disconnection handling"""
         if self.is_connected:  # Only update if state changed
             self.is_connected = False
-            self.root.after(0, self.update_status, 
-                        "ESP32 Status: Disconnected", "red")
+            self.ui.set('connected', False)
+            self.update_status("ESP32 Status: Disconnected", "red")
             
+        if self.reader:
+            self.reader.stop()
+            self.reader = None
+
         with self.serial_lock:
             try:
                 if self.ser and self.ser.is_open:
@@ -308,111 +590,135 @@ class MoistureMonitorApp:
         # Stop any ongoing collection
         if self.is_collecting:
             self.is_collecting = False
-            self.root.after(0, self.hide_progress)
-            self.root.after(0, self.update_status,
-                        "Collection interrupted", "orange")
-
-        def handle_disconnection(self):
-            """Improved disconnection handling"""
-            was_connected = self.is_connected
-            self.is_connected = False
-            
-            if was_connected:
-                self.root.after(0, self.update_status, 
-                            "ESP32 Status: Disconnected", "red")
-                
-            with self.serial_lock:
-                if self.ser and self.ser.is_open:
-                    try:
-                        self.ser.close()
-                        print("Serial port closed properly")  # Debug
-                    except Exception as e:
-                        print(f"Error closing port: {str(e)}")  # Debug
-                self.ser = None
-
-            if self.is_collecting:
-                self.is_collecting = False
-                self.root.after(0, self.hide_progress)
-                self.root.after(0, self.update_status,
-                            "Connection lost during collection", "orange")
-                
-                # If data collection is active, stop it
-                if self.is_collecting:
-                    self.is_collecting = False
-                    self.root.after(0, self.hide_progress)
+            self.hide_progress()
+            self.update_status("Collection interrupted", "orange")
 
-
-    def show_progress(self):
-        self.root.after(0, lambda: self.progress.pack(pady=10))
-        self.root.after(0, lambda: self.progress.config(value=0))
+    def show_progress(self, indeterminate=False):
+        self.ui.set('progress', ('indeterminate', None) if indeterminate else ('determinate', 0))
 
     def update_progress(self, value):
-        self.root.after(0, lambda: self.progress.config(value=value))
+        state = self.ui.get('progress')
+        if state and state[0] == 'determinate':  # Ignore updates after hide_progress()
+            self.ui.set('progress', ('determinate', round(value, 1)))
 
     def hide_progress(self):
-        self.root.after(0, lambda: self.progress.pack_forget())
+        self.ui.set('progress', None)
+
+    def update_status(self, text, color):
+        """Thread-safe status line update"""
+        self.ui.set('status', (text, color))
+        self.publish_event({'event': 'status', 'device_id': self.device_id, 'status': text})
+
+    # Dispatcher handlers, always on the Tk thread
+
+    def apply_status(self, state):
+        text, color = state
+        self.status_label.config(text=text, fg=color)
+
+    def apply_progress(self, state):
+        if state is None:
+            self.progress.stop()
+            self.progress.pack_forget()
+            self.progress_mode = None
+            return
+        mode, value = state
+        self.progress.pack(pady=10)
+        if mode != self.progress_mode:
+            self.progress.stop()
+            self.progress.config(mode=mode)
+            if mode == 'indeterminate':
+                self.progress.start(50)
+            self.progress_mode = mode
+        if mode == 'determinate':
+            self.progress.config(value=value)
+
+    def apply_connection(self, connected):
+        self.led.itemconfig(self.led_indicator, fill="green" if connected else "red")
+
+    def apply_reading(self, reading):
+        moisture, temperature, humidity = reading
+        parts = [f"Moisture {moisture:.1f}%"]
+        if temperature is not None:
+            parts.append(f"{temperature:.1f}°C")
+        if humidity is not None:
+            parts.append(f"{humidity:.0f}% RH")
+        self.reading_label.config(text="Last reading: " + ", ".join(parts))
 
     def show_graph(self):
-        """Show graph in the main thread"""
-        try:
-            # Create new window
-            graph_window = tk.Toplevel(self.root)
-            graph_window.title("Moisture Data Graph")
-            graph_window.geometry("800x600")
+        """Open (or raise) the live graph window"""
+        if self.live_chart:
+            self.live_chart.lift()
+            return
 
-            # Get data in a separate thread
-            def fetch_data():
+        try:
+            livechart, querycache = plugins.load_plugin('graph')
+            if self.query_cache is None:
+                self.query_cache = querycache.QueryCache()
+            chart = livechart.LiveChart(self.root, window=2 * GRAPH_POINTS, expect_history=True,
+                                        on_close=self.close_graph)
+            self.live_chart = chart
+
+            # Subscribe first so nothing arriving during the query is missed
+            self.reading_listeners.append(chart.push)
+
+            def fetch_history():
+                # Days of history render as at most GRAPH_POINTS points; reopening
+                # the graph only fetches what was stored since it was last shown
+                points = []
                 session = self.Session()
-                readings = session.query(MoistureContent).order_by(
-                    MoistureContent.date_created.desc()
-                ).limit(5).all()
-                readings.reverse()
-                session.close()
-                return readings
-
-            # Create and display graph in main thread
-            def create_graph(readings):
-                fig, ax = plt.subplots(figsize=(10, 6))
-                
-                data = {
-                    'id': [r.id for r in readings],
-                    'moisture_percent': [r.moisture_percent for r in readings],
-                    'date': [r.date_created.strftime('%Y-%m-%d') for r in readings]
-                }
-                
-                ax.plot(range(len(readings)), [r.moisture_percent for r in readings], 
-                    marker='o', color='blue')
-                ax.set_title('Moisture Content Over Time')
-                ax.set_ylabel('Moisture (%)')
-                ax.set_xlabel('Reading')
-                
-                ax.set_xticks(range(len(readings)))
-                ax.set_xticklabels([f'ID:{r.id}\n{r.date_created.strftime("%Y-%m-%d")}' 
-                                for r in readings], rotation=45)
-                
-                plt.tight_layout()
-                
-                canvas = FigureCanvasTkAgg(fig, graph_window)
-                canvas.draw()
-                canvas.get_tk_widget().pack(fill='both', expand=True)
-
-            # Fetch data in background thread
-            def async_fetch_and_create():
-                readings = fetch_data()
-                # Schedule graph creation in main thread
-                self.root.after(0, lambda: create_graph(readings))
-
-            # Start the background thread
-            fetch_thread = threading.Thread(target=async_fetch_and_create)
+                try:
+                    times, values = self.query_cache.recent_series(session, GRAPH_HISTORY,
+                                                                   points=GRAPH_POINTS)
+                    points = zip(times, values)
+                except Exception as e:
+                    self.update_status(f"Graph history unavailable: {e}", "red")
+                finally:
+                    session.close()
+                    # Always release the live points held back for the history
+                    chart.load_history(points)
+
+            fetch_thread = threading.Thread(target=fetch_history)
             fetch_thread.daemon = True
             fetch_thread.start()
         
         except Exception as e:
             self.update_status(f"Graph creation failed: {str(e)}", "red")
 
-
-    def export_to_pdf(self):
-        """Export graph and data to PDF"""
+    def show_stats(self):
+        """Open (or raise) the acquisition stats window"""
+        if self.stats_panel:
+            self.stats_panel.lift()
+            return
+        self.stats_panel = StatsPanel(self.root, on_close=self.close_stats)
+
+    def close_stats(self, panel):
+        self.stats_panel = None
+
+    def close_graph(self, chart):
+        if chart.push in self.reading_listeners:
+            self.reading_listeners.remove(chart.push)
+        self.live_chart = None
+
+    def publish_reading(self, timestamp, data):
+        """Hand a stored reading to live views, smoothed when the filters provide it"""
+        moisture = data.get('moisture_smoothed', data['moisture_percent'])
+        for listener in list(self.reading_listeners):
+            listener(timestamp, moisture)
+        self.ui.set('reading', (data['moisture_percent'], data['temperature'], data['humidity']))
+        self.publish_event({
+            'event': 'reading', 'device_id': self.device_id, 'timestamp': timestamp.isoformat(),
+            'moisture_percent': data['moisture_percent'], 'moisture_smoothed': moisture,
+            'temperature': data['temperature'], 'humidity': data['humidity'],
+            'loop': self.collector.loop_count if self.collector else None
+        })
+
+    def publish_event(self, event):
+        """Hand a live event to pub/sub subscribers (standalone mode only)"""
+        if self.broker:
+            self.broker.publish_threadsafe(event)
+
+    def export_to_pdf(self, start=None, end=None, device_id=None):
+        """Build a PDF report in the background worker process"""
         try:
             file_path = filedialog.asksaveasfilename(
                 defaultextension='.pdf',
@@ -421,85 +727,22 @@ class MoistureMonitorApp:
             )
 
             if file_path:
-                # Get the data
-                session = self.Session()
-                readings = session.query(MoistureContent).order_by(
-                    MoistureContent.date_created.desc()
-                ).limit(5).all()
-                readings.reverse()
-
-                # Create PDF
-                doc = SimpleDocTemplate(file_path, pagesize=letter)
-                styles = getSampleStyleSheet()
-                elements = []
-
-                # Add title
-                elements.append(Paragraph("Moisture Monitoring Report", styles['Title']))
-                elements.append(Spacer(1, 20))
-
-                # Create graph for PDF
-                plt.figure(figsize=(8, 6))
-                plt.plot(
-                    range(len(readings)),
-                    [r.moisture_percent for r in readings],
-                    marker='o'
-                )
-                plt.title('Moisture Content Over Time')
-                plt.ylabel('Moisture (%)')
-                plt.xlabel('Reading')
-                plt.xticks(
-                    range(len(readings)),
-                    [f'ID:{r.id}\n{r.date_created.strftime("%Y-%m-%d")}' for r in readings],
-                    rotation=45
-                )
-                plt.tight_layout()
-
-                # Save graph to buffer
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-                plt.close()
-
-                # Add image to PDF
-                from reportlab.platypus import Image
-                img = Image(buf)
-                img.drawHeight = 300
-                img.drawWidth = 500
-                elements.append(img)
-                elements.append(Spacer(1, 20))
-
-                # Add table
-                data = [['ID', 'Moisture %', 'Temperature', 'Humidity', 'Date']]
-                for reading in readings:
-                    data.append([
-                        str(reading.id),
-                        f"{reading.moisture_percent:.2f}%",
-                        f"{reading.temperature:.2f}°C",
-                        f"{reading.humidity:.2f}%",
-                        reading.date_created.strftime("%Y-%m-%d %H:%M:%S")
-                    ])
-
-                table = Table(data)
-                table.setStyle(TableStyle([
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 14),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                    ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                    ('FONTSIZE', (0, 1), (-1, -1), 12),
-                    ('GRID', (0, 0), (-1, -1), 1, colors.black)
-                ]))
-                elements.append(table)
-
-                # Build PDF
-                doc.build(elements)
-                buf.close()
-                session.close()
-
-                self.update_status("PDF exported successfully", "green")
+                def finished(result, error):
+                    if error:
+                        self.update_status(f"Export failed: {error}", "red")
+                        return
+                    self.update_status("PDF exported successfully", "green")
+                    self.ui.call(lambda: messagebox.showinfo(
+                        "Report ready",
+                        f"Report with {result['count']} readings saved to\n{result['path']}"
+                    ))
+
+                if self.reports is None:
+                    reports = plugins.load('reports')
+                    self.reports = reports.ReportService(
+                        self.engine.url.render_as_string(hide_password=False))
+                self.reports.submit(file_path, start, end, device_id, on_done=finished)
+                self.update_status("Generating PDF report...", "blue")
 
         except Exception as e:
             self.update_status(f"Export failed: {str(e)}", "red")
@@ -507,21 +750,31 @@ class MoistureMonitorApp:
     def on_closing(self):
         """Cleanup when window closes"""
         self.stop_monitoring = True
+        self.ui.stop()
+        if self.daemon:
+            self.daemon.close()
+        if self.broker:
+            self.broker.stop_thread()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        if self.reader:
+            self.reader.stop()
         with self.serial_lock:
             if self.ser and self.ser.is_open:
                 self.ser.close()
+        if self.collector and (self.is_collecting or self.resume_pending):
+            self.writer.flush()
+            self.collector.finish_run(runs.INTERRUPTED)
+        self.writer.close()
+        if self.reports:
+            self.reports.shutdown()
         self.root.destroy()
 
-    def update_status(self, text, color):
-        """Thread-safe GUI update"""
-        self.root.after(0, lambda: self.status_label.config(text=text, fg=color))
-    
     def find_esp32_port(self):
         """Scan for available COM ports"""
-        ports = serial.tools.list_ports.comports()
-        for port in ports:
-            if "USB" in port.description.upper() or "SERIAL" in port.description.upper():
-                return port.device
+        ports = find_esp32_ports()
+        if ports:
+            return ports[0].device
         return None
 
 if __name__ == "__main__":
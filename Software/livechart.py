@@ -0,0 +1,101 @@
+import tkinter as tk
+from collections import deque
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+
+class LiveChart:
+    """A persistent chart window that follows incoming readings.
+
+    One figure and one Line2D are created up front. `push()` may be called
+    from any thread; points are appended to a ring buffer of `window`
+    readings and the canvas is redrawn with `draw_idle` at most once every
+    `refresh_ms`, and only when something changed. CPU and memory therefore
+    stay flat however long the window is open.
+    """
+
+    def __init__(self, root, title="Moisture Data Graph", window=500, refresh_ms=250,
+                 expect_history=False, on_close=None):
+        self.top = tk.Toplevel(root)
+        self.top.title(title)
+        self.top.geometry("800x600")
+        self.top.protocol("WM_DELETE_WINDOW", self.close)
+        self.refresh_ms = refresh_ms
+        self.on_close = on_close
+
+        self.times = deque(maxlen=window)
+        self.values = deque(maxlen=window)
+        self.pending = deque(maxlen=window)  # Filled by worker threads, drained on the Tk thread
+        self.history = None
+        self.waiting_for_history = expect_history  # Hold live points until history is in
+
+        self.figure = Figure(figsize=(10, 6))
+        self.ax = self.figure.add_subplot()
+        self.line, = self.ax.plot([], [], marker='o', markersize=3, color='blue')
+        self.ax.set_title('Moisture Content Over Time')
+        self.ax.set_ylabel('Moisture (%)')
+        self.ax.set_xlabel('Time')
+        self.ax.grid(True)
+        self.ax.xaxis_date()
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M:%S'))
+        self.figure.autofmt_xdate()
+
+        self.canvas = FigureCanvasTkAgg(self.figure, self.top)
+        self.canvas.get_tk_widget().pack(fill='both', expand=True)
+        self.canvas.draw()
+
+        self.closed = False
+        self.job = self.top.after(self.refresh_ms, self._refresh)
+
+    def push(self, timestamp, moisture_percent):
+        """Queue one point (thread-safe)"""
+        self.pending.append((mdates.date2num(timestamp), moisture_percent))
+
+    def load_history(self, points):
+        """Set stored (timestamp, moisture_percent) pairs to show before live ones.
+
+        The chart can subscribe before the history query runs; live points
+        that are already part of the history are dropped when merging.
+        """
+        self.history = [(mdates.date2num(t), m) for t, m in points]
+        self.waiting_for_history = False
+
+    def lift(self):
+        self.top.deiconify()
+        self.top.lift()
+
+    def _refresh(self):
+        if self.closed:
+            return
+        changed = False
+        if self.history is not None:
+            history, self.history = self.history, None
+            for x, y in history:
+                self.times.append(x)
+                self.values.append(y)
+            changed = bool(history)
+        if self.pending and not self.waiting_for_history:
+            last = self.times[-1] if self.times else float('-inf')
+            while self.pending:
+                x, y = self.pending.popleft()
+                if x > last:
+                    self.times.append(x)
+                    self.values.append(y)
+                    last = x
+            changed = True
+        if changed:
+            self.line.set_data(self.times, self.values)
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.canvas.draw_idle()
+        self.job = self.top.after(self.refresh_ms, self._refresh)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.top.after_cancel(self.job)
+        if self.on_close:
+            self.on_close(self)
+        self.top.destroy()
@@ -0,0 +1,59 @@
+import json
+import os
+import time
+
+# Level-gated structured logging for per-line and per-reading output.
+# Calls below the current level return before anything is formatted, so
+# debug() on the hot path costs one comparison when disabled. Each record
+# is an event name plus key=value fields, printed as one line, or as one
+# JSON object with MOISTURE_LOG_FORMAT=json.
+#   MOISTURE_LOG=debug python controller.py
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+level = LEVELS.get(os.environ.get('MOISTURE_LOG', 'info').lower(), INFO)
+json_format = os.environ.get('MOISTURE_LOG_FORMAT', '').lower() == 'json'
+
+
+def set_level(name):
+    global level
+    level = LEVELS[name.lower()]
+
+
+def enabled(value):
+    """True if records at `value` are emitted (to skip building costly fields)"""
+    return value >= level
+
+
+def debug(event, **fields):
+    if level <= DEBUG:
+        _emit('debug', event, fields)
+
+
+def info(event, **fields):
+    if level <= INFO:
+        _emit('info', event, fields)
+
+
+def warning(event, **fields):
+    if level <= WARNING:
+        _emit('warning', event, fields)
+
+
+def error(event, **fields):
+    if level <= ERROR:
+        _emit('error', event, fields)
+
+
+def _emit(name, event, fields):
+    if json_format:
+        print(json.dumps(dict(time=time.time(), level=name, event=event, **fields), default=str),
+              flush=True)
+        return
+    parts = [time.strftime('%H:%M:%S'), name.upper(), event]
+    parts.extend(f"{key}={value!r}" for key, value in fields.items())
+    print(' '.join(parts), flush=True)
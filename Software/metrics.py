@@ -0,0 +1,230 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from protocol import parse_message
+import profiler
+
+# In-process metrics for the acquisition hot path. Updating a metric is a
+# dict update under a lock, cheap enough to do for every line. Each metric
+# has at most one label (the device for the per-device ones). The registry
+# is exposed in Prometheus text format by serve() at
+#   http://127.0.0.1:9108/metrics
+# and read directly by the GUI's stats panel (statspanel.py). With
+# profiling enabled (MOISTURE_PROFILING=1), /profile?seconds=N on the same
+# server samples the running process and returns folded stacks (see
+# profiler.py).
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+MAX_PROFILE_SECONDS = 60
+
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}  # Label value (None without a label) -> value
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, key):
+        if self.label is None or key is None:
+            return ''
+        value = str(key).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return f'{self.label}="{value}"'
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def exposition(self):
+        lines = []
+        for key, value in self.collect().items():
+            labels = self.labels(key)
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, key=None, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is set, or read from a callback at collection time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self.callbacks = {}
+
+    def set(self, value, key=None):
+        with self.lock:
+            self.values[key] = value
+
+    def track(self, function, key=None):
+        """Read the value from function() whenever the gauge is collected"""
+        with self.lock:
+            self.callbacks[key] = function
+
+    def untrack(self, key=None):
+        with self.lock:
+            self.callbacks.pop(key, None)
+            self.values.pop(key, None)
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+            callbacks = dict(self.callbacks)
+        for key, function in callbacks.items():
+            try:
+                values[key] = function()
+            except Exception:
+                pass  # The tracked object went away
+        return values
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, as Prometheus histograms are"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, key=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        with self.lock:
+            return {key: (list(counts), total, count)
+                    for key, (counts, total, count) in self.values.items()}
+
+    def quantile(self, fraction, key=None):
+        """Estimated quantile, interpolated within its bucket like histogram_quantile()"""
+        state = self.collect().get(key)
+        if not state or not state[2]:
+            return None
+        counts, _, count = state
+        rank = fraction * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def exposition(self):
+        lines = []
+        for key, (counts, total, count) in self.collect().items():
+            labels = self.labels(key)
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+LINES_READ = Counter('moisture_lines_read_total', "Lines and frames read from the device", 'device')
+BYTES_READ = Counter('moisture_bytes_read_total', "Bytes read from the device", 'device')
+PARSE_FAILURES = Counter('moisture_parse_failures_total', "Items that did not parse", 'device')
+RECONNECTS = Counter('moisture_reconnects_total', "Connections re-established after a loss",
+                     'device')
+READ_WAIT = Histogram('moisture_serial_read_wait_seconds', "Time blocked in serial reads",
+                      'device')
+PARSE_TIME = Histogram('moisture_parse_seconds', "Time to parse one item", 'device')
+COMMIT_LATENCY = Histogram('moisture_db_commit_seconds', "Time to write and commit one batch")
+ROWS_COMMITTED = Counter('moisture_rows_committed_total', "Readings written to the database")
+WRITE_FAILURES = Counter('moisture_db_write_failures_total', "Batch write attempts that failed")
+ROWS_DROPPED = Counter('moisture_rows_dropped_total',
+                       "Readings given up after repeated write failures")
+QUEUE_DEPTH = Gauge('moisture_queue_depth', "Items waiting in a queue", 'queue')
+
+
+def parse(item, device=None):
+    """protocol.parse_message() with its time and failures recorded for `device`"""
+    started = time.perf_counter()
+    data = parse_message(item)
+    PARSE_TIME.observe(time.perf_counter() - started, device)
+    if data is None and item:
+        PARSE_FAILURES.inc(device)
+    return data
+
+
+def exposition():
+    """Every metric in Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.exposition())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    profiling = False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self.reply(200, exposition(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif url.path == '/profile' and self.profiling:
+            query = parse_qs(url.query)
+            try:
+                seconds = min(float(query.get('seconds', ['10'])[0]), MAX_PROFILE_SECONDS)
+            except ValueError:
+                self.reply(400, "seconds must be a number\n")
+                return
+            self.reply(200, profiler.profile(seconds))
+        else:
+            self.reply(404, "Not found\n")
+
+    def reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would otherwise print a line every few seconds
+
+
+def serve(port=METRICS_PORT, host=METRICS_HOST, profiling=None):
+    """Serve /metrics (and /profile if enabled) from a background thread"""
+    if profiling is None:
+        profiling = profiler.enabled()
+    handler = type('Handler', (MetricsHandler,), {'profiling': profiling})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, ForeignKey, String, Float, Integer, Column, DateTime
+from sqlalchemy import create_engine, ForeignKey, String, Float, Integer, Column, DateTime, Index, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -11,17 +11,196 @@ class MoistureContent(Base):
     moisture_percent = Column("moisture_percent", Float)
     temperature = Column("temperature", Float)
     humidity = Column("humidity", Float)
-    date_created = Column(DateTime(), default=datetime.now)
+    date_created = Column(DateTime(), default=datetime.now, index=True)
+    device_id = Column("device_id", String(64))
+    raw_counts = Column("raw_counts", Integer)  # Sensor ADC counts, if the device sends them
+    seq = Column("seq", Integer)  # Device sample sequence number, if known
+    run_id = Column("run_id", Integer, ForeignKey("MeasurementRun.id"), index=True)
+
+    __table_args__ = (
+        Index("ix_MoistureContent_device_date", "device_id", "date_created"),
+        Index("ix_MoistureContent_device_seq", "device_id", "seq"),
+    )
 
-    def __init__(self, moisture_percent, temperature, humidity):
+    def __init__(self, moisture_percent, temperature, humidity, device_id=None, raw_counts=None,
+                 run_id=None):
         self.moisture_percent = moisture_percent
         self.temperature = temperature
         self.humidity = humidity
+        self.device_id = device_id
+        self.raw_counts = raw_counts
+        self.run_id = run_id
+
+class MeasurementRun(Base):
+    """One acquisition run (S ... Complete/Stopped) and its filtered result.
+
+    The row is created when the device confirms the start, so readings can
+    point at it through MoistureContent.run_id, and the summary is filled
+    in once when the run ends. `status` is 'running', 'complete',
+    'incomplete' (stopped early or timed out) or 'interrupted' (the link
+    or the program went away). The moisture figures are taken over the
+    readings that passed the range and outlier checks in filters.py: the
+    median is the run's result, the mean comes with the half-width of its
+    95% confidence interval.
+    """
+    __tablename__ = "MeasurementRun"
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String(64), index=True)
+    grain_lot = Column(String(64))
+    started = Column(DateTime(), default=datetime.now, index=True)
+    finished = Column(DateTime())
+    status = Column(String(16), nullable=False, default='complete', server_default='complete')
+    sample_count = Column(Integer)  # Requested readings, 0 for burst runs
+    interval_ms = Column(Integer)
+    readings = Column(Integer, nullable=False, default=0)
+    rejected = Column(Integer, nullable=False, default=0)
+    moisture_median = Column(Float)
+    moisture_mean = Column(Float)
+    moisture_std = Column(Float)
+    moisture_ci95 = Column(Float)
+    temperature_mean = Column(Float)
+    humidity_mean = Column(Float)
+
+    __table_args__ = (
+        Index("ix_MeasurementRun_device_started", "device_id", "started"),
+        Index("ix_MeasurementRun_lot_started", "grain_lot", "started"),
+    )
+
+class DeviceCalibration(Base):
+    """Per-sensor calibration: ADC counts in dry air and in water.
+
+    Counts are normalised to 0 (dry) .. 1 (wet) before the grain curve of
+    `variety` is applied.
+    """
+    __tablename__ = "DeviceCalibration"
+    device_id = Column(String(64), primary_key=True)
+    dry_counts = Column(Float, nullable=False)
+    wet_counts = Column(Float, nullable=False)
+    variety = Column(String(32), nullable=False, default='generic')
+    date_updated = Column(DateTime(), default=datetime.now, onupdate=datetime.now)
+
+class VarietyCurve(Base):
+    """Moisture curve for a grain variety.
+
+    moisture % = c0 + c1*r + c2*r^2 + c3*r^3 + temp_coeff * (T - ref_temp),
+    clipped to [min_percent, max_percent], where r is the normalised reading.
+    """
+    __tablename__ = "VarietyCurve"
+    variety = Column(String(32), primary_key=True)
+    c0 = Column(Float, nullable=False, default=0.0)
+    c1 = Column(Float, nullable=False, default=100.0)
+    c2 = Column(Float, nullable=False, default=0.0)
+    c3 = Column(Float, nullable=False, default=0.0)
+    temp_coeff = Column(Float, nullable=False, default=0.0)
+    ref_temp = Column(Float, nullable=False, default=25.0)
+    min_percent = Column(Float, nullable=False, default=0.0)
+    max_percent = Column(Float, nullable=False, default=100.0)
+    date_updated = Column(DateTime(), default=datetime.now, onupdate=datetime.now)
+
+class Rollup(Base):
+    """Pre-aggregated readings per resolution ('minute', 'hour', 'day') and device.
+
+    Sums and sums of squares are stored rather than means so buckets can be
+    updated incrementally and merged; `*_n` counts the non-null values of a
+    column. device_id is '' for readings without a device.
+    """
+    __tablename__ = "Rollup"
+    resolution = Column(String(8), primary_key=True)
+    device_id = Column(String(64), primary_key=True, default='')
+    bucket_start = Column(DateTime(), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    moisture_n = Column(Integer, nullable=False, default=0)
+    moisture_min = Column(Float)
+    moisture_max = Column(Float)
+    moisture_sum = Column(Float, nullable=False, default=0.0)
+    moisture_sumsq = Column(Float, nullable=False, default=0.0)
+    temperature_n = Column(Integer, nullable=False, default=0)
+    temperature_min = Column(Float)
+    temperature_max = Column(Float)
+    temperature_sum = Column(Float, nullable=False, default=0.0)
+    temperature_sumsq = Column(Float, nullable=False, default=0.0)
+    humidity_n = Column(Integer, nullable=False, default=0)
+    humidity_min = Column(Float)
+    humidity_max = Column(Float)
+    humidity_sum = Column(Float, nullable=False, default=0.0)
+    humidity_sumsq = Column(Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        Index("ix_Rollup_resolution_bucket", "resolution", "bucket_start"),
+    )
+
+class ArchiveFile(Base):
+    """Manifest entry for a file of raw readings moved out of MoistureContent.
+
+    The file holds the rows with start <= date_created < end and
+    id <= max_id that were in the table when it was written.
+    """
+    __tablename__ = "ArchiveFile"
+    id = Column(Integer, primary_key=True)
+    path = Column(String(255), nullable=False)
+    format = Column(String(16), nullable=False)
+    start = Column(DateTime(), nullable=False)
+    end = Column(DateTime(), nullable=False, index=True)
+    rows = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=False)
+    date_created = Column(DateTime(), default=datetime.now)
+
+class DataVersion(Base):
+    """Single row counting in-place changes to stored readings.
+
+    Calibration reprocessing and retention bump it (queries.mark_changed),
+    so caches of query results in any process can tell that rows they
+    hold changed without a new id appearing (see querycache.py).
+    """
+    __tablename__ = "DataVersion"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+def upgrade_schema(engine):
+    """Add columns introduced after a database file was first created"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = column.type.compile(engine.dialect)
+                if column.server_default is not None:
+                    # Also fills the new column in existing rows
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl}'))
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def _tune_sqlite(dbapi_connection, connection_record):
+    """Per-connection SQLite settings.
+
+    WAL lets readers (graphs, exports) run while the writer commits, and
+    synchronous=NORMAL is durable across application crashes under WAL.
+    auto_vacuum only takes effect on new files (see retention.py).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-20000")  # About 20 MB of page cache
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
 
 # Database setup function
-def setup_database():
-    db = "sqlite:///moistureDB.db"
+def setup_database(db="sqlite:///moistureDB.db"):
     engine = create_engine(db)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _tune_sqlite)
+    new_rollups = not inspect(engine).has_table(Rollup.__tablename__)
     Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+    if new_rollups:
+        # Databases created before rollups existed are aggregated once
+        from rollups import backfill
+        backfill(engine)
     Session = sessionmaker(bind=engine)
     return engine, Session
\ No newline at end of file
@@ -0,0 +1,50 @@
+import importlib
+import threading
+import time
+
+# Optional GUI features and the modules behind them. matplotlib, numpy and
+# pyarrow account for most of the GUI's import time, so these modules are
+# imported on first use, or by preload() once the window is up, instead of
+# when interface.py is imported. The acquisition core (serial, protocol,
+# database and writer) never depends on them.
+PLUGINS = {
+    'graph': ('livechart', 'querycache'),
+    'export': ('export',),
+    'reports': ('reports',),
+}
+
+load_times = {}  # Module name -> seconds its first import took
+_lock = threading.Lock()
+
+
+def load(module):
+    """Import `module` on first use and return it (thread-safe)"""
+    with _lock:
+        started = time.perf_counter()
+        imported = importlib.import_module(module)
+        load_times.setdefault(module, time.perf_counter() - started)
+    return imported
+
+
+def load_plugin(name):
+    """Import every module of plugin `name`"""
+    return [load(module) for module in PLUGINS[name]]
+
+
+def preload(names=None):
+    """Import plugins on a background thread so the first use is instant.
+
+    Failures are only printed; the same import is retried, and reported
+    to the user, on first use.
+    """
+    def run():
+        for name in names or PLUGINS:
+            try:
+                load_plugin(name)
+            except Exception as e:
+                print(f"Preloading {name} failed: {e}")
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
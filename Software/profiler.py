@@ -0,0 +1,100 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+# Opt-in sampling profiler for a running acquisition. A background thread
+# takes a snapshot of every other thread's Python stack every `interval`
+# seconds; nothing is traced, so the process runs at full speed between
+# samples. The result is in the folded format ("thread;outer;inner count"
+# per line) that flamegraph.pl and speedscope.app turn into flame graphs.
+
+SAMPLE_INTERVAL = 0.005
+
+
+def enabled():
+    """Profiling hooks are only installed with MOISTURE_PROFILING=1"""
+    return os.environ.get('MOISTURE_PROFILING') == '1'
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(1)
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                                 f"{code.co_firstlineno})".replace(';', ':'))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ':'))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.folded())
+        return path
+
+
+def profile(seconds, interval=SAMPLE_INTERVAL):
+    """Sample the whole process for `seconds`; returns folded stacks"""
+    sampler = SamplingProfiler(interval).start()
+    time.sleep(seconds)
+    sampler.stop()
+    return sampler.folded()
+
+
+def install_signal_toggle(directory='.', signum=None):
+    """Start sampling on the first signal (SIGUSR1), dump on the next.
+
+    Each dump goes to moisture-<pid>-<time>.folded in `directory`. Returns
+    False where the signal does not exist (Windows).
+    """
+    signum = signum or getattr(signal, 'SIGUSR1', None)
+    if signum is None:
+        return False
+    state = {'sampler': None}
+
+    def toggle(*_):
+        sampler = state['sampler']
+        if sampler is None:
+            state['sampler'] = SamplingProfiler().start()
+            print("Profiling started")
+            return
+        state['sampler'] = None
+        sampler.stop()
+        path = os.path.join(directory, f"moisture-{os.getpid()}-{int(time.time())}.folded")
+        print(f"Profile with {sampler.samples} samples written to {sampler.dump(path)}")
+
+    signal.signal(signum, toggle)
+    return True
@@ -0,0 +1,374 @@
+import binascii
+import queue
+import struct
+import time
+from datetime import datetime
+from collections import namedtuple
+
+# Binary reading frame, little endian (13 bytes):
+#   sync 0xA5 | type | seq u16 | loop u8 | moisture i16 | temperature i16 |
+#   humidity i16 | crc16
+# Values are fixed point x100; FIXED_NAN marks a failed sensor read. The CRC
+# is CRC-16/CCITT-FALSE over everything before it. Status messages
+# (Started, Stopped, Complete, HB, Mode) stay as text lines in both modes.
+# Type 0x02 appends the sensor's raw ADC counts (u16) before the CRC
+# (15 bytes); moisture is then NaN and computed on the host (calibration.py).
+# In text mode the raw counts are an optional fourth CSV field.
+# Type 0x03 replays a sample from the device's ring buffer (22 bytes):
+#   sync | type | seq u32 | age ms u32 | loop u16 | moisture i16 |
+#   temperature i16 | humidity i16 | raw u16 | crc16
+# where seq is the full sample sequence and age how long ago it was taken.
+# NO_RAW in the raw field means the device has no raw counts.
+SYNC = 0xA5
+FRAME_READING = 0x01
+FRAME_RAW_READING = 0x02
+FRAME_STORED_READING = 0x03
+READING_FORMAT = struct.Struct('<BBHBhhh')
+RAW_READING_FORMAT = struct.Struct('<BBHBhhhH')
+STORED_READING_FORMAT = struct.Struct('<BBIIHhhhH')
+CRC_FORMAT = struct.Struct('<H')
+READING_SIZE = READING_FORMAT.size + CRC_FORMAT.size
+RAW_READING_SIZE = RAW_READING_FORMAT.size + CRC_FORMAT.size
+STORED_READING_SIZE = STORED_READING_FORMAT.size + CRC_FORMAT.size
+FRAME_FORMATS = {
+    FRAME_READING: READING_FORMAT,
+    FRAME_RAW_READING: RAW_READING_FORMAT,
+    FRAME_STORED_READING: STORED_READING_FORMAT
+}
+FIXED_NAN = -32768
+NO_RAW = 0xFFFF
+SCALE = 100.0
+
+# Host -> device commands for mode negotiation
+BINARY_COMMAND = b'B'
+TEXT_COMMAND = b'T'
+BINARY_ACK = b'Mode: binary'
+
+# Run configuration: "N<count>\n" sets readings per run (0 = burst until
+# stopped), "I<ms>\n" the interval and "Q" queries. The device answers each
+# with "Config: N=<count> I=<ms>". Firmware that predates these commands
+# ignores them and always runs the defaults.
+CONFIG_PREFIX = b'Config:'
+DEFAULT_SAMPLE_COUNT = 5
+DEFAULT_INTERVAL_MS = 2000
+
+# Store-and-forward: "D<seq>\n" asks the device to replay every buffered
+# sample after seq (as type 0x03 frames, or "Stored:" lines in text mode),
+# finishing with "Dump: sent=<n> seq=<newest> loop=<n> running=<0|1>".
+# "Started seq=<n>" gives the sequence number before the run's first sample.
+DUMP_PREFIX = b'Dump:'
+
+Reading = namedtuple('Reading', ['seq', 'loop', 'moisture_percent', 'temperature', 'humidity',
+                                 'raw_counts'], defaults=(None,))
+StoredReading = namedtuple('StoredReading', ['seq', 'age_ms', 'loop', 'moisture_percent',
+                                             'temperature', 'humidity', 'raw_counts'])
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def _to_fixed(value):
+    if value != value:  # NaN
+        return FIXED_NAN
+    return int(round(value * SCALE))
+
+
+def _from_fixed(value):
+    if value == FIXED_NAN:
+        return float('nan')
+    return value / SCALE
+
+
+def encode_stored_reading(seq, age_ms, loop, moisture_percent, temperature, humidity, raw_counts):
+    """Build a ring buffer replay frame exactly as the firmware sends it"""
+    body = STORED_READING_FORMAT.pack(
+        SYNC, FRAME_STORED_READING, seq & 0xFFFFFFFF, age_ms & 0xFFFFFFFF, loop & 0xFFFF,
+        _to_fixed(moisture_percent), _to_fixed(temperature), _to_fixed(humidity),
+        NO_RAW if raw_counts is None else raw_counts & 0xFFFF
+    )
+    return body + CRC_FORMAT.pack(crc16(body))
+
+
+def encode_reading(seq, loop, moisture_percent, temperature, humidity, raw_counts=None):
+    """Build a reading frame exactly as the firmware sends it"""
+    values = [seq & 0xFFFF, loop & 0xFF,
+              _to_fixed(moisture_percent), _to_fixed(temperature), _to_fixed(humidity)]
+    if raw_counts is None:
+        body = READING_FORMAT.pack(SYNC, FRAME_READING, *values)
+    else:
+        body = RAW_READING_FORMAT.pack(SYNC, FRAME_RAW_READING, *values, raw_counts & 0xFFFF)
+    return body + CRC_FORMAT.pack(crc16(body))
+
+
+class FrameDecoder:
+    """Splits a mixed byte stream into text lines and binary frames.
+
+    `feed()` returns a list whose items are either `bytes` (one text line,
+    without the line ending), `Reading` or `StoredReading` tuples. Frames
+    with a bad CRC are skipped and counted in `crc_errors`; gaps in the
+    sequence numbers of live readings are counted in `missed`.
+    """
+
+    def __init__(self, max_line=4096):
+        self.buffer = bytearray()
+        self.max_line = max_line
+        self.last_seq = None
+        self.crc_errors = 0
+        self.missed = 0
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        items = []
+        start = 0
+        while start < len(buf):
+            newline = buf.find(b'\n', start)
+            sync = buf.find(SYNC, start, newline if newline >= 0 else len(buf))
+
+            if sync < 0:
+                if newline < 0:
+                    break
+                items.append(bytes(buf[start:newline]).rstrip(b'\r'))
+                start = newline + 1
+                continue
+
+            # Text lines never contain the sync byte, so anything before it
+            # is an unterminated fragment and can be dropped
+            if len(buf) - sync < 2:
+                start = sync
+                break
+            frame_format = FRAME_FORMATS.get(buf[sync + 1])
+            if frame_format is None:
+                start = sync + 1
+                continue
+            if len(buf) - sync < frame_format.size + CRC_FORMAT.size:
+                start = sync
+                break
+
+            end = sync + frame_format.size
+            (crc,) = CRC_FORMAT.unpack_from(buf, end)
+            if crc != crc16(bytes(buf[sync:end])):
+                self.crc_errors += 1
+                start = sync + 1
+                continue
+
+            fields = frame_format.unpack_from(buf, sync)
+            start = end + CRC_FORMAT.size
+            if frame_format is STORED_READING_FORMAT:
+                seq, age_ms, loop, moisture, temperature, humidity, raw_counts = fields[2:]
+                items.append(StoredReading(
+                    seq, age_ms, loop, _from_fixed(moisture), _from_fixed(temperature),
+                    _from_fixed(humidity), None if raw_counts == NO_RAW else raw_counts
+                ))
+                continue
+
+            seq, loop, moisture, temperature, humidity = fields[2:7]
+            if self.last_seq is not None:
+                self.missed += (seq - self.last_seq - 1) & 0xFFFF
+            self.last_seq = seq
+            items.append(Reading(
+                seq, loop, _from_fixed(moisture), _from_fixed(temperature), _from_fixed(humidity),
+                fields[7] if len(fields) > 7 else None
+            ))
+
+        del buf[:start]
+
+        # Never let a missing newline grow the buffer without bound
+        if len(buf) > self.max_line:
+            buf.clear()
+        return items
+
+
+def parse_message(item):
+    """Turn one decoder item into a message dict, or None if it is not useful.
+
+    Readings give 'moisture_percent', 'temperature', 'humidity' and
+    'raw_counts' (None from devices that do not send it; binary frames also
+    carry 'seq' and 'loop'), 'Loop: N' gives {'loop': N} and status lines
+    give {'status': text}. Replayed samples (StoredReading frames or
+    "Stored:" lines) also give 'stored': True, the full 'seq' and 'age_ms'.
+    """
+    if isinstance(item, StoredReading):
+        data = item._asdict()
+        data['stored'] = True
+        return data
+
+    if isinstance(item, Reading):
+        return {
+            'moisture_percent': item.moisture_percent,
+            'temperature': item.temperature,
+            'humidity': item.humidity,
+            'raw_counts': item.raw_counts,
+            'seq': item.seq,
+            'loop': item.loop
+        }
+
+    # latin-1 maps every byte, so a single decode always succeeds
+    line = item.decode('latin-1').strip()
+    if not line or line == 'HB':
+        return None
+
+    if line.startswith('Loop:'):
+        try:
+            return {'loop': int(line[5:])}
+        except ValueError:
+            return None
+
+    if line.startswith(('Started', 'Stopped', 'Complete', 'Mode:', 'Config:', 'Dump:')):
+        return {'status': line}
+
+    if line.startswith('Stored:'):
+        # seq,age_ms,loop,moisture,temperature,humidity,raw with fixed point values
+        try:
+            seq, age_ms, loop, moisture, temperature, humidity, raw_counts = (
+                int(v) for v in line[7:].split(','))
+        except ValueError:
+            return None
+        return parse_message(StoredReading(
+            seq, age_ms, loop, _from_fixed(moisture), _from_fixed(temperature),
+            _from_fixed(humidity), None if raw_counts == NO_RAW else raw_counts
+        ))
+
+    values = line.split(',')
+    if len(values) not in (3, 4):
+        return None
+    try:
+        return {
+            'moisture_percent': float(values[0]),
+            'temperature': float(values[1]),
+            'humidity': float(values[2]),
+            'raw_counts': int(values[3]) if len(values) == 4 else None
+        }
+    except ValueError:
+        return None
+
+
+def _wait_for(reader, accept, timeout):
+    """Return the first queued line for which accept() is true, or None"""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            line = reader.lines.get(timeout=remaining)
+        except queue.Empty:
+            return None
+        if line is None:
+            return None
+        if isinstance(line, bytes) and accept(line):
+            return line
+
+
+def negotiate_binary(reader, write, timeout=1.0):
+    """Ask the device to switch to binary frames.
+
+    Returns True once the device acknowledges. Firmware that does not know
+    the command never answers, in which case the link stays in text mode.
+    Lines received while waiting are discarded.
+    """
+    write(BINARY_COMMAND)
+    return _wait_for(reader, lambda line: line == BINARY_ACK, timeout) is not None
+
+
+def parse_fields(line):
+    """The key=value pairs of a status line as a dict of strings"""
+    if isinstance(line, bytes):
+        line = line.decode('latin-1')
+    values = {}
+    for part in line.split(':', 1)[-1].split():
+        key, _, value = part.partition('=')
+        if value:
+            values[key] = value
+    return values
+
+
+def parse_config(line):
+    """Parse "Config: N=<count> I=<ms>" into (count, interval_ms)"""
+    values = parse_fields(line)
+    try:
+        return int(values['N']), int(values['I'])
+    except (KeyError, ValueError):
+        return None
+
+
+def configure(reader, write, count=None, interval_ms=None, timeout=1.0):
+    """Set the sample count and/or interval and return what the device reports.
+
+    Returns (count, interval_ms), or None if the device did not answer.
+    Lines received while waiting are discarded.
+    """
+    commands = []
+    if count is not None:
+        commands.append(b'N%d\n' % count)
+    if interval_ms is not None:
+        commands.append(b'I%d\n' % interval_ms)
+    if not commands:
+        commands.append(b'Q')
+
+    config = None
+    for command in commands:
+        write(command)
+        line = _wait_for(reader, lambda line: line.startswith(CONFIG_PREFIX), timeout)
+        if line is None:
+            return None
+        config = parse_config(line)
+    return config
+
+
+def run_timeout(count, interval_ms, margin=5.0):
+    """Seconds a run of `count` readings may take, or None for burst mode"""
+    if count <= 0:
+        return None
+    return count * interval_ms / 1000.0 * 1.5 + margin
+
+
+def unwrap_loop(previous, loop):
+    """Extend a loop counter that binary frames carry modulo 256"""
+    if loop > 0xFF:
+        return loop
+    return previous + ((loop - previous) & 0xFF)
+
+
+def unwrap_seq(previous, seq):
+    """Extend a 16-bit live frame sequence number past the previous full one"""
+    return previous + ((seq - previous) & 0xFFFF)
+
+
+def started_seq(status):
+    """Sequence number before a run's first sample from "Started seq=<n>", or None"""
+    try:
+        return int(parse_fields(status.replace('Started', 'Started:', 1))['seq'])
+    except (KeyError, ValueError):
+        return None
+
+
+def catch_up(reader, write, after_seq, timeout=2.0):
+    """Ask the device to replay buffered samples after `after_seq`.
+
+    Returns (items, info): (receive time, item) for every replayed sample
+    up to the closing "Dump:" line, and that line's fields as ints. Live
+    readings in between are left out; the dump goes on until it has
+    replayed those too.
+    Returns None if the device does not answer within `timeout` seconds of
+    silence (older firmware).
+    """
+    write(b'D%d\n' % after_seq)
+    items = []
+    while True:
+        try:
+            item = reader.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if item is None:
+            return None
+        if isinstance(item, bytes) and item.startswith(DUMP_PREFIX):
+            try:
+                info = {k: int(v) for k, v in parse_fields(item).items()}
+            except ValueError:
+                info = {}
+            return items, info
+        data = parse_message(item)
+        if data and data.get('stored'):
+            items.append((datetime.now(), item))
@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+# Local fan-out of live events. Producers call Broker.publish() once per
+# event; every subscriber has its own bounded queue that drops its oldest
+# events when the subscriber falls behind, so a slow dashboard never holds
+# up acquisition or the other subscribers. Subscribers connect over
+#   - a Unix socket (localhost TCP on Windows): one JSON event per line;
+#     send {"topics": ["reading", ...]} at any time to filter
+#   - a localhost WebSocket: one JSON event per text message;
+#     ws://127.0.0.1:8766/?topics=reading,status to filter
+# Every event is a dict with an 'event' key naming its topic.
+
+TOPICS = ('reading', 'progress', 'status', 'connection', 'run')
+PUBSUB_SOCKET = 'moisture-pubsub.sock'  # Unix socket, relative to the working directory
+PUBSUB_HOST = '127.0.0.1'
+PUBSUB_PORT = 8767  # TCP fallback for the line protocol where Unix sockets are missing
+WEBSOCKET_PORT = 8766
+QUEUE_SIZE = 1000  # Events kept per subscriber before the oldest are dropped
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def use_unix_socket():
+    return hasattr(socket, 'AF_UNIX') and sys.platform != 'win32'
+
+
+class Subscriber:
+    """One consumer: a bounded drop-oldest queue drained by its own task"""
+
+    def __init__(self, send, topics=None, maxsize=QUEUE_SIZE):
+        self.send = send  # async callable taking the encoded event (str)
+        self.topics = set(topics) if topics else None
+        self.queue = deque(maxlen=maxsize)
+        self.ready = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.task = None
+
+    def wants(self, topic):
+        return self.topics is None or topic in self.topics
+
+    def offer(self, message):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1  # deque(maxlen) discards the oldest
+        self.queue.append(message)
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                await self.send(self.queue.popleft())
+                self.delivered += 1
+
+
+class Broker:
+    """Publishes events to any number of local subscribers.
+
+    `publish()` must be called on the broker's event loop; threads use
+    `publish_threadsafe()`. Use `start_thread()` to run a broker with its
+    servers on a private loop next to a threaded program such as the GUI.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.connections = {}  # Handler task -> stream writer
+        self.servers = []
+        self.path = None
+        self.published = 0
+        self.loop = None
+        self.thread = None
+
+    def publish(self, event):
+        if not self.subscribers:
+            return
+        self.published += 1
+        message = json.dumps(event)  # Encoded once for every subscriber
+        topic = event.get('event')
+        for subscriber in self.subscribers:
+            if subscriber.wants(topic):
+                subscriber.offer(message)
+
+    def publish_threadsafe(self, event):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish, event)
+
+    def add(self, send, topics=None):
+        subscriber = Subscriber(send, topics, self.maxsize)
+        subscriber.task = asyncio.get_running_loop().create_task(subscriber.run())
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if subscriber.task:
+            subscriber.task.cancel()
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'dropped': sum(s.dropped for s in self.subscribers)
+        }
+
+    async def serve(self, address=None, websocket_port=WEBSOCKET_PORT):
+        """Listen for line and WebSocket subscribers (None disables a listener)"""
+        self.loop = asyncio.get_running_loop()
+        if use_unix_socket():
+            path = address or PUBSUB_SOCKET
+            if os.path.exists(path):
+                os.remove(path)  # Left over from a process that was killed
+            self.servers.append(await asyncio.start_unix_server(self.handle_lines, path))
+            self.path = path
+        else:
+            self.servers.append(await asyncio.start_server(
+                self.handle_lines, PUBSUB_HOST, int(address or PUBSUB_PORT)))
+        if websocket_port is not None:
+            self.servers.append(await asyncio.start_server(
+                self.handle_websocket, PUBSUB_HOST, websocket_port))
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        for subscriber in list(self.subscribers):
+            self.remove(subscriber)
+        for writer in self.connections.values():
+            writer.transport.abort()  # close() would wait for slow clients to read
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start_thread(self, address=None, websocket_port=WEBSOCKET_PORT):
+        """Serve from a background thread; returns once the listeners are up"""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.serve(address, websocket_port))
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            loop.run_forever()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop_thread(self):
+        if self.loop is None or self.thread is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+        future.result(2)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(2)
+
+    async def handle_lines(self, reader, writer):
+        """Line protocol: events out, optional {"topics": [...]} lines in"""
+        async def send(message):
+            writer.write(message.encode() + b'\n')
+            await writer.drain()
+
+        await self.follow(reader, writer, self.add(send))
+
+    async def follow(self, reader, writer, subscriber):
+        """Serve a line-protocol subscriber until it disconnects"""
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    topics = json.loads(line).get('topics')
+                except (ValueError, AttributeError):
+                    continue
+                subscriber.topics = set(topics) if topics else None
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.remove(subscriber)
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def handle_websocket(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        lines = request.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if not key:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            writer.close()
+            return
+
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        target = lines[0].split(' ')[1] if len(lines[0].split(' ')) > 1 else '/'
+        query = parse_qs(urlparse(target).query)
+        topics = ','.join(query.get('topics', [])).split(',') if 'topics' in query else None
+
+        async def send(message):
+            writer.write(websocket_frame(0x1, message.encode()))
+            await writer.drain()
+
+        subscriber = self.add(send, [t for t in topics if t] if topics else None)
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                opcode, payload = await read_websocket_frame(reader)
+                if opcode == 0x8:  # Close
+                    writer.write(websocket_frame(0x8, payload[:2]))
+                    break
+                if opcode == 0x9:  # Ping
+                    writer.write(websocket_frame(0xA, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.remove(subscriber)
+            self.connections.pop(task, None)
+            writer.close()
+
+
+def websocket_frame(opcode, payload):
+    """One unmasked, unfragmented server frame"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(reader):
+    """(opcode, payload) of the next client frame (clients always mask)"""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack('!Q', await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+    payload = bytearray(await reader.readexactly(length))
+    for i in range(length):
+        payload[i] ^= mask[i % 4]
+    return first & 0x0F, bytes(payload)
+
+
+def subscribe(on_event, topics=None, address=None):
+    """Call on_event(event) for every event on a background thread.
+
+    Returns the socket; closing it ends the subscription, after which
+    on_event receives {'event': 'closed'}.
+    """
+    if use_unix_socket():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address or PUBSUB_SOCKET)
+    else:
+        sock = socket.create_connection((PUBSUB_HOST, int(address or PUBSUB_PORT)))
+    stream = sock.makefile('rwb')
+    if topics:
+        stream.write(json.dumps({'topics': list(topics)}).encode() + b'\n')
+        stream.flush()
+
+    def listen():
+        try:
+            for line in stream:
+                on_event(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        on_event({'event': 'closed'})
+
+    thread = threading.Thread(target=listen)
+    thread.daemon = True
+    thread.start()
+    return sock
+
+
+def main():
+    """Print the live event stream (a minimal subscriber)"""
+    parser = argparse.ArgumentParser(description="Print live moisture events")
+    parser.add_argument("--topics", help="Comma separated, e.g. reading,status")
+    parser.add_argument("--socket", help="Pub/sub socket path (TCP port on Windows)")
+    args = parser.parse_args()
+
+    done = threading.Event()
+
+    def show(event):
+        print(json.dumps(event), flush=True)
+        if event['event'] == 'closed':
+            done.set()
+
+    topics = args.topics.split(',') if args.topics else None
+    subscribe(show, topics, args.socket)
+    try:
+        done.wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
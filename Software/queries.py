@@ -0,0 +1,135 @@
+from collections import namedtuple
+from datetime import timedelta
+from sqlalchemy import select, update, insert, func, cast, Integer
+from models import MoistureContent, DataVersion
+
+# Query paths over MoistureContent. Everything filters and orders on
+# date_created (optionally per device), so SQLite can answer from the
+# ix_MoistureContent_date_created / ix_MoistureContent_device_date indexes
+# instead of scanning the table.
+
+Bucket = namedtuple('Bucket', [
+    'time', 'count', 'moisture_avg', 'moisture_min', 'moisture_max',
+    'temperature_avg', 'humidity_avg'
+])
+
+
+def filter_range(stmt, start=None, end=None, device_id=None):
+    """Restrict a MoistureContent select to a device and/or time range"""
+    if device_id is not None:
+        stmt = stmt.where(MoistureContent.device_id == device_id)
+    if start is not None:
+        stmt = stmt.where(MoistureContent.date_created >= start)
+    if end is not None:
+        stmt = stmt.where(MoistureContent.date_created < end)
+    return stmt
+
+
+def data_version_select():
+    """Scalar subquery of DataVersion.version (None until the first change)"""
+    return select(DataVersion.version).where(DataVersion.id == 1).scalar_subquery()
+
+
+def mark_changed(conn):
+    """Bump DataVersion after rows were updated or deleted in place"""
+    bumped = conn.execute(update(DataVersion).where(DataVersion.id == 1)
+                          .values(version=DataVersion.version + 1)).rowcount
+    if not bumped:
+        conn.execute(insert(DataVersion).values(id=1, version=1))
+
+
+def latest_select(n, device_id=None):
+    """SELECT for the newest `n` readings, newest first"""
+    stmt = filter_range(select(MoistureContent), device_id=device_id)
+    return stmt.order_by(MoistureContent.date_created.desc()).limit(n)
+
+
+def latest(session, n, device_id=None):
+    """The newest `n` readings in chronological order"""
+    readings = session.scalars(latest_select(n, device_id)).all()
+    readings.reverse()
+    return readings
+
+
+def between_select(start=None, end=None, device_id=None):
+    """SELECT for readings with start <= date_created < end, oldest first"""
+    stmt = filter_range(select(MoistureContent), start, end, device_id)
+    return stmt.order_by(MoistureContent.date_created)
+
+
+def between(session, start=None, end=None, device_id=None):
+    """Readings with start <= date_created < end in chronological order"""
+    return session.scalars(between_select(start, end, device_id)).all()
+
+
+def count(session, start=None, end=None, device_id=None):
+    """Number of readings in a range"""
+    stmt = filter_range(select(func.count()).select_from(MoistureContent), start, end, device_id)
+    return session.execute(stmt).scalar()
+
+
+def time_bounds(session, device_id=None):
+    """(first, last) date_created, answered from the index"""
+    stmt = filter_range(
+        select(func.min(MoistureContent.date_created), func.max(MoistureContent.date_created)),
+        device_id=device_id
+    )
+    return tuple(session.execute(stmt).one())
+
+
+def downsampled(session, start=None, end=None, buckets=200, device_id=None):
+    """Aggregate a time range into at most `buckets` equal-width windows.
+
+    The bucketing runs in SQL, so only one row per non-empty window is
+    returned no matter how many readings the range holds.
+    """
+    if start is None or end is None:
+        first, last = time_bounds(session, device_id)
+        if first is None:
+            return []
+        start = start or first
+        end = end or last + timedelta(microseconds=1)
+
+    width = max((end - start).total_seconds(), 1e-6) / buckets
+    seconds = (func.julianday(MoistureContent.date_created) - func.julianday(start)) * 86400.0
+    bucket = func.min(cast(seconds / width, Integer), buckets - 1).label('bucket')
+
+    stmt = filter_range(
+        select(
+            bucket,
+            func.count(),
+            func.avg(MoistureContent.moisture_percent),
+            func.min(MoistureContent.moisture_percent),
+            func.max(MoistureContent.moisture_percent),
+            func.avg(MoistureContent.temperature),
+            func.avg(MoistureContent.humidity)
+        ),
+        start, end, device_id
+    ).group_by(bucket).order_by(bucket)
+
+    return [
+        Bucket(start + timedelta(seconds=(row[0] + 0.5) * width), *row[1:])
+        for row in session.execute(stmt)
+    ]
+
+
+def summary(session, start=None, end=None, device_id=None):
+    """Count, mean, min, max and standard deviation per measurement.
+
+    Aggregated in SQL, so the result is one row however large the range.
+    Returns a dict keyed by column name, plus 'count', 'first' and 'last'.
+    """
+    columns = [MoistureContent.moisture_percent, MoistureContent.temperature, MoistureContent.humidity]
+    aggregates = [func.count(), func.min(MoistureContent.date_created), func.max(MoistureContent.date_created)]
+    for column in columns:
+        aggregates += [func.avg(column), func.min(column), func.max(column), func.avg(column * column)]
+
+    row = session.execute(filter_range(select(*aggregates), start, end, device_id)).one()
+    result = {'count': row[0], 'first': row[1], 'last': row[2]}
+    for i, column in enumerate(columns):
+        mean, low, high, mean_sq = row[3 + 4 * i:7 + 4 * i]
+        std = None
+        if mean is not None:
+            std = max(mean_sq - mean * mean, 0.0) ** 0.5
+        result[column.key] = {'mean': mean, 'min': low, 'max': high, 'std': std}
+    return result
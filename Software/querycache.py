@@ -0,0 +1,260 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+from sqlalchemy import select, func
+from models import MoistureContent
+import downsample
+import queries
+import rollups
+import metrics
+
+# Results of the graph and report queries, kept in memory between views so
+# reopening a chart or rebuilding a report over the same window does not
+# re-run its SQL. Entries are keyed by query shape and time range and held
+# in an LRU bounded by their estimated size.
+#
+# The cache is valid up to a watermark: the lowest and highest
+# MoistureContent.id it has seen and DataVersion.version. Before answering,
+# they are compared with the database's (three primary key lookups). Rows
+# added since, by this or any other process, are fetched by id and applied
+# to the entries: an entry whose device and range they fall outside is
+# kept, an open-ended series read from raw rows is extended with them,
+# anything else is dropped and recomputed on its next use. Each entry also
+# keeps the highest id seen before it was computed and is patched from
+# there, since another thread may move the cache's watermark while it
+# computes. A changed lowest id or version means rows were deleted or
+# updated in place (retention, calibration reprocessing), which drops
+# everything.
+
+MAX_BYTES = 32 * 1024 * 1024
+MAX_PATCH_ROWS = 5000  # With more new rows than this, entries are recomputed
+MAX_AGE = 300.0  # Seconds; bounds the drift of patched series
+
+LOOKUPS = metrics.Counter('moisture_query_cache_total', "View query cache lookups", 'result')
+
+
+def _size(value):
+    """Rough memory footprint of a cached result"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_size(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+def _extend_series(points, window=None):
+    """Patch for downsample.series() results: append new points, trim, re-reduce"""
+    def patch(value, rows):
+        times, values = value
+        rows = [row for row in rows if row.moisture_percent is not None]
+        if not rows:
+            return value
+        new_times = np.array([row.date_created for row in rows], dtype='datetime64[ms]')
+        if len(times) and new_times[0] <= times[-1]:
+            return None  # Late rows inside the series (or ones it already has)
+        times = np.concatenate([times, new_times])
+        values = np.concatenate([values, np.array([row.moisture_percent for row in rows],
+                                                  dtype=float)])
+        if window is not None:
+            keep = times >= np.datetime64(datetime.now() - window, 'ms')
+            times, values = times[keep], values[keep]
+        if len(times) > points:
+            x, values = downsample.lttb(times.astype('int64'), values, points)
+            times = x.astype('int64').astype('datetime64[ms]')
+        return times, values
+    return patch
+
+
+def _open_series(start, points, device_id, window=None):
+    """compute() and patch() for an LTTB series up to now.
+
+    Only a series reduced from raw rows is extended: a bucketed one ends at
+    a bucket time rather than its newest reading, so a row committed while
+    it was computed could be appended a second time. It is recomputed
+    instead.
+    """
+    raw = []
+
+    def compute(session):
+        since = start if window is None else datetime.now() - window
+        times, values, from_rows = downsample.lttb_series(session, since, None, points, device_id)
+        raw.append(from_rows)
+        return times, values
+    extend = _extend_series(points, window)
+
+    def patch(value, rows):
+        return extend(value, rows) if raw[-1] else None
+    return compute, patch
+
+
+class Entry:
+    def __init__(self, value, start, end, device_id, patch, watermark):
+        self.value = value
+        self.start = start
+        self.end = end
+        self.device_id = device_id
+        self.patch = patch  # patch(value, new rows) -> value, or None to drop
+        self.watermark = watermark  # Highest MoistureContent.id applied to `value`
+        self.created = time.monotonic()
+        self.size = _size(value)
+
+    def covers(self, row):
+        return ((self.device_id is None or row.device_id == self.device_id)
+                and (self.start is None or row.date_created >= self.start)
+                and (self.end is None or row.date_created < self.end))
+
+
+class QueryCache:
+    """LRU cache of view query results, kept current from new readings.
+
+    Methods mirror the query functions they cache and take the same
+    arguments; results are shared between callers and must not be
+    modified.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.watermark = None  # (lowest, highest MoistureContent.id, DataVersion) applied
+        self.lock = threading.Lock()
+
+    def series(self, session, start=None, end=None, points=1000, device_id=None, method='lttb'):
+        """downsample.series(), extended with new rows while `end` is open"""
+        if end is None and method == 'lttb':
+            compute, patch = _open_series(start, points, device_id)
+        else:
+            patch = None
+
+            def compute(s):
+                return downsample.series(s, start, end, points, device_id, method)
+        return self.get(session, ('series', start, end, points, device_id, method),
+                        compute, start, end, device_id, patch)
+
+    def recent_series(self, session, window, points=1000, device_id=None):
+        """downsample.series() over the last `window` (a timedelta) up to now"""
+        compute, patch = _open_series(None, points, device_id, window)
+        return self.get(session, ('recent_series', window, points, device_id),
+                        compute, None, None, device_id, patch)
+
+    def downsampled(self, session, start=None, end=None, buckets=200, device_id=None):
+        """queries.downsampled()"""
+        return self.get(
+            session, ('downsampled', start, end, buckets, device_id),
+            lambda s: queries.downsampled(s, start, end, buckets, device_id),
+            start, end, device_id
+        )
+
+    def summary(self, session, start=None, end=None, device_id=None):
+        """rollups.summary()"""
+        return self.get(
+            session, ('summary', start, end, device_id),
+            lambda s: rollups.summary(s, start, end, device_id),
+            start, end, device_id
+        )
+
+    def get(self, session, key, compute, start=None, end=None, device_id=None, patch=None):
+        """compute(session) for `key`, answered from memory while still valid.
+
+        `start`, `end` and `device_id` describe which readings the result
+        depends on; `patch(value, rows)` may bring it up to date with new
+        rows instead of dropping it.
+        """
+        with self.lock:
+            self._sync(session)
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry.created <= self.max_age:
+                self.entries.move_to_end(key)
+                LOOKUPS.inc('hit')
+                return entry.value
+            seen = self.watermark
+        LOOKUPS.inc('miss')
+
+        # Rows committed while this runs are newer than `seen` and applied
+        # again by the next sync; series patches drop the entry rather than
+        # append them twice.
+        value = compute(session)
+        with self.lock:
+            # Unless the cache was cleared meanwhile
+            if (self.watermark[0] == seen[0] and self.watermark[1] >= seen[1]
+                    and self.watermark[2] == seen[2]):
+                self._store(key, Entry(value, start, end, device_id, patch, seen[1]))
+        return value
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def _store(self, key, entry):
+        self._discard(key)
+        if entry.size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes += entry.size
+        self._trim()
+
+    def _trim(self):
+        """Drop least recently used entries until the size bound holds"""
+        while self.bytes > self.max_bytes:
+            self._discard(next(iter(self.entries)))
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def _sync(self, session):
+        """Apply the rows added since their watermark to every entry"""
+        # Separate subqueries: SQLite only answers a lone min() or max() from the index
+        low, high, version = session.execute(select(
+            select(func.min(MoistureContent.id)).scalar_subquery(),
+            select(func.max(MoistureContent.id)).scalar_subquery(),
+            queries.data_version_select()
+        )).one()
+        high = high or 0
+        if (self.watermark is None or low != self.watermark[0] or high < self.watermark[1]
+                or version != self.watermark[2]):
+            self._clear()
+            self.watermark = (low, high, version)
+            return
+        self.watermark = (low, high, version)
+        oldest = min((entry.watermark for entry in self.entries.values()), default=high)
+        if oldest >= high:
+            return
+
+        rows = session.execute(
+            select(MoistureContent.id, MoistureContent.date_created, MoistureContent.device_id,
+                   MoistureContent.moisture_percent)
+            .where(MoistureContent.id > oldest, MoistureContent.id <= high)
+            .order_by(MoistureContent.date_created)
+            .limit(MAX_PATCH_ROWS + 1)
+        ).all()
+        if len(rows) > MAX_PATCH_ROWS:
+            self._clear()
+            return
+
+        for key, entry in list(self.entries.items()):
+            relevant = [row for row in rows if row.id > entry.watermark and entry.covers(row)]
+            entry.watermark = high
+            if not relevant:
+                continue
+            value = entry.patch(entry.value, relevant) if entry.patch else None
+            if value is None:
+                self._discard(key)
+                continue
+            LOOKUPS.inc('patched')
+            self.bytes -= entry.size
+            entry.value = value
+            entry.size = _size(value)
+            self.bytes += entry.size
+        self._trim()
@@ -0,0 +1,172 @@
+import argparse
+import io
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from models import setup_database
+from querycache import QueryCache
+
+# Report generation runs in a worker process: the query, the matplotlib
+# rendering and the ReportLab build never touch the GUI thread. Heavy
+# imports happen inside the worker only. The worker lives as long as the
+# ReportService, so its query cache serves repeated reports over the same
+# range from memory.
+
+CHART_BUCKETS = 200  # Min/max band resolution
+CHART_POINTS = 1000  # LTTB points for the moisture line
+TABLE_BUCKETS = 20
+
+caches = {}  # Database URL -> QueryCache of this worker process
+
+
+def _fmt(value, unit=""):
+    if value is None:
+        return "-"
+    return f"{value:.2f}{unit}"
+
+
+def _when(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else "-"
+
+
+def _render_chart(series, line):
+    """Moisture chart (LTTB line over a min/max band) as a PNG buffer"""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 4.5))
+    ax = fig.add_subplot()
+    times = [b.time for b in series]
+    ax.fill_between(times, [b.moisture_min for b in series], [b.moisture_max for b in series],
+                    color='tab:blue', alpha=0.2, label='Min/Max')
+    ax.plot(line[0], line[1], color='tab:blue', linewidth=0.8, label='Moisture')
+    ax.set_title('Moisture Content Over Time')
+    ax.set_ylabel('Moisture (%)')
+    ax.set_xlabel('Time')
+    ax.legend()
+    fig.autofmt_xdate()
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=150)
+    buf.seek(0)
+    return buf
+
+
+def build_report(db_url, path, start=None, end=None, device_id=None):
+    """Build the PDF report; this is the worker process entry point"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+
+    engine, Session = setup_database(db_url)
+    cache = caches.setdefault(db_url, QueryCache())
+    with Session() as session:
+        stats = cache.summary(session, start, end, device_id)
+        series = cache.downsampled(session, start, end, CHART_BUCKETS, device_id)
+        line = cache.series(session, start, end, CHART_POINTS, device_id)
+        windows = cache.downsampled(session, start, end, TABLE_BUCKETS, device_id)
+    engine.dispose()
+
+    doc = SimpleDocTemplate(path, pagesize=letter)
+    styles = getSampleStyleSheet()
+    elements = [Paragraph("Moisture Monitoring Report", styles['Title'])]
+
+    scope = f"{_when(stats['first'])} to {_when(stats['last'])}, {stats['count']} readings"
+    if device_id:
+        scope = f"Device {device_id}: {scope}"
+    elements.append(Paragraph(scope, styles['Normal']))
+    elements.append(Spacer(1, 20))
+
+    if series:
+        img = Image(_render_chart(series, line))
+        img.drawHeight = 300
+        img.drawWidth = 500
+        elements.append(img)
+        elements.append(Spacer(1, 20))
+
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ])
+
+    # Summary statistics
+    data = [['', 'Mean', 'Min', 'Max', 'Std Dev']]
+    for label, key, unit in (('Moisture', 'moisture_percent', '%'),
+                             ('Temperature', 'temperature', '°C'),
+                             ('Humidity', 'humidity', '%')):
+        s = stats[key]
+        data.append([label, _fmt(s['mean'], unit), _fmt(s['min'], unit),
+                     _fmt(s['max'], unit), _fmt(s['std'], unit)])
+    table = Table(data)
+    table.setStyle(table_style)
+    elements.append(table)
+    elements.append(Spacer(1, 20))
+
+    # One row per time window instead of one row per reading
+    if windows:
+        data = [['Window', 'Readings', 'Moisture %', 'Min', 'Max', 'Temperature', 'Humidity']]
+        for b in windows:
+            data.append([
+                _when(b.time), str(b.count), _fmt(b.moisture_avg, '%'),
+                _fmt(b.moisture_min, '%'), _fmt(b.moisture_max, '%'),
+                _fmt(b.temperature_avg, '°C'), _fmt(b.humidity_avg, '%')
+            ])
+        table = Table(data)
+        table.setStyle(table_style)
+        elements.append(table)
+
+    doc.build(elements)
+    return {'path': path, 'count': stats['count']}
+
+
+class ReportService:
+    """Builds reports in a single background worker process.
+
+    `submit()` returns immediately; `on_done(result, error)` is called from a
+    helper thread of this process when the report is finished.
+    """
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self.executor = None
+
+    def submit(self, path, start=None, end=None, device_id=None, on_done=None):
+        if self.executor is None:
+            # Created on first use so the worker is not spawned at startup
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        future = self.executor.submit(build_report, self.db_url, path, start, end, device_id)
+
+        if on_done:
+            def done(f):
+                error = f.exception()
+                on_done(None if error else f.result(), error)
+            future.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a moisture PDF report")
+    parser.add_argument("path")
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--device")
+    args = parser.parse_args()
+    result = build_report("sqlite:///moistureDB.db", args.path, args.start, args.end, args.device)
+    print(f"Report with {result['count']} readings written to {result['path']}")
+
+
+if __name__ == "__main__":
+    main()
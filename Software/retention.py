@@ -0,0 +1,236 @@
+import argparse
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, delete, insert, literal_column
+from models import MoistureContent, Rollup, ArchiveFile, setup_database
+import export
+import archive
+import queries
+
+# Retention for moistureDB.db. Raw readings older than the policy are
+# written to per-month archive files (one new part per month and run),
+# recorded in the ArchiveFile manifest and then deleted in small batches,
+# so the writer is never locked out for long. Freed pages are handed back
+# with incremental_vacuum. Rollups have their own, usually longer, limits.
+
+# Days to keep per table; None keeps forever
+Policy = namedtuple('Policy', ['raw_days', 'minute_days', 'hour_days', 'day_days'],
+                    defaults=(90, 30, None, None))
+
+ARCHIVE_DIR = 'archive'  # Next to the database file unless a directory is given
+DELETE_BATCH = 5000
+VACUUM_PAGES = 2000  # Pages released per incremental_vacuum step
+
+
+def default_format():
+    return 'parquet' if archive.pa is not None else 'csv'
+
+
+def _month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(dt):
+    return (_month_start(dt) + timedelta(days=32)).replace(day=1)
+
+
+def _part_path(archive_dir, month, fmt):
+    ext = {'parquet': 'parquet', 'arrow': 'arrow', 'csv': 'csv.gz'}[fmt]
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    return os.path.join(archive_dir, f"readings-{month:%Y-%m}-{stamp}.{ext}")
+
+
+def _archived_rows(start, end, max_id):
+    return (MoistureContent.date_created >= start, MoistureContent.date_created < end,
+            MoistureContent.id <= max_id)
+
+
+def delete_archived(engine, part, batch_size=DELETE_BATCH):
+    """Delete the rows of one manifest entry in short transactions"""
+    ids = select(MoistureContent.id).where(
+        *_archived_rows(part.start, part.end, part.max_id)
+    ).limit(batch_size)
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            n = conn.execute(delete(MoistureContent).where(MoistureContent.id.in_(ids))).rowcount
+        deleted += n
+        if n < batch_size:
+            break
+    if deleted:
+        with engine.begin() as conn:
+            queries.mark_changed(conn)
+    return deleted
+
+
+def resume(engine):
+    """Finish deletes left over from an interrupted run"""
+    with engine.connect() as conn:
+        pending = conn.execute(select(ArchiveFile.start, ArchiveFile.end, ArchiveFile.max_id)).all()
+    return sum(delete_archived(engine, part) for part in pending)
+
+
+def default_archive_dir(engine):
+    with engine.connect() as conn:
+        return os.path.join(archive.database_dir(conn), ARCHIVE_DIR)
+
+
+def archive_expired(engine, cutoff, archive_dir=None, fmt=None):
+    """Move raw readings older than `cutoff` to archive files, month by month.
+
+    Files are recorded with absolute paths, so they are found from any
+    working directory. Returns the number of rows archived.
+    """
+    fmt = fmt or default_format()
+    archive_dir = os.path.abspath(archive_dir or default_archive_dir(engine))
+    os.makedirs(archive_dir, exist_ok=True)
+    with engine.connect() as conn:
+        first = conn.execute(
+            select(func.min(MoistureContent.date_created)).where(MoistureContent.date_created < cutoff)
+        ).scalar()
+    if first is None:
+        return 0
+
+    archived = 0
+    month = _month_start(first)
+    while month < cutoff:
+        start, end = month, min(_next_month(month), cutoff)
+        with engine.connect() as conn:
+            max_id, expected = conn.execute(
+                select(func.max(MoistureContent.id), func.count()).where(
+                    MoistureContent.date_created >= start, MoistureContent.date_created < end
+                )
+            ).one()
+        if expected:
+            path = _part_path(archive_dir, month, fmt)
+            rows = export.export(engine, path, fmt, start, end, include_archive=False,
+                                 columns=archive.COLUMNS)
+            with engine.connect() as conn:
+                written = conn.execute(
+                    select(func.count()).where(*_archived_rows(start, end, max_id))
+                ).scalar()
+            if rows != written:
+                # Rows arrived for this month while it was being written
+                print(f"Skipping {month:%Y-%m}: range changed during archiving")
+                os.remove(path)
+            else:
+                with engine.begin() as conn:
+                    conn.execute(insert(ArchiveFile).values(
+                        path=path, format=fmt, start=start, end=end, rows=rows,
+                        max_id=max_id, date_created=datetime.now()
+                    ))
+                delete_archived(engine, ArchiveFile(start=start, end=end, max_id=max_id))
+                archived += rows
+        month = _next_month(month)
+    return archived
+
+
+def prune_rollups(engine, policy, now=None, batch_size=DELETE_BATCH):
+    """Delete rollup buckets older than the policy allows"""
+    now = now or datetime.now()
+    deleted = 0
+    for resolution, days in (('minute', policy.minute_days), ('hour', policy.hour_days),
+                             ('day', policy.day_days)):
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=days)
+        rowid = literal_column('rowid')
+        batch = select(rowid).select_from(Rollup).where(
+            Rollup.resolution == resolution, Rollup.bucket_start < cutoff
+        ).limit(batch_size)
+        while True:
+            with engine.begin() as conn:
+                n = conn.execute(delete(Rollup).where(rowid.in_(batch))).rowcount
+            deleted += n
+            if n < batch_size:
+                break
+    if deleted:
+        with engine.begin() as conn:
+            queries.mark_changed(conn)
+    return deleted
+
+
+def incremental_vacuum_enabled(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+
+
+def enable_incremental_vacuum(engine):
+    """Switch an existing file to auto_vacuum=INCREMENTAL.
+
+    Needs one full VACUUM, which locks the database while it runs; files
+    created by setup_database already have it.
+    """
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+def reclaim(engine, pages=VACUUM_PAGES, max_steps=None):
+    """Return free pages to the filesystem a few at a time.
+
+    Returns the number of pages released (0 without incremental auto_vacuum).
+    """
+    if not incremental_vacuum_enabled(engine):
+        print("auto_vacuum is not INCREMENTAL; run 'retention.py enable-vacuum' once")
+        return 0
+    released = 0
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        raw = engine.raw_connection()
+        try:
+            free = raw.cursor().execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                break
+            # The pragma frees one page per step and sqlite3's execute() only
+            # steps once; executescript() runs it to completion
+            raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        finally:
+            raw.close()
+        released += min(free, pages)
+        steps += 1
+    return released
+
+
+def apply(engine, policy=Policy(), archive_dir=None, fmt=None, now=None):
+    """Run a full retention pass and return what it did"""
+    now = now or datetime.now()
+    result = {'resumed': resume(engine), 'archived': 0, 'rollups_deleted': 0}
+    if policy.raw_days is not None:
+        cutoff = now - timedelta(days=policy.raw_days)
+        result['archived'] = archive_expired(engine, cutoff, archive_dir, fmt)
+    result['rollups_deleted'] = prune_rollups(engine, policy, now)
+    result['pages_released'] = reclaim(engine)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive and prune old moisture data")
+    parser.add_argument("command", choices=("run", "list", "enable-vacuum"))
+    parser.add_argument("--raw-days", type=int, default=Policy().raw_days)
+    parser.add_argument("--minute-days", type=int, default=Policy().minute_days)
+    parser.add_argument("--hour-days", type=int, default=Policy().hour_days)
+    parser.add_argument("--day-days", type=int, default=Policy().day_days)
+    parser.add_argument("--archive-dir", help=f"Default: {ARCHIVE_DIR}/ next to the database")
+    parser.add_argument("--format", choices=('parquet', 'arrow', 'csv'))
+    args = parser.parse_args()
+
+    engine, Session = setup_database()
+    if args.command == "enable-vacuum":
+        enable_incremental_vacuum(engine)
+        print("auto_vacuum set to INCREMENTAL")
+    elif args.command == "list":
+        with engine.connect() as conn:
+            for part in archive.parts(conn):
+                print(f"{part.start} - {part.end}  {part.rows:>8} rows  {part.path}")
+            print(f"{queries.count(conn)} readings in the database")
+    else:
+        policy = Policy(args.raw_days, args.minute_days, args.hour_days, args.day_days)
+        result = apply(engine, policy, args.archive_dir, args.format)
+        print(f"Archived {result['archived']} readings, deleted {result['rollups_deleted']} "
+              f"rollup rows, released {result['pages_released']} pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, delete, insert, literal, and_, not_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import MoistureContent, Rollup, ArchiveFile, setup_database
+import queries
+
+# Minute/hour/day rollups of MoistureContent per device. ReadingWriter
+# folds every committed batch into them (same transaction), `backfill()`
+# rebuilds them from raw rows, and `summary()` answers long ranges from a
+# few hundred rollup rows with raw rows only at the ragged edges.
+
+RESOLUTIONS = ('minute', 'hour', 'day')
+STEPS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+# Same text layout SQLAlchemy uses for SQLite DateTime values
+SQL_FORMATS = {
+    'minute': '%Y-%m-%d %H:%M:00.000000',
+    'hour': '%Y-%m-%d %H:00:00.000000',
+    'day': '%Y-%m-%d 00:00:00.000000'
+}
+MEASUREMENTS = (
+    ('moisture', 'moisture_percent'),
+    ('temperature', 'temperature'),
+    ('humidity', 'humidity')
+)
+
+
+def truncate(dt, resolution):
+    """Start of the bucket containing `dt`"""
+    if resolution == 'minute':
+        return dt.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _ceil(dt, resolution):
+    start = truncate(dt, resolution)
+    return start if start == dt else start + STEPS[resolution]
+
+
+def aggregate(rows):
+    """Fold reading dicts (as queued by ReadingWriter) into rollup rows"""
+    buckets = {}
+    for row in rows:
+        device = row.get('device_id') or ''
+        for resolution in RESOLUTIONS:
+            key = (resolution, device, truncate(row['date_created'], resolution))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = {'resolution': resolution, 'device_id': device,
+                          'bucket_start': key[2], 'count': 0}
+                for prefix, _ in MEASUREMENTS:
+                    bucket.update({f'{prefix}_n': 0, f'{prefix}_min': None, f'{prefix}_max': None,
+                                   f'{prefix}_sum': 0.0, f'{prefix}_sumsq': 0.0})
+                buckets[key] = bucket
+            bucket['count'] += 1
+            for prefix, field in MEASUREMENTS:
+                value = row.get(field)
+                if value is None or value != value:  # Missing or NaN
+                    continue
+                bucket[f'{prefix}_n'] += 1
+                bucket[f'{prefix}_sum'] += value
+                bucket[f'{prefix}_sumsq'] += value * value
+                low = bucket[f'{prefix}_min']
+                high = bucket[f'{prefix}_max']
+                bucket[f'{prefix}_min'] = value if low is None else min(low, value)
+                bucket[f'{prefix}_max'] = value if high is None else max(high, value)
+    return list(buckets.values())
+
+
+def apply(session, rows):
+    """Add a batch of readings to the rollups (caller commits)"""
+    buckets = aggregate(rows)
+    if not buckets:
+        return 0
+    stmt = sqlite_insert(Rollup)
+    excluded = stmt.excluded
+    updates = {'count': Rollup.count + excluded.count}
+    for prefix, _ in MEASUREMENTS:
+        for suffix in ('n', 'sum', 'sumsq'):
+            name = f'{prefix}_{suffix}'
+            updates[name] = getattr(Rollup, name) + getattr(excluded, name)
+        # Two-argument min()/max() are scalar in SQLite and return NULL if
+        # either side is NULL, hence the coalesce on both sides
+        for suffix, pick in (('min', func.min), ('max', func.max)):
+            name = f'{prefix}_{suffix}'
+            current, new = getattr(Rollup, name), getattr(excluded, name)
+            updates[name] = pick(func.coalesce(current, new), func.coalesce(new, current))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Rollup.resolution, Rollup.device_id, Rollup.bucket_start],
+        set_=updates
+    )
+    session.execute(stmt, buckets)
+    return len(buckets)
+
+
+def backfill(engine, start=None, end=None, device_id=None):
+    """Rebuild rollups from raw readings.
+
+    The range is widened to whole buckets of each resolution so every
+    affected bucket is rebuilt completely. Buckets overlapping an archived
+    stretch are left alone, since their archived rows are no longer there
+    to rebuild from, and none are rebuilt older than the oldest rollup of
+    that resolution, which retention may have pruned. Run it while nothing
+    is ingesting into the same range. Returns the number of rollup rows
+    written.
+    """
+    columns = ['resolution', 'device_id', 'bucket_start', 'count']
+    for prefix, _ in MEASUREMENTS:
+        columns += [f'{prefix}_n', f'{prefix}_min', f'{prefix}_max', f'{prefix}_sum', f'{prefix}_sumsq']
+
+    written = 0
+    with engine.begin() as conn:
+        # A few rows, one per archived month; a part ending just before
+        # `start` may still share its buckets
+        archived = conn.execute(select(ArchiveFile.start, ArchiveFile.end)).all()
+
+        for resolution in RESOLUTIONS:
+            lo = None if start is None else truncate(start, resolution)
+            hi = None if end is None else _ceil(end, resolution)
+            oldest = conn.scalar(select(func.min(Rollup.bucket_start))
+                                 .where(Rollup.resolution == resolution))
+            if oldest is not None and (lo is None or lo < oldest):
+                lo = oldest
+            if lo is not None and hi is not None and lo >= hi:
+                continue
+            skipped = [(truncate(a, resolution), _ceil(b, resolution)) for a, b in archived]
+
+            cleanup = delete(Rollup).where(Rollup.resolution == resolution)
+            if device_id is not None:
+                cleanup = cleanup.where(Rollup.device_id == device_id)
+            if lo is not None:
+                cleanup = cleanup.where(Rollup.bucket_start >= lo)
+            if hi is not None:
+                cleanup = cleanup.where(Rollup.bucket_start < hi)
+            for a, b in skipped:
+                cleanup = cleanup.where(not_(and_(Rollup.bucket_start >= a, Rollup.bucket_start < b)))
+            conn.execute(cleanup)
+
+            bucket = func.strftime(SQL_FORMATS[resolution], MoistureContent.date_created)
+            device = func.coalesce(MoistureContent.device_id, '')
+            aggregates = [literal(resolution), device, bucket, func.count()]
+            for _, field in MEASUREMENTS:
+                column = getattr(MoistureContent, field)
+                aggregates += [func.count(column), func.min(column), func.max(column),
+                               func.coalesce(func.sum(column), 0.0),
+                               func.coalesce(func.sum(column * column), 0.0)]
+            source = queries.filter_range(select(*aggregates), lo, hi, device_id)
+            for a, b in skipped:
+                source = source.where(not_(and_(MoistureContent.date_created >= a,
+                                                MoistureContent.date_created < b)))
+            source = source.group_by(device, bucket)
+            written += conn.execute(insert(Rollup).from_select(columns, source)).rowcount
+    return written
+
+
+def _plan(start, end, levels=('day', 'hour', 'minute')):
+    """Split [start, end) into (resolution, lo, hi) pieces, coarsest first.
+
+    A resolution of None means the piece is shorter than a minute bucket and
+    has to be read from raw rows.
+    """
+    if start is not None and end is not None and start >= end:
+        return []
+    if not levels:
+        return [(None, start, end)]
+    level, finer = levels[0], levels[1:]
+    lo = None if start is None else _ceil(start, level)
+    hi = None if end is None else truncate(end, level)
+    if lo is not None and hi is not None and lo >= hi:
+        return _plan(start, end, finer)
+    head = [] if start is None else _plan(start, lo, finer)
+    tail = [] if end is None else _plan(hi, end, finer)
+    return head + [(level, lo, hi)] + tail
+
+
+def _rollup_totals(session, resolution, lo, hi, device_id):
+    aggregates = [func.sum(Rollup.count)]
+    for prefix, _ in MEASUREMENTS:
+        aggregates += [
+            func.sum(getattr(Rollup, f'{prefix}_n')),
+            func.min(getattr(Rollup, f'{prefix}_min')),
+            func.max(getattr(Rollup, f'{prefix}_max')),
+            func.sum(getattr(Rollup, f'{prefix}_sum')),
+            func.sum(getattr(Rollup, f'{prefix}_sumsq'))
+        ]
+    stmt = select(*aggregates).where(Rollup.resolution == resolution)
+    if device_id is not None:
+        stmt = stmt.where(Rollup.device_id == device_id)
+    if lo is not None:
+        stmt = stmt.where(Rollup.bucket_start >= lo)
+    if hi is not None:
+        stmt = stmt.where(Rollup.bucket_start < hi)
+    return session.execute(stmt).one()
+
+
+def _raw_totals(session, lo, hi, device_id):
+    aggregates = [func.count()]
+    for _, field in MEASUREMENTS:
+        column = getattr(MoistureContent, field)
+        aggregates += [func.count(column), func.min(column), func.max(column),
+                       func.sum(column), func.sum(column * column)]
+    return session.execute(queries.filter_range(select(*aggregates), lo, hi, device_id)).one()
+
+
+def _edge(session, start, end, device_id, newest):
+    order = MoistureContent.date_created.desc() if newest else MoistureContent.date_created
+    stmt = queries.filter_range(select(MoistureContent.date_created), start, end, device_id)
+    return session.execute(stmt.order_by(order).limit(1)).scalar()
+
+
+def summary(session, start=None, end=None, device_id=None):
+    """Same result as queries.summary(), computed from the rollups"""
+    count = 0
+    totals = {field: [0, None, None, 0.0, 0.0] for _, field in MEASUREMENTS}
+    for resolution, lo, hi in _plan(start, end):
+        if resolution is None:
+            row = _raw_totals(session, lo, hi, device_id)
+        else:
+            row = _rollup_totals(session, resolution, lo, hi, device_id)
+        count += row[0] or 0
+        for i, (_, field) in enumerate(MEASUREMENTS):
+            n, low, high, total, total_sq = row[1 + 5 * i:6 + 5 * i]
+            acc = totals[field]
+            acc[0] += n or 0
+            if low is not None:
+                acc[1] = low if acc[1] is None else min(acc[1], low)
+                acc[2] = high if acc[2] is None else max(acc[2], high)
+            acc[3] += total or 0.0
+            acc[4] += total_sq or 0.0
+
+    result = {
+        'count': count,
+        'first': _edge(session, start, end, device_id, newest=False),
+        'last': _edge(session, start, end, device_id, newest=True)
+    }
+    for field, (n, low, high, total, total_sq) in totals.items():
+        mean = std = None
+        if n:
+            mean = total / n
+            std = max(total_sq / n - mean * mean, 0.0) ** 0.5
+        result[field] = {'mean': mean, 'min': low, 'max': high, 'std': std}
+    return result
+
+
+def buckets(session, resolution, start=None, end=None, device_id=None):
+    """Rollup buckets as queries.Bucket tuples, summed across devices"""
+    n = func.sum(Rollup.moisture_n)
+    stmt = select(
+        Rollup.bucket_start,
+        func.sum(Rollup.count),
+        func.sum(Rollup.moisture_sum) / func.nullif(n, 0),
+        func.min(Rollup.moisture_min),
+        func.max(Rollup.moisture_max),
+        func.sum(Rollup.temperature_sum) / func.nullif(func.sum(Rollup.temperature_n), 0),
+        func.sum(Rollup.humidity_sum) / func.nullif(func.sum(Rollup.humidity_n), 0)
+    ).where(Rollup.resolution == resolution)
+    if device_id is not None:
+        stmt = stmt.where(Rollup.device_id == device_id)
+    if start is not None:
+        stmt = stmt.where(Rollup.bucket_start >= truncate(start, resolution))
+    if end is not None:
+        stmt = stmt.where(Rollup.bucket_start < end)
+    stmt = stmt.group_by(Rollup.bucket_start).order_by(Rollup.bucket_start)
+    return [queries.Bucket(*row) for row in session.execute(stmt)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain moisture rollup tables")
+    parser.add_argument("command", choices=("backfill", "summary"))
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--device")
+    args = parser.parse_args()
+
+    engine, Session = setup_database()
+    if args.command == "backfill":
+        rows = backfill(engine, args.start, args.end, args.device)
+        print(f"Rebuilt {rows} rollup rows")
+    else:
+        with Session() as session:
+            stats = summary(session, args.start, args.end, args.device)
+        print(f"{stats['count']} readings from {stats['first']} to {stats['last']}")
+        for _, field in MEASUREMENTS:
+            s = stats[field]
+            print(f"{field}: mean={s['mean']} min={s['min']} max={s['max']} std={s['std']}")
+
+
+if __name__ == "__main__":
+    main()
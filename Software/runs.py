@@ -0,0 +1,250 @@
+import argparse
+from datetime import datetime
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
+from models import MeasurementRun, MoistureContent, setup_database
+import log
+
+# Stored measurement runs. A run row is created when the device confirms
+# the start, readings reference it through MoistureContent.run_id, and the
+# result is written once when the run ends, so views never have to
+# recompute it from the raw readings. Listing and comparing runs only
+# reads MeasurementRun, ordered by the (device_id|grain_lot, started)
+# indexes.
+#
+# The acquisition programs go through open_run() and close_run(), which
+# report database errors instead of raising: a run whose start could not
+# be stored is still recorded when it ends. Rows left 'running' by a
+# program that crashed are marked interrupted by sweep(), when the device
+# is first seen again and before each new run.
+
+RUNNING = 'running'
+COMPLETE = 'complete'
+INCOMPLETE = 'incomplete'  # Stopped early or timed out
+INTERRUPTED = 'interrupted'  # The link or the program went away
+STATUSES = (RUNNING, COMPLETE, INCOMPLETE, INTERRUPTED)
+
+
+def start(Session, device_id, started, grain_lot=None, sample_count=None, interval_ms=None):
+    """Create the row of a run that has just started and return its id"""
+    run = MeasurementRun(
+        device_id=device_id,
+        grain_lot=grain_lot or None,
+        started=started,
+        status=RUNNING,
+        sample_count=sample_count,
+        interval_ms=interval_ms
+    )
+    with Session() as session:
+        session.add(run)
+        session.commit()
+        return run.id
+
+
+def record(Session, device_id, started, finished, result, status=COMPLETE, run_id=None):
+    """Store a finished run from a ReadingFilter.result() and return its id.
+
+    With `run_id` the row created by start() is completed, otherwise a new
+    row is added (e.g. when the start could not be stored).
+    """
+    moisture = result['moisture_percent']
+    values = dict(
+        finished=finished,
+        status=status,
+        readings=moisture['n'],
+        rejected=moisture['rejected'],
+        moisture_median=moisture['median'],
+        moisture_mean=moisture['mean'],
+        moisture_std=moisture['std'],
+        moisture_ci95=moisture['ci95'],
+        temperature_mean=result['temperature']['mean'],
+        humidity_mean=result['humidity']['mean']
+    )
+    with Session() as session:
+        if run_id is not None:
+            session.execute(update(MeasurementRun).where(MeasurementRun.id == run_id)
+                            .values(**values))
+            session.commit()
+            return run_id
+        run = MeasurementRun(device_id=device_id, started=started, **values)
+        session.add(run)
+        session.commit()
+        return run.id
+
+
+def sweep(Session, device_id=None, keep=None):
+    """Mark runs still 'running' (left by a crash) as interrupted.
+
+    Only the device's runs with `device_id`; `keep` is a run id that is
+    really still going. Returns the number of runs closed.
+    """
+    stmt = update(MeasurementRun).where(MeasurementRun.status == RUNNING)
+    if device_id is not None:
+        stmt = stmt.where(MeasurementRun.device_id == device_id)
+    if keep is not None:
+        stmt = stmt.where(MeasurementRun.id != keep)
+    try:
+        with Session() as session:
+            closed = session.execute(stmt.values(status=INTERRUPTED)).rowcount
+            session.commit()
+    except SQLAlchemyError as e:
+        log.warning('run_sweep_failed', device=device_id, error=str(e))
+        return 0
+    if closed:
+        log.info('runs_interrupted', device=device_id, runs=closed)
+    return closed
+
+
+def open_run(Session, device_id, started, grain_lot=None, sample_count=None, interval_ms=None):
+    """start() for a run a device just confirmed; None if it could not be stored"""
+    try:
+        sweep(Session, device_id)  # A device runs one acquisition at a time
+        return start(Session, device_id, started, grain_lot, sample_count, interval_ms)
+    except SQLAlchemyError as e:
+        log.warning('run_start_failed', device=device_id, error=str(e))
+        return None
+
+
+def close_run(Session, device_id, started, result, status=COMPLETE, run_id=None, finished=None):
+    """record() for a run that just ended; returns the id, or None if it could not be stored"""
+    try:
+        return record(Session, device_id, started, finished or datetime.now(), result,
+                      status, run_id)
+    except SQLAlchemyError as e:
+        log.warning('run_result_failed', device=device_id, run=run_id, error=str(e))
+        return None
+
+
+def list_runs(session, device_id=None, grain_lot=None, status=None, start=None, end=None,
+              limit=100, offset=0):
+    """Stored runs, newest first, optionally filtered"""
+    stmt = select(MeasurementRun)
+    if device_id is not None:
+        stmt = stmt.where(MeasurementRun.device_id == device_id)
+    if grain_lot is not None:
+        stmt = stmt.where(MeasurementRun.grain_lot == grain_lot)
+    if status is not None:
+        stmt = stmt.where(MeasurementRun.status == status)
+    if start is not None:
+        stmt = stmt.where(MeasurementRun.started >= start)
+    if end is not None:
+        stmt = stmt.where(MeasurementRun.started < end)
+    stmt = stmt.order_by(MeasurementRun.started.desc()).limit(limit).offset(offset)
+    return session.scalars(stmt).all()
+
+
+def compare(session, run_ids):
+    """Stored results of `run_ids` side by side, relative to the first one.
+
+    Each entry has the run, its difference in mean moisture from the first
+    run and whether their 95% intervals are disjoint (a real difference).
+    """
+    found = {run.id: run for run in session.scalars(
+        select(MeasurementRun).where(MeasurementRun.id.in_(run_ids)))}
+    ordered = [found[run_id] for run_id in run_ids if run_id in found]
+    if not ordered:
+        return []
+    reference = ordered[0]
+    compared = []
+    for run in ordered:
+        difference = None
+        significant = None
+        if run.moisture_mean is not None and reference.moisture_mean is not None:
+            difference = run.moisture_mean - reference.moisture_mean
+            if run.moisture_ci95 is not None and reference.moisture_ci95 is not None:
+                significant = abs(difference) > run.moisture_ci95 + reference.moisture_ci95
+        compared.append({'run': run, 'difference': difference, 'significant': significant})
+    return compared
+
+
+def readings(session, run_id):
+    """The stored readings of one run in order, archived ones included.
+
+    Archived readings come back as MoistureContent objects that are not
+    part of the session.
+    """
+    import archive  # Only needed here; keeps pyarrow out of GUI startup
+
+    stmt = (select(MoistureContent).where(MoistureContent.run_id == run_id)
+            .order_by(MoistureContent.date_created))
+    found = session.scalars(stmt).all()
+    run = session.get(MeasurementRun, run_id)
+    if run is None:
+        return found
+    archived = []
+    for chunk in archive.iter_archived(session.connection(), run.started, None, run.device_id):
+        for row in chunk:
+            values = dict(zip(archive.HEADER, row))
+            if values['run_id'] != run_id:
+                continue
+            reading = MoistureContent(values['moisture_percent'], values['temperature'],
+                                      values['humidity'], values['device_id'],
+                                      values['raw_counts'], run_id)
+            reading.id = values['id']
+            reading.date_created = values['timestamp']
+            reading.seq = values['seq']
+            archived.append(reading)
+    if not archived:
+        return found
+    return sorted(archived + list(found), key=lambda reading: reading.date_created)
+
+
+def _describe_moisture(median, mean, ci95):
+    text = f"{median:.2f}%"
+    if ci95 is not None:
+        text += f" (mean {mean:.2f} ± {ci95:.2f})"
+    return text
+
+
+def describe(result):
+    """Short text form of a run result, e.g. for status lines"""
+    moisture = result['moisture_percent']
+    if moisture['median'] is None:
+        return "no valid readings"
+    text = _describe_moisture(moisture['median'], moisture['mean'], moisture['ci95'])
+    text += f" n={moisture['n']}"
+    if moisture['rejected']:
+        text += f", {moisture['rejected']} rejected"
+    return text
+
+
+def describe_run(run):
+    """One line for a stored run"""
+    if run.moisture_mean is None:
+        result = "no valid readings"
+    else:
+        # Runs stored before medians were kept show their mean
+        median = run.moisture_mean if run.moisture_median is None else run.moisture_median
+        result = _describe_moisture(median, run.moisture_mean, run.moisture_ci95)
+    return (f"#{run.id:<6} {run.started:%Y-%m-%d %H:%M:%S}  {run.device_id or '-':<16} "
+            f"{run.grain_lot or '-':<12} {run.status:<11} {run.readings:>5} readings  {result}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List and compare stored measurement runs")
+    parser.add_argument("--device")
+    parser.add_argument("--lot")
+    parser.add_argument("--status", choices=STATUSES)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--compare", type=int, nargs='+', metavar="RUN_ID",
+                        help="Compare runs with the first one given")
+    parser.add_argument("--db", default="sqlite:///moistureDB.db")
+    args = parser.parse_args()
+
+    engine, Session = setup_database(args.db)
+    with Session() as session:
+        if args.compare:
+            for entry in compare(session, args.compare):
+                line = describe_run(entry['run'])
+                if entry['difference'] is not None and entry['run'].id != args.compare[0]:
+                    line += f"  {entry['difference']:+.2f}"
+                    if entry['significant']:
+                        line += " (significant)"
+                print(line)
+        else:
+            for run in list_runs(session, args.device, args.lot, args.status, limit=args.limit):
+                print(describe_run(run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import queue
+import threading
+import time
+import serial
+import serial.tools.list_ports
+from protocol import FrameDecoder
+from metrics import LINES_READ, BYTES_READ, READ_WAIT, QUEUE_DEPTH
+
+# Liveness: the firmware prints HEARTBEAT after HEARTBEAT_INTERVAL seconds
+# without other output. Any traffic counts as proof of life; the host only
+# sends PROBE_COMMAND after SILENCE_WINDOW seconds of silence, and gives up
+# PROBE_GRACE seconds after that.
+HEARTBEAT = b'HB'
+HEARTBEAT_INTERVAL = 1.0
+PROBE_COMMAND = b'P'
+SILENCE_WINDOW = 3.0
+PROBE_GRACE = 2.0
+
+
+def find_esp32_ports():
+    """Return port info for every port that looks like a USB serial board"""
+    found = []
+    for port in serial.tools.list_ports.comports():
+        description = (port.description or "").upper()
+        if "USB" in description or "SERIAL" in description:
+            found.append(port)
+    return found
+
+
+def port_identity(info):
+    """Device ID of a listed port: the board's USB serial number, else the port name"""
+    return info.serial_number or info.device
+
+
+def device_identity(port):
+    """Device ID for `port`, the same whichever program connects to it.
+
+    Calibration, rollups and run history are kept per device ID, so the
+    controller, the GUI, the hub and the daemon must all agree on it.
+    """
+    for info in serial.tools.list_ports.comports():
+        if info.device == port:
+            return port_identity(info)
+    return port
+
+
+def open_serial(port, baudrate=115200, timeout=0.5):
+    """Open a port without pulsing DTR/RTS.
+
+    On most ESP32 boards those lines drive EN and IO0, so a plain open
+    resets the board and wipes the samples buffered while it was offline.
+    """
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = baudrate
+    ser.timeout = timeout
+    ser.dtr = False
+    ser.rts = False
+    ser.open()
+    return ser
+
+
+class SerialReader:
+    """Background thread that reads everything available from a serial port.
+
+    The thread blocks on the port (up to the port's own timeout) instead of
+    polling, splits the bytes into text lines and binary frames with a
+    FrameDecoder and puts them on `lines`. The queue is bounded; when a
+    consumer falls behind the oldest item is dropped. A `None` is queued when the port fails so blocked consumers wake up, and
+    the exception is kept in `error`. Heartbeat lines only refresh
+    `last_rx` and are never queued.
+
+    If `on_item` is given, items (and the final `None`) are passed to it on
+    the reader thread instead of being queued. Reads are recorded in the
+    metrics under `device` (the port name by default).
+    """
+
+    def __init__(self, ser, maxsize=10000, on_item=None, device=None):
+        self.ser = ser
+        self.on_item = on_item
+        self.device = device or getattr(ser, 'port', None)
+        self.lines = queue.Queue(maxsize=maxsize)
+        self.decoder = FrameDecoder()
+        self.error = None
+        self.dropped = 0
+        self.last_rx = time.monotonic()
+        self.probe_sent = False
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        QUEUE_DEPTH.track(self.lines.qsize, f"reader:{self.device}")
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=2):
+        """Stop reading (the caller still owns and closes the port)"""
+        self.running = False
+        QUEUE_DEPTH.untrack(f"reader:{self.device}")
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def drain(self):
+        """Discard any lines that have not been consumed yet"""
+        while True:
+            try:
+                self.lines.get_nowait()
+            except queue.Empty:
+                return
+
+    def _put(self, line):
+        if self.on_item:
+            self.on_item(line)
+            return
+        while True:
+            try:
+                self.lines.put_nowait(line)
+                return
+            except queue.Full:
+                try:
+                    self.lines.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while self.running:
+            try:
+                # Block for the first byte, then take whatever else is waiting
+                started = time.perf_counter()
+                data = self.ser.read(self.ser.in_waiting or 1)
+                READ_WAIT.observe(time.perf_counter() - started, self.device)
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                if self.running:
+                    self.error = e
+                    self.running = False
+                    self._put(None)
+                return
+
+            if data:
+                self.last_rx = time.monotonic()
+                BYTES_READ.inc(self.device, len(data))
+                for item in self.decoder.feed(data):
+                    if item != HEARTBEAT:
+                        LINES_READ.inc(self.device)
+                        self._put(item)
+
+    def silence(self):
+        """Seconds since any byte was received"""
+        return time.monotonic() - self.last_rx
+
+    def liveness(self):
+        """Liveness state for the connection monitor.
+
+        Returns 'alive' while traffic is recent, 'probe' exactly once when
+        the silence window is first exceeded (the caller should then write
+        PROBE_COMMAND), and 'dead' once the port has failed or the device
+        stayed silent through the probe grace period.
+        """
+        if self.error:
+            return 'dead'
+        silence = self.silence()
+        if silence < SILENCE_WINDOW:
+            self.probe_sent = False
+            return 'alive'
+        if silence > SILENCE_WINDOW + PROBE_GRACE:
+            return 'dead'
+        if not self.probe_sent:
+            self.probe_sent = True
+            return 'probe'
+        return 'alive'
@@ -0,0 +1,304 @@
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+from serial_reader import HEARTBEAT_INTERVAL
+from protocol import encode_reading, encode_stored_reading, _to_fixed, NO_RAW
+
+COUNTS_PER_PERCENT = 18  # Raw count noise per % of moisture noise (default calibration span)
+MAX_CATCH_UP = 1000  # Samples emitted at once when the loop fell behind its schedule
+
+
+class FakeDevice:
+    """Simulated ESP32 on a pseudo-terminal (POSIX only).
+
+    Speaks the same protocol as Firmware/src/main.cpp, so host code can be
+    pointed at `port` instead of a real board. `mute()` stops all output
+    (a hung board) and `unplug()` closes the pty (a pulled USB cable).
+    With `raw_counts` set it behaves like current firmware and sends raw
+    sensor counts with a NaN moisture; without it, like older firmware.
+    Every sample goes to a ring buffer that "D<seq>" replays; `drop()`
+    loses the link in both directions while sampling goes on, `resume()`
+    brings it back.
+
+    For soak tests and benchmarks: `noise` adds Gaussian noise (standard
+    deviation in each channel's unit), `corrupt_rate` is the probability
+    that a write has one byte flipped, and `drop_every` drops the link for
+    `drop_for` seconds at random, on average every `drop_every` seconds.
+    With `track_latency`, `sent_at` maps each sample's sequence number to
+    the time.monotonic() at which it was written.
+    """
+
+    def __init__(self, total_loops=5, interval=2.0, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 moisture_percent=50.15, temperature=25.0, humidity=60.0, raw_counts=None,
+                 buffer_capacity=2048, noise=0.0, corrupt_rate=0.0, drop_every=None,
+                 drop_for=2.0, seed=None, track_latency=False):
+        self.total_loops = total_loops
+        self.interval = interval
+        self.heartbeat_interval = heartbeat_interval
+        self.moisture_percent = moisture_percent
+        self.temperature = temperature
+        self.humidity = humidity
+        self.raw_counts = raw_counts
+        self.noise = noise
+        self.corrupt_rate = corrupt_rate
+        self.drop_every = drop_every
+        self.drop_for = drop_for
+        self.random = random.Random(seed)
+        self.sent_at = {} if track_latency else None
+        self.corrupted = 0
+        self.drops = 0
+        self.cpu_time = 0.0  # Thread CPU seconds used by the simulator itself
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.is_running = False
+        self.loop_counter = 0
+        self.muted = False
+        self.binary_mode = False
+        self.sample_seq = 0
+        self.ring = deque(maxlen=buffer_capacity)  # (seq, taken, loop, values...)
+        self.link_down = False
+        self.pending_command = None  # N or I waiting for its digits
+        self.argument = b''
+        self.received = bytearray()  # Every byte the host has sent
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_sample = 0.0
+        self.last_tx = time.monotonic()
+        self.next_drop = None
+        self.resume_at = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(2)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def drop(self):
+        """Lose the link: nothing is sent or received, sampling continues"""
+        self.link_down = True
+
+    def resume(self):
+        self.link_down = False
+
+    def mute(self, muted=True):
+        """Stop (or resume) all output, including heartbeats"""
+        self.muted = muted
+
+    def unplug(self):
+        """Close the device side so the host sees the port fail"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(2)
+        os.close(self.master)
+
+    def println(self, text):
+        self.write(text.encode() + b'\r\n')
+
+    def write(self, data):
+        if self.muted or self.link_down:
+            return
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            data = bytearray(data)
+            data[self.random.randrange(len(data))] ^= 1 << self.random.randrange(8)
+            self.corrupted += 1
+        os.write(self.master, data)
+        self.last_tx = time.monotonic()
+
+    def handle_byte(self, byte):
+        """Mimic the firmware's Serial.read()/parseInt() command handling"""
+        if self.pending_command:
+            if byte.isdigit():
+                self.argument += byte
+                return
+            self.handle_argument(self.pending_command, int(self.argument or b'-1'))
+            self.pending_command = None
+        if byte in (b'N', b'I', b'D'):
+            self.pending_command = byte
+            self.argument = b''
+            return
+        self.handle_command(byte)
+
+    def handle_argument(self, command, value):
+        if command == b'N' and value >= 0:
+            self.total_loops = value
+        elif command == b'I' and value >= 10:
+            self.interval = value / 1000.0
+        elif command == b'D':
+            self.dump(max(value, 0))
+            return
+        self.report_config()
+
+    def dump(self, after):
+        """Replay buffered samples after `after`, like the firmware's D command"""
+        if after > self.sample_seq:
+            after = 0  # The host knew a sequence we never produced
+        now = time.monotonic()
+        sent = 0
+        for seq, taken, loop, moisture, temperature, humidity, raw in list(self.ring):
+            if seq <= after:
+                continue
+            age_ms = int((now - taken) * 1000)
+            if self.binary_mode:
+                self.write(encode_stored_reading(seq, age_ms, loop, moisture, temperature,
+                                                 humidity, raw))
+            else:
+                self.println(f"Stored: {seq},{age_ms},{loop},{_to_fixed(moisture)},"
+                             f"{_to_fixed(temperature)},{_to_fixed(humidity)},"
+                             f"{NO_RAW if raw is None else raw}")
+            sent += 1
+        self.println(f"Dump: sent={sent} seq={self.sample_seq} loop={self.loop_counter} "
+                     f"running={int(self.is_running)}")
+
+    def report_config(self):
+        self.println(f"Config: N={self.total_loops} I={int(round(self.interval * 1000))}")
+
+    def handle_command(self, command):
+        if command == b'S':
+            self.is_running = True
+            self.loop_counter = 0
+            self.last_sample = time.monotonic() - self.interval
+            self.println(f"Started seq={self.sample_seq}")
+        elif command == b'X':
+            self.is_running = False
+            self.println("Stopped")
+        elif command == b'P':
+            self.println("HB")
+        elif command == b'B':
+            self.binary_mode = True
+            self.println("Mode: binary")
+        elif command == b'T':
+            self.binary_mode = False
+            self.println("Mode: text")
+        elif command == b'Q':
+            self.report_config()
+
+    def jitter(self, value, scale=1.0):
+        if not self.noise:
+            return value
+        return value + self.random.gauss(0.0, self.noise * scale)
+
+    def sample(self):
+        """One reading as sent by the firmware: (moisture, temperature, humidity, raw counts)"""
+        temperature = self.jitter(self.temperature)
+        humidity = self.jitter(self.humidity)
+        if self.raw_counts is not None:
+            raw = int(round(self.jitter(self.raw_counts, COUNTS_PER_PERCENT)))
+            return float('nan'), temperature, humidity, min(max(raw, 0), 4095)
+        return self.jitter(self.moisture_percent), temperature, humidity, None
+
+    def emit_sample(self):
+        moisture_percent, temperature, humidity, raw_counts = self.sample()
+        self.loop_counter += 1
+        self.sample_seq += 1
+        self.ring.append((self.sample_seq, time.monotonic(), self.loop_counter,
+                          moisture_percent, temperature, humidity, raw_counts))
+        if self.sent_at is not None:
+            self.sent_at[self.sample_seq] = time.monotonic()
+        if self.binary_mode:
+            self.write(encode_reading(self.sample_seq, self.loop_counter & 0xFF,
+                                      moisture_percent, temperature, humidity, raw_counts))
+        else:
+            line = f"{moisture_percent:.2f},{temperature:.2f},{humidity:.2f}"
+            if raw_counts is not None:
+                line += f",{raw_counts}"
+            self.println(line)
+            self.println(f"Loop: {self.loop_counter}")
+        if self.total_loops and self.loop_counter >= self.total_loops:
+            self.is_running = False
+            self.println(f"Complete: Finished {self.total_loops} loops")
+
+    def schedule_drops(self, now):
+        """Automatic link drops for `drop_every`"""
+        if self.resume_at is not None and now >= self.resume_at:
+            self.resume_at = None
+            self.resume()
+        if self.drop_every is None:
+            return
+        if self.next_drop is None:
+            self.next_drop = now + self.random.expovariate(1.0 / self.drop_every)
+        elif now >= self.next_drop and self.resume_at is None:
+            self.drops += 1
+            self.drop()
+            self.resume_at = now + self.drop_for
+            self.next_drop = None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            wait = 0.01
+            if self.is_running:
+                wait = min(wait, max(0.0, self.last_sample + self.interval - now))
+            readable, _, _ = select.select([self.master], [], [], wait)
+            if readable:
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError:
+                    return
+                if not self.link_down:
+                    self.received += data
+                    for i in range(len(data)):
+                        self.handle_byte(data[i:i + 1])
+
+            now = time.monotonic()
+            self.schedule_drops(now)
+            # Keep to the schedule even when one pass of the loop is slower
+            # than the interval, like the firmware's millis() check
+            emitted = 0
+            while (self.is_running and (self.total_loops == 0 or self.loop_counter < self.total_loops)
+                   and now - self.last_sample >= self.interval):
+                if emitted == MAX_CATCH_UP:
+                    self.last_sample = now  # Too far behind, start the schedule over
+                    break
+                self.last_sample += self.interval
+                self.emit_sample()
+                emitted += 1
+
+            if now - self.last_tx >= self.heartbeat_interval:
+                self.println("HB")
+                self.last_tx = now
+            self.cpu_time = time.thread_time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated ESP32 moisture sensor on a pty")
+    parser.add_argument("--loops", type=int, default=5, help="Readings per run (0 = burst)")
+    parser.add_argument("--rate", type=float, default=0.5, help="Samples per second")
+    parser.add_argument("--noise", type=float, default=0.0)
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Probability a write is corrupted")
+    parser.add_argument("--drop-every", type=float, help="Mean seconds between link drops")
+    parser.add_argument("--drop-for", type=float, default=2.0)
+    parser.add_argument("--raw", type=int, default=2300, help="Raw counts to send (-1: percent only)")
+    args = parser.parse_args()
+
+    device = FakeDevice(total_loops=args.loops, interval=1.0 / args.rate,
+                        raw_counts=None if args.raw < 0 else args.raw, noise=args.noise,
+                        corrupt_rate=args.corrupt, drop_every=args.drop_every,
+                        drop_for=args.drop_for).start()
+    print(f"Simulated ESP32 on {device.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        device.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import time
+import tkinter as tk
+import metrics
+
+
+class StatsPanel:
+    """A small window with the live acquisition metrics of this process.
+
+    Refreshes every `refresh_ms` from the metrics registry; rates are the
+    change since the previous refresh, latencies are estimated from the
+    histograms since startup.
+    """
+
+    def __init__(self, root, refresh_ms=1000, on_close=None):
+        self.top = tk.Toplevel(root)
+        self.top.title("Acquisition Stats")
+        self.top.protocol("WM_DELETE_WINDOW", self.close)
+        self.refresh_ms = refresh_ms
+        self.on_close = on_close
+
+        self.text = tk.Label(self.top, justify='left', anchor='nw', font=("Courier", 10))
+        self.text.pack(fill='both', expand=True, padx=10, pady=10)
+
+        self.previous = None
+        self._refresh()
+
+    def lift(self):
+        self.top.lift()
+
+    def close(self):
+        self.top.after_cancel(self.job)
+        self.top.destroy()
+        if self.on_close:
+            self.on_close(self)
+
+    def _refresh(self):
+        self.text.config(text="\n".join(self.lines()))
+        self.job = self.top.after(self.refresh_ms, self._refresh)
+
+    def lines(self):
+        now = time.monotonic()
+        totals = {
+            'lines': metrics.LINES_READ.collect(),
+            'bytes': metrics.BYTES_READ.collect(),
+            'rows': metrics.ROWS_COMMITTED.collect()
+        }
+        previous, self.previous = self.previous, (now, totals)
+
+        def rate(kind, key):
+            if previous is None or now <= previous[0]:
+                return 0.0
+            return (totals[kind].get(key, 0) - previous[1][kind].get(key, 0)) / (now - previous[0])
+
+        def ms(histogram, fraction, key=None):
+            value = histogram.quantile(fraction, key)
+            return "-" if value is None else f"{value * 1000:.2f}"
+
+        failures = metrics.PARSE_FAILURES.collect()
+        reconnects = metrics.RECONNECTS.collect()
+        lines = []
+        for device in sorted(totals['lines'], key=str):
+            lines.append(f"{device}")
+            lines.append(f"  {rate('lines', device):8.1f} lines/s  "
+                         f"{rate('bytes', device) / 1024:8.2f} kB/s  "
+                         f"{totals['lines'][device]} lines total")
+            lines.append(f"  parse failures {failures.get(device, 0)}, "
+                         f"reconnects {reconnects.get(device, 0)}")
+            lines.append(f"  read wait p50 {ms(metrics.READ_WAIT, 0.5, device)} ms, "
+                         f"parse p50 {ms(metrics.PARSE_TIME, 0.5, device)} ms "
+                         f"p99 {ms(metrics.PARSE_TIME, 0.99, device)} ms")
+        if not lines:
+            lines.append("No device traffic yet")
+
+        lines.append("")
+        lines.append(f"Database  {rate('rows', None):8.1f} rows/s  "
+                     f"{totals['rows'].get(None, 0)} rows total")
+        lines.append(f"  commit p50 {ms(metrics.COMMIT_LATENCY, 0.5)} ms "
+                     f"p99 {ms(metrics.COMMIT_LATENCY, 0.99)} ms")
+        depths = metrics.QUEUE_DEPTH.collect()
+        if depths:
+            lines.append("Queues  " + ", ".join(f"{name} {depth}"
+                                                for name, depth in sorted(depths.items())))
+        return lines
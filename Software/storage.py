@@ -0,0 +1,371 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+from sqlalchemy import insert, select
+from models import MoistureContent
+import queries
+import rollups
+
+# Where the batched writers put readings. A storage takes batches of row
+# dicts (ingest.make_row, already calibrated) and answers range scans with
+# one NumPy array per column. SqliteStorage is the default and writes
+# MoistureContent plus its rollups; SegmentStore is an append-only
+# alternative for measuring ingest rates, e.g.
+#   python benchmark.py --path controller --storage segments:readings
+# The charts, reports, export and run views read MoistureContent and the
+# rollups only, so the acquisition programs always write SQLite. Runs,
+# calibration curves and settings stay in the SQLite database either way.
+
+Columns = namedtuple('Columns', ['time', 'moisture_percent', 'temperature', 'humidity',
+                                 'raw_counts', 'seq', 'run_id', 'device_id'])
+
+# Fixed-width record of the segment store, one file per column. seq and
+# run_id are floats so a missing one is NaN like the measurements (exact
+# below 2**53). A segment holds one device, so its device_id is not stored
+# per record but filled in by scans.
+RECORD = (('time', 'M8[us]'), ('moisture_percent', 'f8'), ('temperature', 'f8'),
+          ('humidity', 'f8'), ('raw_counts', 'f8'), ('seq', 'f8'), ('run_id', 'f8'))
+
+SEGMENT_ROWS = 65536  # Records preallocated per segment
+SEAL_SECONDS = 3600  # Longest stretch of time in one segment
+FLUSH_SECONDS = 5.0  # Longest time written records stay unsynced and out of the index
+INDEX_FILE = 'index.json'
+
+
+def to_columns(rows):
+    """Columns from tuples in RECORD order followed by the device_id, or from row dicts"""
+    if rows and isinstance(rows[0], dict):
+        rows = [(row['date_created'], row['moisture_percent'], row['temperature'],
+                 row['humidity'], row['raw_counts'], row['seq'], row['run_id'],
+                 row['device_id']) for row in rows]
+    # None becomes NaN in the float columns
+    values = [np.array([row[i] for row in rows], dtype=dtype)
+              for i, (_, dtype) in enumerate(RECORD)]
+    return Columns(*values, np.array([row[len(RECORD)] for row in rows], dtype=object))
+
+
+def empty_columns():
+    return Columns(*(np.empty(0, dtype=dtype) for _, dtype in RECORD), np.empty(0, dtype=object))
+
+
+def _time(value):
+    return None if value is None else np.datetime64(value, 'us')
+
+
+class Storage:
+    """What ReadingWriter and BatchWriter write to.
+
+    write() is called from a single writer thread; scan() may be called
+    from any thread.
+    """
+
+    def write(self, rows):
+        """Store a batch of row dicts"""
+        raise NotImplementedError
+
+    def rollback(self):
+        """Discard what is left of a batch whose write() failed"""
+
+    def scan(self, start=None, end=None, device_id=None):
+        """Columns of the readings with start <= time < end, oldest first"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteStorage(Storage):
+    """MoistureContent and the rollup tables through one long-lived session"""
+
+    def __init__(self, Session):
+        self.Session = Session
+        self.session = None  # Created on the writer thread
+
+    def write(self, rows):
+        if self.session is None:
+            self.session = self.Session()
+        self.session.execute(insert(MoistureContent), rows)
+        rollups.apply(self.session, rows)
+        self.session.commit()
+
+    def rollback(self):
+        if self.session is not None:
+            self.session.rollback()
+
+    def scan(self, start=None, end=None, device_id=None):
+        stmt = queries.filter_range(
+            select(MoistureContent.date_created, MoistureContent.moisture_percent,
+                   MoistureContent.temperature, MoistureContent.humidity,
+                   MoistureContent.raw_counts, MoistureContent.seq, MoistureContent.run_id,
+                   MoistureContent.device_id),
+            start, end, device_id
+        ).order_by(MoistureContent.date_created)
+        with self.Session() as session:
+            rows = session.execute(stmt).all()
+        return to_columns(rows) if rows else empty_columns()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class Segment:
+    """Column files holding one device's records for a stretch of time"""
+
+    def __init__(self, path, capacity, rows=0, start=None, end=None, sealed=False,
+                 ordered=True):
+        self.path = path
+        self.capacity = capacity
+        self.rows = rows
+        self.start = start  # datetime64 of the oldest and newest record
+        self.end = end
+        self.sealed = sealed
+        self.ordered = ordered  # Records are in time order
+        self.columns = None
+
+    @classmethod
+    def create(cls, path, capacity):
+        segment = cls(path, capacity)
+        segment.columns = [np.memmap(segment.file(name), dtype=dtype, mode='w+', shape=(capacity,))
+                           for name, dtype in RECORD]
+        return segment
+
+    @classmethod
+    def from_index(cls, directory, entry):
+        return cls(os.path.join(directory, entry['name']), entry['capacity'], entry['rows'],
+                   _time(entry['start']), _time(entry['end']), entry['sealed'], entry['ordered'])
+
+    def index_entry(self):
+        return {
+            'name': os.path.basename(self.path),
+            'capacity': self.capacity,
+            'rows': self.rows,
+            'start': None if self.start is None else str(self.start),
+            'end': None if self.end is None else str(self.end),
+            'sealed': self.sealed,
+            'ordered': self.ordered
+        }
+
+    def file(self, name):
+        return f"{self.path}.{name}"
+
+    def load(self):
+        """Map the column files, read-only once sealed"""
+        if self.columns is None:
+            mode = 'r' if self.sealed else 'r+'
+            self.columns = [np.memmap(self.file(name), dtype=dtype, mode=mode,
+                                      shape=(self.capacity,))
+                            for name, dtype in RECORD]
+        return self.columns
+
+    def append(self, values):
+        """Copy a batch (one array per column) behind the stored records.
+
+        The records reach the files through the page cache; flush() syncs them.
+        """
+        columns = self.load()
+        n = len(values[0])
+        for column, value in zip(columns, values):
+            column[self.rows:self.rows + n] = value
+        times = values[0]
+        if (self.end is not None and times[0] < self.end) or np.any(times[1:] < times[:-1]):
+            self.ordered = False  # A catch-up batch older than what is stored
+        low, high = times.min(), times.max()
+        self.start = low if self.start is None else min(self.start, low)
+        self.end = high if self.end is None else max(self.end, high)
+        self.rows += n
+
+    def flush(self):
+        """Sync the open segment's files"""
+        if self.columns is not None and not self.sealed:
+            for column in self.columns:
+                column.flush()
+
+    def seal(self):
+        """Sort the records by time, cut the files to size and map them read-only"""
+        columns = self.load()
+        if not self.ordered:
+            order = np.argsort(columns[0][:self.rows], kind='stable')
+            for column in columns:
+                column[:self.rows] = column[:self.rows][order]
+        for column in columns:
+            column.flush()
+        self.columns = None
+        for name, dtype in RECORD:
+            os.truncate(self.file(name), self.rows * np.dtype(dtype).itemsize)
+        self.capacity = self.rows
+        self.sealed = True
+        self.ordered = True
+
+    def scan(self, start=None, end=None):
+        """Arrays in RECORD order of the records in [start, end).
+
+        Sealed segments return views of the mapped files; the open segment
+        is copied, since it is still written to and sorted when sealed.
+        """
+        columns = self.load()
+        times = columns[0][:self.rows]
+        if self.ordered:
+            low = 0 if start is None else np.searchsorted(times, start, 'left')
+            high = self.rows if end is None else np.searchsorted(times, end, 'left')
+            if self.sealed:
+                return [column[low:high].view(np.ndarray) for column in columns]
+            return [np.array(column[low:high]) for column in columns]
+
+        mask = np.ones(self.rows, dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times < end
+        order = np.argsort(times[mask], kind='stable')
+        return [column[:self.rows][mask][order] for column in columns]
+
+
+class SegmentStore(Storage):
+    """Append-only, memory-mapped column files per device.
+
+    Each device's readings are appended to a segment preallocated for
+    `segment_rows` fixed-width records. A segment is sealed when it is full
+    or spans `seal_seconds`: its records are sorted by time, the files are
+    cut to size and mapped read-only. index.json records every segment's
+    size and time range, so a scan only maps the segments overlapping the
+    range and binary-searches inside them. Every column of a row is kept
+    but rollups are not maintained, and nothing but scan() reads it back.
+
+    Writes are not synced one by one: the open segments are flushed and the
+    index saved when a segment is sealed, at most `flush_seconds` after a
+    write and on close(). A crash of the machine loses at most that much,
+    and the index never counts records that were not synced.
+    """
+
+    def __init__(self, directory, segment_rows=SEGMENT_ROWS, seal_seconds=SEAL_SECONDS,
+                 flush_seconds=FLUSH_SECONDS):
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.seal_span = np.timedelta64(int(seal_seconds * 1e6), 'us')
+        self.flush_seconds = flush_seconds
+        self.flushed = time.monotonic()
+        self.devices = {}  # device_id -> (directory name, [Segment, ...])
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            index = json.load(f)
+        for device in index['devices']:
+            folder = os.path.join(self.directory, device['dir'])
+            self.devices[device['device_id']] = (
+                device['dir'], [Segment.from_index(folder, entry) for entry in device['segments']]
+            )
+
+    def _save_index(self):
+        index = {'devices': [
+            {'device_id': device_id, 'dir': name,
+             'segments': [segment.index_entry() for segment in segments]}
+            for device_id, (name, segments) in self.devices.items()
+        ]}
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def _open_segment(self, device_id):
+        """The segment that takes the device's next records"""
+        if device_id not in self.devices:
+            name = f"d{len(self.devices) + 1:04d}"
+            os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+            self.devices[device_id] = (name, [])
+        name, segments = self.devices[device_id]
+        if not segments or segments[-1].sealed:
+            path = os.path.join(self.directory, name, f"{len(segments) + 1:06d}")
+            segments.append(Segment.create(path, self.segment_rows))
+        return segments[-1]
+
+    def write(self, rows):
+        by_device = {}
+        for row in rows:
+            by_device.setdefault(row['device_id'], []).append(row)
+        with self.lock:
+            sealed = False
+            for device_id, device_rows in by_device.items():
+                values = to_columns(device_rows)[:len(RECORD)]
+                while len(values[0]):
+                    segment = self._open_segment(device_id)
+                    take = segment.capacity - segment.rows
+                    segment.append([column[:take] for column in values])
+                    values = [column[take:] for column in values]
+                    if segment.rows == segment.capacity or segment.end - segment.start >= self.seal_span:
+                        segment.seal()
+                        sealed = True
+            if sealed or time.monotonic() - self.flushed >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        """Sync the open segments, then save the index that counts their records"""
+        for _, segments in self.devices.values():
+            for segment in segments:
+                segment.flush()
+        self._save_index()
+        self.flushed = time.monotonic()
+
+    def segments(self, start=None, end=None, device_id=None):
+        """(device_id, segment) of the segments that may hold records in [start, end)"""
+        start, end = _time(start), _time(end)
+        found = []
+        for key, (_, segments) in self.devices.items():
+            if device_id is not None and key != device_id:
+                continue
+            for segment in segments:
+                if not segment.rows:
+                    continue
+                if (end is not None and segment.start >= end) or (start is not None and segment.end < start):
+                    continue
+                found.append((key, segment))
+        return found
+
+    def chunks(self, start=None, end=None, device_id=None):
+        """Columns per overlapping segment, in storage order, without merging"""
+        chunks = []
+        with self.lock:
+            for key, segment in self.segments(start, end, device_id):
+                values = segment.scan(_time(start), _time(end))
+                chunks.append(Columns(*values, np.full(len(values[0]), key, dtype=object)))
+        return chunks
+
+    def scan(self, start=None, end=None, device_id=None):
+        chunks = [chunk for chunk in self.chunks(start, end, device_id) if len(chunk.time)]
+        if not chunks:
+            return empty_columns()
+        if len(chunks) == 1:
+            return chunks[0]
+        merged = Columns(*(np.concatenate(columns) for columns in zip(*chunks)))
+        if np.any(merged.time[1:] < merged.time[:-1]):
+            # Several devices, or segments that overlap after a catch-up
+            order = np.argsort(merged.time, kind='stable')
+            merged = Columns(*(column[order] for column in merged))
+        return merged
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            for _, segments in self.devices.values():
+                for segment in segments:
+                    segment.columns = None
+
+
+def open_storage(spec, Session):
+    """Storage for benchmark.py --storage: 'sqlite' (the default) or 'segments:<directory>'"""
+    if not spec or spec == 'sqlite':
+        return SqliteStorage(Session)
+    kind, _, directory = spec.partition(':')
+    if kind == 'segments' and directory:
+        return SegmentStore(directory)
+    raise ValueError(f"Unknown storage {spec!r}, expected 'sqlite' or 'segments:<directory>'")
@@ -0,0 +1,64 @@
+import os
+import sys
+import queue
+import time
+import pytest
+
+# The modules are flat scripts in Software/, imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serial_reader import SerialReader, open_serial  # noqa: E402
+
+# Tests that drive simulator.FakeDevice on a pty read it back through
+# SerialReader and its FrameDecoder like the real host does.
+
+requires_pty = pytest.mark.skipif(not hasattr(os, 'openpty'), reason="FakeDevice needs a POSIX pty")
+
+
+@pytest.fixture
+def devices():
+    from simulator import FakeDevice
+    started = []
+
+    def make(**options):
+        device = FakeDevice(**options).start()
+        started.append(device)
+        return device
+    yield make
+    for device in started:
+        device.stop()
+
+
+@pytest.fixture
+def connect():
+    opened = []
+
+    def make(device):
+        ser = open_serial(device.port, timeout=0.1)
+        reader = SerialReader(ser).start()
+        opened.append((ser, reader))
+        return ser, reader
+    yield make
+    for ser, reader in opened:
+        reader.stop()
+        ser.close()
+
+
+def collect(reader, until, timeout=5.0):
+    """Items from the reader up to and including the first one until() accepts"""
+    items = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            item = reader.lines.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        assert item is not None, reader.error
+        items.append(item)
+        if until(item):
+            return items
+    pytest.fail(f"Timed out after {items!r}")
+
+
+def is_status(prefix):
+    return lambda item: isinstance(item, bytes) and item.startswith(prefix)
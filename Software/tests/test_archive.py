@@ -0,0 +1,82 @@
+import csv
+import gzip
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import insert, select, func
+from models import setup_database, MoistureContent
+import archive
+import export
+import retention
+import runs
+
+FORMATS = ['csv'] + (['parquet', 'arrow'] if archive.pa is not None else [])
+START = datetime(2026, 1, 20)
+
+
+@pytest.fixture
+def database(tmp_path):
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'archive.db'}")
+    run_id = runs.start(Session, 'sensor-a', START, sample_count=40, interval_ms=3600000)
+    rows = []
+    for i in range(40):
+        rows.append(dict(date_created=START + timedelta(hours=12 * i), device_id='sensor-a',
+                         moisture_percent=20.0 + i / 10, temperature=25.0, humidity=None,
+                         raw_counts=2000 + i, seq=i + 1, run_id=run_id))
+        rows.append(dict(date_created=START + timedelta(hours=12 * i, minutes=5),
+                         device_id='sensor-b', moisture_percent=30.0, temperature=None,
+                         humidity=55.0, raw_counts=None, seq=None, run_id=None))
+    with engine.begin() as conn:
+        conn.execute(insert(MoistureContent), rows)
+    yield engine, Session, run_id
+    engine.dispose()
+
+
+def stored(engine):
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(
+            select(*archive.COLUMNS).order_by(MoistureContent.date_created))]
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_archive_round_trip(database, tmp_path, fmt):
+    engine, Session, run_id = database
+    before = stored(engine)
+    cutoff = START + timedelta(days=15)
+
+    assert retention.archive_expired(engine, cutoff, tmp_path / 'archive', fmt) == 60
+    with engine.connect() as conn:
+        assert conn.scalar(select(func.count()).select_from(MoistureContent)) == 20
+        archived = [row for chunk in archive.iter_archived(conn, chunk_size=7) for row in chunk]
+    # Every column comes back, None included
+    assert archived == [row for row in before if row[4] < cutoff]
+
+    exported = [row for chunk in export.iter_chunks(engine) for row in chunk]
+    assert exported == [row[:len(export.HEADER)] for row in before]
+
+    with Session() as session:
+        readings = runs.readings(session, run_id)
+    assert [r.seq for r in readings] == list(range(1, 41))
+    assert [r.raw_counts for r in readings] == [2000 + i for i in range(40)]
+
+
+def test_old_archive_files_read_back(database, tmp_path):
+    engine, Session, run_id = database
+    path = tmp_path / 'old.csv.gz'
+    with gzip.open(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(export.HEADER)
+        writer.writerow([7, 21.5, 24.0, '', START.isoformat(), 'sensor-a'])
+    part = archive.Part(str(path), 'csv', START, START + timedelta(days=1), 1, 7)
+    assert list(archive.read_part(part)) == [
+        [(7, 21.5, 24.0, None, START, 'sensor-a', None, None, None)]]
+
+
+def test_user_export_keeps_its_columns(database, tmp_path):
+    engine, Session, run_id = database
+    retention.archive_expired(engine, START + timedelta(days=15), tmp_path / 'archive', 'csv')
+    path = tmp_path / 'out.csv'
+    assert export.export(engine, str(path)) == 80
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == export.HEADER
+    assert {len(row) for row in rows} == {len(export.HEADER)}
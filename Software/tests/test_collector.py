@@ -0,0 +1,59 @@
+import time
+import pytest
+from sqlalchemy import select
+from simulator import FakeDevice
+from models import setup_database, MeasurementRun
+from ingest import ReadingWriter
+from hub import DeviceLink
+import runs
+from conftest import requires_pty
+
+pytestmark = requires_pty
+
+
+@pytest.fixture
+def link(tmp_path):
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'runs.db'}")
+    writer = ReadingWriter(Session)
+    device = FakeDevice(total_loops=20, interval=0.05).start()
+    link = DeviceLink('sensor-a', device.port, writer).open()
+    yield link, device, Session
+    link.close()
+    device.stop()
+    writer.close()
+    engine.dispose()
+
+
+def run_status(link, Session, readings=3):
+    """Start a run, stop it after a few readings and return the stored status"""
+    link.send(b'S')
+    deadline = time.monotonic() + 5
+    while link.loop_count < readings and time.monotonic() < deadline:
+        time.sleep(0.01)
+    link.send(b'X')
+    while link.run_started is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with Session() as session:
+        return session.scalars(select(MeasurementRun.status)
+                               .order_by(MeasurementRun.id.desc())).first()
+
+
+def test_stopped_run_is_incomplete(link):
+    link, device, Session = link
+    # Nothing was configured: the settings are queried when the link opens
+    assert link.config == (20, 50)
+    assert run_status(link, Session) == runs.INCOMPLETE
+
+
+def test_stopped_burst_run_is_complete(link):
+    link, device, Session = link
+    link.send(b'N0\n')
+    time.sleep(0.2)
+    assert link.config == (0, 50)
+    assert run_status(link, Session) == runs.COMPLETE
+
+
+def test_unknown_config_is_not_burst(link):
+    link, device, Session = link
+    link.config = None  # Older firmware that never reports its settings
+    assert run_status(link, Session) == runs.INCOMPLETE
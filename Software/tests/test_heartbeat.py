@@ -0,0 +1,33 @@
+import time
+import serial_reader
+from serial_reader import PROBE_COMMAND
+from conftest import requires_pty
+
+pytestmark = requires_pty
+
+
+def test_heartbeats_keep_link_alive(devices, connect, monkeypatch):
+    monkeypatch.setattr(serial_reader, 'SILENCE_WINDOW', 0.4)
+    monkeypatch.setattr(serial_reader, 'PROBE_GRACE', 0.4)
+    device = devices(heartbeat_interval=0.1)
+    ser, reader = connect(device)
+
+    time.sleep(0.6)
+    assert reader.liveness() == 'alive'
+    assert reader.lines.empty()  # Heartbeats are never queued
+
+    # A quiet device answers the probe
+    device.heartbeat_interval = 60.0
+    time.sleep(0.5)
+    assert reader.liveness() == 'probe'
+    ser.write(PROBE_COMMAND)
+    time.sleep(0.2)
+    assert reader.liveness() == 'alive'
+
+    # A hung one is probed once, then given up
+    device.mute()
+    time.sleep(0.5)
+    assert reader.liveness() == 'probe'
+    assert reader.liveness() == 'alive'
+    time.sleep(0.4)
+    assert reader.liveness() == 'dead'
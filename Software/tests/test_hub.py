@@ -0,0 +1,47 @@
+import time
+from sqlalchemy import select
+from models import setup_database, MoistureContent, MeasurementRun
+from ingest import ReadingWriter
+from hub import AcquisitionHub
+import runs
+from conftest import requires_pty
+
+pytestmark = requires_pty
+
+
+def test_hub_keeps_devices_apart(devices, tmp_path):
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'hub.db'}")
+    writer = ReadingWriter(Session)
+    hub = AcquisitionHub(writer)
+    first = devices(interval=0.02, raw_counts=2000)
+    second = devices(interval=0.02, raw_counts=2600)
+    try:
+        hub.add_device(first.port, 'sensor-a')
+        hub.add_device(second.port, 'sensor-b')
+        hub.configure(count=6, interval_ms=20)
+        time.sleep(0.3)
+        assert {d: s['config'] for d, s in hub.status().items()} == {
+            'sensor-a': (6, 20), 'sensor-b': (6, 20)}
+        assert hub.start(grain_lot='lot-1') == ['sensor-a', 'sensor-b']
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and any(
+                s['collecting'] or s['loop'] < 6 for s in hub.status().values()):
+            time.sleep(0.05)
+    finally:
+        hub.close()
+        writer.close()
+
+    with Session() as session:
+        stored = session.execute(select(MoistureContent.device_id, MoistureContent.raw_counts,
+                                        MoistureContent.run_id, MoistureContent.seq)).all()
+        run_rows = {run.device_id: run for run in session.scalars(select(MeasurementRun))}
+    assert sorted(run_rows) == ['sensor-a', 'sensor-b']
+    for device_id, counts in (('sensor-a', 2000), ('sensor-b', 2600)):
+        rows = [row for row in stored if row.device_id == device_id]
+        run = run_rows[device_id]
+        assert [row.seq for row in rows] == [1, 2, 3, 4, 5, 6]
+        assert {row.raw_counts for row in rows} == {counts}
+        assert {row.run_id for row in rows} == {run.id}
+        assert run.status == runs.COMPLETE and run.readings == 6 and run.grain_lot == 'lot-1'
+    engine.dispose()
@@ -0,0 +1,38 @@
+from datetime import datetime
+import ingest
+from ingest import ReadingWriter
+from models import setup_database
+from storage import Storage
+
+
+class FlakyStorage(Storage):
+    """Fails every write while `failing` is set"""
+
+    def __init__(self):
+        self.failing = True
+        self.rows = []
+
+    def write(self, rows):
+        if self.failing:
+            raise OSError("database is locked")
+        self.rows.extend(rows)
+
+
+def test_flush_reports_retained_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'RETRY_DELAY', 0.0)
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'ingest.db'}")
+    storage = FlakyStorage()
+    writer = ReadingWriter(Session, storage=storage)
+    try:
+        writer.put(21.5, 24.0, 60.0, datetime(2026, 3, 1), 'sensor-a')
+        assert writer.flush(timeout=5) is False
+        assert len(writer.retained) == 1
+
+        # The retained row goes out with the next batch
+        storage.failing = False
+        writer.put(21.7, 24.0, 60.0, datetime(2026, 3, 1, 0, 1), 'sensor-a')
+        assert writer.flush(timeout=5) is True
+        assert [row['moisture_percent'] for row in storage.rows] == [21.5, 21.7]
+    finally:
+        writer.close()
+        engine.dispose()
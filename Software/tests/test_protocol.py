@@ -0,0 +1,85 @@
+import time
+from protocol import (Reading, encode_reading, parse_message, negotiate_binary, configure,
+                      catch_up, started_seq)
+from conftest import requires_pty, collect, is_status
+
+pytestmark = requires_pty
+
+
+def readings(items):
+    return [data for data in map(parse_message, items) if data and 'moisture_percent' in data]
+
+
+def test_text_then_binary_frames(devices, connect):
+    device = devices(total_loops=4, interval=0.02)
+    ser, reader = connect(device)
+
+    ser.write(b'S')
+    text = collect(reader, is_status(b'Complete'))
+    assert all(isinstance(item, bytes) for item in text)
+    assert [r['moisture_percent'] for r in readings(text)] == [50.15] * 4
+    assert {'loop': 4} in [parse_message(item) for item in text]
+
+    assert negotiate_binary(reader, ser.write)
+    ser.write(b'S')
+    binary = collect(reader, is_status(b'Complete'))
+    frames = [item for item in binary if isinstance(item, Reading)]
+    assert [frame.seq for frame in frames] == [5, 6, 7, 8]
+    assert [frame.loop for frame in frames] == [1, 2, 3, 4]
+    # Status lines still arrive as text between the frames
+    assert started_seq(binary[0].decode()) == 4
+    assert reader.decoder.crc_errors == 0
+
+
+def test_corrupted_frame_is_skipped(devices, connect):
+    device = devices()
+    ser, reader = connect(device)
+
+    bad = bytearray(encode_reading(1, 1, 40.0, 20.0, 55.0, 2100))
+    bad[5] ^= 0x10
+    device.write(bytes(bad) + encode_reading(2, 2, 41.0, 20.0, 55.0, 2101) + b'Loop: 2\r\n')
+    items = collect(reader, lambda item: item == b'Loop: 2')
+
+    frames = [item for item in items if isinstance(item, Reading)]
+    assert [frame.seq for frame in frames] == [2]
+    assert frames[0].raw_counts == 2101
+    assert reader.decoder.crc_errors == 1
+
+
+def test_configure_commands(devices, connect):
+    device = devices()
+    ser, reader = connect(device)
+
+    assert configure(reader, ser.write, count=7, interval_ms=25) == (7, 25)
+    assert configure(reader, ser.write) == (7, 25)
+    assert configure(reader, ser.write, count=0) == (0, 25)  # Burst mode
+
+    # N without a count is rejected instead of switching to burst mode
+    ser.write(b'N\n')
+    line = collect(reader, is_status(b'Config:'))[-1]
+    assert line == b'Config: N=0 I=25'
+    configure(reader, ser.write, count=3)
+    ser.write(b'N\n')
+    assert collect(reader, is_status(b'Config:'))[-1] == b'Config: N=3 I=25'
+
+    # Intervals below 10 ms are ignored
+    assert configure(reader, ser.write, interval_ms=5) == (3, 25)
+
+
+def test_catch_up_after_drop(devices, connect):
+    device = devices(total_loops=20, interval=0.02, raw_counts=2200)
+    ser, reader = connect(device)
+    assert negotiate_binary(reader, ser.write)
+
+    ser.write(b'S')
+    live = collect(reader, lambda item: isinstance(item, Reading) and item.loop == 5)
+    device.drop()
+    time.sleep(0.6)  # The run finishes while the link is down
+    device.resume()
+
+    last = max(item.seq for item in live if isinstance(item, Reading))
+    items, info = catch_up(reader, ser.write, last)
+    stored = [parse_message(item) for _, item in items]
+    assert [data['seq'] for data in stored] == list(range(last + 1, 21))
+    assert all(data['stored'] and data['raw_counts'] is not None for data in stored)
+    assert info['seq'] == 20 and info['loop'] == 20 and info['running'] == 0
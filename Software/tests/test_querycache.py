@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from sqlalchemy import insert
+from models import setup_database, MoistureContent
+from calibration import CalibrationEngine, reprocess
+import downsample
+import querycache
+from querycache import QueryCache
+
+START = datetime(2026, 2, 1)
+
+
+@pytest.fixture
+def database(tmp_path):
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'cache.db'}")
+    yield engine, Session
+    engine.dispose()
+
+
+def add(engine, times, moisture=20.0, raw_counts=None):
+    with engine.begin() as conn:
+        conn.execute(insert(MoistureContent), [
+            dict(date_created=t, device_id='sensor-a', moisture_percent=moisture + i % 7,
+                 temperature=25.0, raw_counts=raw_counts) for i, t in enumerate(times)])
+
+
+def same(a, b):
+    return np.array_equal(a[0], b[0]) and np.allclose(a[1], b[1])
+
+
+def test_bucketed_series_is_not_extended_twice(database, monkeypatch):
+    engine, Session = database
+    points = 10
+    add(engine, [START + timedelta(minutes=i) for i in range(points * 30)])
+    cache = QueryCache()
+
+    # A row is committed while the (bucketed) series is computed: it is in
+    # the result and also newer than the watermark taken before
+    compute = downsample.lttb_series
+    late = START + timedelta(minutes=points * 30, seconds=30)
+
+    def racing(session, *args):
+        add(engine, [late])
+        return compute(session, *args)
+    monkeypatch.setattr(querycache.downsample, 'lttb_series', racing)
+    with Session() as session:
+        first = cache.series(session, START, points=points)
+    monkeypatch.setattr(querycache.downsample, 'lttb_series', compute)
+
+    with Session() as session:
+        assert not compute(session, START, None, points)[2]  # Reduced from SQL buckets
+        assert same(cache.series(session, START, points=points), first)
+        assert same(first, downsample.series(session, START, points=points))
+
+
+def test_raw_series_is_extended(database):
+    engine, Session = database
+    add(engine, [START + timedelta(minutes=i) for i in range(5)])
+    cache = QueryCache()
+    with Session() as session:
+        cache.series(session, START)
+        add(engine, [START + timedelta(minutes=10)])
+        times, values = cache.series(session, START)
+    assert len(times) == 6 and times[-1] == np.datetime64(START + timedelta(minutes=10), 'ms')
+
+
+def test_reprocess_invalidates(database):
+    engine, Session = database
+    add(engine, [START + timedelta(minutes=i) for i in range(5)], raw_counts=2000)
+    cache = QueryCache()
+    end = START + timedelta(days=1)
+    with Session() as session:
+        before = cache.series(session, START, end)
+
+    CalibrationEngine(Session).set_device('sensor-a', dry_counts=1000, wet_counts=3000)
+    assert reprocess(engine, Session) == 5
+    with Session() as session:
+        after = cache.series(session, START, end)
+        assert same(after, downsample.series(session, START, end))
+    assert not same(before, after)
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from models import setup_database
+from storage import SqliteStorage, SegmentStore
+
+START = datetime(2026, 3, 1)
+
+
+def rows(count):
+    """Readings of two devices, interleaved in time"""
+    return [dict(date_created=START + timedelta(seconds=i), device_id=f"sensor-{'ab'[i % 2]}",
+                 moisture_percent=20.0 + i, temperature=None, humidity=None,
+                 raw_counts=2000 + i, seq=i // 2 + 1, run_id=None) for i in range(count)]
+
+
+@pytest.fixture(params=['sqlite', 'segments'])
+def storage(request, tmp_path):
+    engine, Session = setup_database(f"sqlite:///{tmp_path / 'storage.db'}")
+    if request.param == 'sqlite':
+        storage = SqliteStorage(Session)
+    else:
+        storage = SegmentStore(str(tmp_path / 'segments'), segment_rows=8)
+    yield storage
+    storage.close()
+    engine.dispose()
+
+
+def test_scan_keeps_devices_apart(storage):
+    storage.write(rows(30))
+    merged = storage.scan()
+    assert list(merged.device_id) == [f"sensor-{'ab'[i % 2]}" for i in range(30)]
+    assert list(merged.moisture_percent) == [20.0 + i for i in range(30)]
+
+    one = storage.scan(START + timedelta(seconds=10), START + timedelta(seconds=20), 'sensor-b')
+    assert set(one.device_id) == {'sensor-b'}
+    assert list(one.raw_counts) == [2011, 2013, 2015, 2017, 2019]
+
+
+def test_segments_flush_on_seal_and_close(tmp_path):
+    directory = str(tmp_path / 'segments')
+    store = SegmentStore(directory, segment_rows=8, flush_seconds=3600)
+    store.write(rows(6))
+    # Not synced yet, so not in the index either
+    assert len(SegmentStore(directory).scan().time) == 0
+    store.write(rows(20)[6:])
+    # sensor-a filled its first segment: sealing saves everything written so far
+    assert len(SegmentStore(directory).scan().time) == 20
+    store.write(rows(24)[20:])
+    store.close()
+    reopened = SegmentStore(directory).scan()
+    assert np.array_equal(reopened.raw_counts, np.arange(2000, 2024))
+    assert list(reopened.device_id[:2]) == ['sensor-a', 'sensor-b']
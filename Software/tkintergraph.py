@@ -1,61 +1,61 @@
-from sqlalchemy import create_engine
-import pandas as pd
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
 import tkinter as tk
 from tkinter import ttk
-import matplotlib.pyplot as plt
+from models import setup_database
+from querycache import QueryCache
+
+REFRESH_MS = 5000  # Auto-refresh interval
+POINTS = 500  # Whole history is downsampled to this many points
 
 # Create database connection
-engine = create_engine("sqlite:///moistureDB.db")
+engine, Session = setup_database()
+cache = QueryCache()  # Refreshes only fetch the readings stored since the last one
 
 # Create the main window
 root = tk.Tk()
 root.geometry("800x600")  # Larger window for better graph visibility
 root.title("Moisture Data Visualization")
 
+# Create the figure, line and canvas once; refreshes only replace the data
+figure = Figure(figsize=(10, 6))
+ax = figure.add_subplot()
+line, = ax.plot([], [], marker='o', markersize=3)
+
+# Customize the plot
+ax.set_title('Moisture Content Over Time')
+ax.set_xlabel('Time')
+ax.xaxis_date()
+ax.set_ylabel('Moisture (%)')
+ax.grid(True)
+
+# Rotate x-axis labels for better readability
+ax.tick_params(axis='x', labelrotation=45)
+
+canvas = FigureCanvasTkAgg(figure, root)
+canvas.get_tk_widget().grid(row=1, column=0, padx=10, pady=10)
+
 def update_graph(*args):
-    # Query to get the moisture data
-    query = """
-    SELECT id, moisture_percent, date_created 
-    FROM MoistureContent 
-    ORDER BY date_created DESC 
-    LIMIT 50
-    """
-    
-    # Read data into DataFrame
-    df = pd.read_sql(query, engine)
+    # Full history reduced to POINTS samples, bucketed in SQL for large tables
+    with Session() as session:
+        times, values = cache.series(session, points=POINTS)
     
-    # Clear previous graph
-    for widget in root.grid_slaves():
-        if isinstance(widget, FigureCanvasTkAgg):
-            widget.get_tk_widget().destroy()
-    
-    # Create new figure with larger size
-    plt.figure(figsize=(10, 6))
-    
-    # Create the line plot
-    plt.plot(df['id'], df['moisture_percent'], marker='o')
-    
-    # Customize the plot
-    plt.title('Moisture Content Over Time')
-    plt.xlabel('Reading ID')
-    plt.ylabel('Moisture (%)')
-    plt.grid(True)
-    
-    # Rotate x-axis labels for better readability
-    plt.xticks(rotation=45)
-    
-    # Create canvas and show plot
-    canvas = FigureCanvasTkAgg(plt.gcf(), root)
-    canvas.draw()
-    canvas.get_tk_widget().grid(row=1, column=0, padx=10, pady=10)
+    # Update the existing line instead of building a new figure
+    line.set_data(times, values)
+    ax.relim()
+    ax.autoscale_view()
+    canvas.draw_idle()
+
+def auto_refresh():
+    update_graph()
+    root.after(REFRESH_MS, auto_refresh)
 
 # Create refresh button
 refresh_btn = ttk.Button(root, text="Refresh Data", command=update_graph)
 refresh_btn.grid(row=0, column=0, padx=10, pady=10)
 
-# Show initial graph
-update_graph()
+# Show initial graph and keep it current
+auto_refresh()
 
 # Start the GUI
-root.mainloop()
\ No newline at end of file
+root.mainloop()
@@ -0,0 +1,79 @@
+import threading
+
+FRAME_MS = 50  # At most 20 UI updates per second
+
+
+class UiDispatcher:
+    """Coalesces UI state from any thread and applies it on the Tk thread.
+
+    Workers call `set(key, value)` for state such as the status line or the
+    progress bar; only the latest value per key is kept, so a burst of
+    thousands of updates costs one widget change. A single `after()` loop
+    applies whatever changed once per `interval_ms`, and handlers only run
+    for keys whose value actually changed. `call()` queues one-off actions
+    (dialogs, packing a button) for the next frame.
+    """
+
+    def __init__(self, root, interval_ms=FRAME_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.handlers = {}
+        self.applied = {}
+        self.pending = {}
+        self.actions = []
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.coalesced = 0
+        self.job = None
+
+    def register(self, key, handler, initial=None):
+        """Call handler(value) on the Tk thread whenever `key` changes"""
+        self.handlers[key] = handler
+        self.applied[key] = initial
+
+    def set(self, key, value):
+        """Record the latest value of `key` (thread-safe, never blocks on Tk)"""
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = value
+
+    def get(self, key):
+        """Latest value of `key`, including changes not applied yet"""
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+        return self.applied.get(key)
+
+    def call(self, action, *args):
+        with self.lock:
+            self.actions.append((action, args))
+
+    def start(self):
+        self.job = self.root.after(self.interval_ms, self._frame)
+        return self
+
+    def stop(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+
+    def _frame(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            actions, self.actions = self.actions, []
+        for key, value in pending.items():
+            if self.applied.get(key) == value:
+                continue
+            self.applied[key] = value
+            self.updates += 1
+            try:
+                self.handlers[key](value)
+            except Exception as e:
+                print(f"UI update for {key} failed: {e}")
+        for action, args in actions:
+            try:
+                action(*args)
+            except Exception as e:
+                print(f"UI action failed: {e}")
+        self.job = self.root.after(self.interval_ms, self._frame)